@@ -0,0 +1,40 @@
+# Onno de Gouw
+# Stefan Popa
+
+# Micro-benchmark of the checksum engine against the original per-word loop.
+# Run from the project directory: python3 -m benchmarks.checksum
+
+import argparse
+import os
+import timeit
+
+from btcp import checksum
+from btcp.constants import *
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--number", help="Number of checksums per measurement", type=int, default=2000)
+    args = parser.parse_args()
+
+    header = os.urandom(HEADER_SIZE)
+    payload = os.urandom(PAYLOAD_SIZE)
+    payload_sum = checksum.ones_sum(payload)
+    segment = header + payload
+    new_header = os.urandom(HEADER_SIZE)
+
+    cases = [
+        ("reference loop, full segment", lambda: checksum.in_cksum_reference(segment)),
+        ("wide integer, full segment", lambda: checksum.in_cksum(segment)),
+        ("wide integer, memoryview", lambda: checksum.in_cksum(memoryview(segment))),
+        ("header + cached payload sum", lambda: checksum.finish(checksum.add(checksum.ones_sum(header), payload_sum))),
+        ("incremental header update", lambda: checksum.update(payload_sum, header, new_header)),
+    ]
+
+    for name, case in cases:
+        seconds = min(timeit.repeat(case, number=args.number, repeat=5))
+        print("{:<32} {:>10.3f} us/segment".format(name, seconds / args.number * 1e6))
+
+
+if __name__ == "__main__":
+    main()
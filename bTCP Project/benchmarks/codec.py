@@ -0,0 +1,61 @@
+# Onno de Gouw
+# Stefan Popa
+
+# Micro-benchmark of the segment codec: the cost to encode and decode one segment, against the original code that
+# packed every header twice and sliced received segments into new bytes objects.
+# Run from the project directory: python3 -m benchmarks.codec
+
+import argparse
+import os
+import struct
+import timeit
+
+from socket import htons
+from btcp import checksum, codec
+from btcp.constants import *
+
+
+# The original build_header: the format string is parsed on every call and the header is packed twice
+def legacy_header(seq_num, ack_num, flags, window, data_length, data):
+    header = struct.pack("HHBBhH", seq_num, ack_num, flags, window, data_length, 0)
+    cksum = htons(checksum.finish(checksum.add(checksum.ones_sum(header), checksum.ones_sum(data)))) & 0xffff
+
+    return struct.pack("HHBBhH", seq_num, ack_num, flags, window, data_length, cksum)
+
+
+# The original unpack_segment: header and data are copied out of the datagram
+def legacy_decode(segment):
+    header = segment[:HEADER_SIZE]
+    data = segment[HEADER_SIZE:]
+
+    return struct.unpack("HHBBhH", header) + (header, data)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--number", help="Number of segments per measurement", type=int, default=20000)
+    args = parser.parse_args()
+
+    payload = memoryview(os.urandom(PAYLOAD_SIZE))
+    control = struct.pack("d", 0)
+    sack = codec.SACK_BLOCK.pack(100, 110) + codec.SACK_BLOCK.pack(120, 130)
+    segment = bytes(codec.encode_header(1, 0, 0, 100, 0, payload)) + bytes(payload)
+    ack = bytes(codec.encode(0, 1, ACK, 100, len(sack), sack))
+
+    cases = [
+        ("encode data header (legacy)", lambda: legacy_header(1, 0, 0, 100, 0, payload)),
+        ("encode data header", lambda: codec.encode_header(1, 0, 0, 100, 0, payload)),
+        ("encode control segment (legacy)", lambda: legacy_header(1, 0, SYN, 100, 0, control) + control),
+        ("encode control segment", lambda: codec.encode(1, 0, SYN, 100, 0, control)),
+        ("decode data segment (legacy)", lambda: legacy_decode(segment)),
+        ("decode data segment", lambda: codec.decode(segment)),
+        ("decode ACK with SACK blocks", lambda: list(codec.SACK_BLOCK.iter_unpack(codec.decode(ack).data))),
+    ]
+
+    for name, case in cases:
+        seconds = min(timeit.repeat(case, number=args.number, repeat=5))
+        print("{:<36} {:>10.3f} us/segment".format(name, seconds / args.number * 1e6))
+
+
+if __name__ == "__main__":
+    main()
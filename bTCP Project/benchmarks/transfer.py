@@ -0,0 +1,321 @@
+# Onno de Gouw
+# Stefan Popa
+
+# Benchmark of complete transfers. Sweeps window size, timeout, file size, impairment profile, kind of data (random
+# or compressible text) and compression and reports, for every combination, the completion time, goodput (of the
+# file, not of what went over the wire), retransmission ratio, CPU time per MB and peak RSS as JSON.
+# Transfers run in-process (a client and a server socket in one fresh process per transfer) or through
+# client_app.py and server_app.py. Impairments are emulated in-process (see btcp.impairment) with a fixed seed, so
+# runs are reproducible. Given a baseline (the JSON output of an earlier run), it reports every case whose goodput or
+# CPU time per MB became worse than the tolerance allows and exits with status 1.
+# Run from the project directory, for example:
+#     python3 -m benchmarks.transfer -s 1M,10M -p ideal,lossy -o results.json
+#     python3 -m benchmarks.transfer -b results.json
+#     python3 -m benchmarks.transfer -s 10M -p narrow -d random,text -z none,zlib:1,zlib,lzma:1
+
+import argparse
+import filecmp
+import itertools
+import json
+import mmap
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from btcp.client_socket import BTCPClientSocket
+from btcp.server_socket import BTCPServerSocket
+from btcp.impairment import Impairment
+from btcp.constants import *
+
+
+# The network profiles of testframework.py, as tc netem arguments
+PROFILES = {
+    "ideal": "",
+    "flipping": "corrupt 1%",
+    "duplicates": "duplicate 10%",
+    "lossy": "loss 10% 25%",
+    "burst": "loss gemodel 1% 30%",
+    "reordering": "delay 20ms reorder 25% 50%",
+    "delayed": "delay 100ms 20ms",
+    "allbad": "corrupt 1% duplicate 10% loss 10% 25% delay 20ms reorder 25% 50%",
+    "narrow": "rate 20mbit",
+}
+
+# The kinds of data to transfer
+DATA = ["random", "text"]
+
+# The metrics compared with the baseline: name and whether a higher value is better
+COMPARED = [("goodput_mbps", True), ("cpu_seconds_per_mb", False)]
+
+APP_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# Parse a size like "64K", "10M" or "1G" into bytes
+def parse_size(word):
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    if word[-1].upper() in units:
+        return int(float(word[:-1]) * units[word[-1].upper()])
+
+    return int(word)
+
+
+def parse_list(parse):
+    return lambda value: [parse(word) for word in value.split(",")]
+
+
+# Return size bytes of data of the given kind: random bytes, which do not compress, or lines of a CSV log, which
+# compress about as well as the logs, CSV and JSON files we transfer
+def generate(kind, size):
+    if kind == "random":
+        return os.urandom(size)
+
+    rng = random.Random(size)
+    lines = []
+    length = 0
+    while length < size:
+        line = "2026-01-{:02d}T{:02d}:{:02d}:{:02d},host{},GET /api/v1/items/{},{},{:.3f}\n".format(
+            rng.randrange(1, 29), rng.randrange(24), rng.randrange(60), rng.randrange(60), rng.randrange(20),
+            rng.randrange(100000), rng.choice([200, 200, 200, 404, 500]), rng.random() * 100).encode()
+        lines.append(line)
+        length += len(line)
+
+    return b"".join(lines)[:size]
+
+
+# Return the impairment description of a profile with the seed, or None for an ideal network
+def impairment_spec(profile, seed):
+    spec = PROFILES[profile]
+
+    return "{} seed {}".format(spec, seed) if spec else None
+
+
+# Transfer input_path to output_path with a client and a server socket in this process, compressed as described by
+# compression (None for no compression). Returns the completion time in seconds and the retransmission ratio.
+def transfer_in_process(input_path, output_path, window, timeout, spec, compression):
+    impairment = Impairment.parse(spec) if spec else None
+    server = BTCPServerSocket(window, timeout, ("127.0.0.1", 0), impairment=impairment)
+
+    def serve():
+        connection = server.accept()
+        with open(output_path, "wb") as file:
+            connection.recv_to_file(file)
+        connection.close()
+
+    thread = threading.Thread(target=serve)
+    thread.start()
+    client = BTCPClientSocket(window, timeout, server._lossy_layer._udp_sock.getsockname(), ("127.0.0.1", 0),
+                              impairment=impairment, compression=compression)
+
+    with open(input_path, "rb") as file:
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(file.fileno()).st_size > 0 else b""
+
+        start = time.perf_counter()
+        if client.connect() == 0:
+            raise RuntimeError("connection establishment failed")
+        first_seq_num = client._seq_num
+        client.send(data)
+        client.disconnect()
+        thread.join()
+        seconds = time.perf_counter() - start
+
+        if isinstance(data, mmap.mmap):
+            data.close()
+
+    client.close()
+    server.close()
+
+    new = client._seq_num - first_seq_num
+
+    return seconds, client.stats.retransmissions / new if new > 0 else 0.0
+
+
+# Run one in-process transfer; called in a fresh process, so CPU time and peak RSS belong to this transfer alone
+def run_in_process(input_path, output_path, window, timeout, spec, compression):
+    cpu_start = time.process_time()
+    seconds, retransmission_ratio = transfer_in_process(input_path, output_path, window, timeout, spec, compression)
+    cpu_seconds = time.process_time() - cpu_start
+
+    return seconds, retransmission_ratio, cpu_seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+# Wait for a child process, and return its CPU time and peak RSS
+def wait_for(process):
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    return usage.ru_utime + usage.ru_stime, usage.ru_maxrss
+
+
+# Run one transfer with client_app.py and server_app.py. The retransmission ratio is not known to the benchmark.
+def run_apps(input_path, output_path, window, timeout, spec, compression):
+    common = ["-w", str(window), "-t", str(timeout)] + (["-n", spec] if spec else [])
+    server = subprocess.Popen([sys.executable, "server_app.py", "-o", output_path] + common, cwd=APP_DIRECTORY,
+                              stdout=subprocess.DEVNULL)
+    # Give the server time to bind its socket; the client would retransmit its SYN otherwise
+    time.sleep(0.5)
+
+    start = time.perf_counter()
+    client = subprocess.Popen([sys.executable, "client_app.py", "-i", input_path] + common +
+                              (["-z", compression] if compression else []), cwd=APP_DIRECTORY,
+                              stdout=subprocess.DEVNULL)
+    client_cpu, client_rss = wait_for(client)
+    server_cpu, server_rss = wait_for(server)
+    seconds = time.perf_counter() - start
+
+    if client.returncode != 0 or server.returncode != 0:
+        raise RuntimeError("client_app.py or server_app.py failed")
+
+    return seconds, None, client_cpu + server_cpu, max(client_rss, server_rss)
+
+
+# Run every repetition of one combination and summarize it with the medians
+def run_case(pool, mode, input_path, output_path, size, data, compression, window, timeout, profile, seed, repeat):
+    spec = impairment_spec(profile, seed)
+    runs = []
+    for _ in range(repeat):
+        if mode == "apps":
+            runs.append(run_apps(input_path, output_path, window, timeout, spec, compression))
+        else:
+            runs.append(pool.apply(run_in_process, (input_path, output_path, window, timeout, spec, compression)))
+
+        if not filecmp.cmp(input_path, output_path, shallow=False):
+            raise RuntimeError("the received file differs from the sent one")
+
+    seconds = statistics.median(run[0] for run in runs)
+    retransmission_ratios = [run[1] for run in runs if run[1] is not None]
+    megabytes = max(size, 1) / (1 << 20)
+
+    return {
+        "mode": mode,
+        "profile": profile,
+        "impairment": spec,
+        "window": window,
+        "timeout": timeout,
+        "size": size,
+        "data": data,
+        "compression": compression,
+        "repeat": repeat,
+        "seconds": seconds,
+        "all_seconds": [run[0] for run in runs],
+        "goodput_mbps": size * 8 / seconds / 1e6,
+        "retransmission_ratio": statistics.median(retransmission_ratios) if retransmission_ratios else None,
+        "cpu_seconds_per_mb": statistics.median(run[2] for run in runs) / megabytes,
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_mb": max(run[3] for run in runs) / 1024,
+    }
+
+
+# The combination a result belongs to, to find it in the baseline. Results from before the data and compression
+# options transferred random data without compression.
+def case_key(result):
+    return (result["mode"], result["profile"], result["window"], result["timeout"], result["size"],
+            result.get("data", "random"), result.get("compression"))
+
+
+# Return a description of every metric of results that is worse than in baseline by more than tolerance
+def compare(results, baseline, tolerance):
+    previous = {case_key(result): result for result in baseline["results"]}
+    regressions = []
+
+    for result in results:
+        old = previous.get(case_key(result))
+        if old is None:
+            continue
+
+        for metric, higher_is_better in COMPARED:
+            if result[metric] is None or old[metric] is None or old[metric] == 0:
+                continue
+
+            change = result[metric] / old[metric] - 1
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append("{} {}: {:.3f} -> {:.3f} ({:+.1%})".format(
+                    "/".join(str(part) for part in case_key(result)), metric, old[metric], result[metric], change))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--mode", help="Run the transfers in-process or with client_app.py and server_app.py",
+                        choices=["inprocess", "apps"], default="inprocess")
+    parser.add_argument("-w", "--windows", help="Comma separated window sizes", type=parse_list(int), default=[100])
+    parser.add_argument("-t", "--timeouts", help="Comma separated initial timeouts in milliseconds",
+                        type=parse_list(int), default=[100])
+    parser.add_argument("-s", "--sizes", help="Comma separated file sizes, like 64K,10M", type=parse_list(parse_size),
+                        default=[1 << 20])
+    parser.add_argument("-p", "--profiles", help="Comma separated impairment profiles: " + ", ".join(PROFILES),
+                        type=parse_list(str), default=["ideal"])
+    parser.add_argument("-d", "--data", help="Comma separated kinds of data: " + ", ".join(DATA), type=parse_list(str),
+                        default=["random"])
+    parser.add_argument("-z", "--compression", help="Comma separated compression methods with optional level, like "
+                        "zlib:1, or none", type=parse_list(lambda word: None if word == "none" else word),
+                        default=[None])
+    parser.add_argument("-r", "--repeat", help="Number of transfers per combination", type=int, default=3)
+    parser.add_argument("--seed", help="Seed of the emulated impairments", type=int, default=1)
+    parser.add_argument("-o", "--output", help="Write the results to this JSON file instead of standard output")
+    parser.add_argument("-b", "--baseline", help="JSON output of an earlier run to compare with")
+    parser.add_argument("--tolerance", help="Allowed relative regression against the baseline", type=float,
+                        default=0.1)
+    args = parser.parse_args()
+
+    for profile in args.profiles:
+        if profile not in PROFILES:
+            parser.error("unknown profile: {}".format(profile))
+    for data in args.data:
+        if data not in DATA:
+            parser.error("unknown kind of data: {}".format(data))
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory, \
+            multiprocessing.get_context("spawn").Pool(1, maxtasksperchild=1) as pool:
+        input_path = os.path.join(directory, "input.file")
+        output_path = os.path.join(directory, "output.file")
+
+        for size, data in itertools.product(args.sizes, args.data):
+            with open(input_path, "wb") as file:
+                file.write(generate(data, size))
+
+            for window, timeout, profile, compression in itertools.product(args.windows, args.timeouts, args.profiles,
+                                                                           args.compression):
+                result = run_case(pool, args.mode, input_path, output_path, size, data, compression, window, timeout,
+                                  profile, args.seed, args.repeat)
+                results.append(result)
+                print("{mode} {profile} w={window} t={timeout} size={size} {data} {compression}: {seconds:.3f} s, "
+                      "{goodput_mbps:.1f} Mbit/s".format(**result), file=sys.stderr)
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "seed": args.seed,
+        "results": results,
+    }
+
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+
+        for regression in regressions:
+            print("regression:", regression, file=sys.stderr)
+
+        if len(regressions) > 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+# Onno de Gouw
+# Stefan Popa
+
+# asyncio versions of the bTCP sockets. Instead of a lossy layer thread per socket, every socket is a datagram
+# endpoint on the event loop and its retransmission timer is scheduled with loop.call_later, so one thread can run
+# hundreds of transfers. The protocol logic is inherited from BTCPClientSocket and BTCPServerSocket: incoming
+# segments are processed by exactly the same code, so both implementations speak the same wire format. Only the
+# methods that have to wait are replaced by coroutines.
+
+import asyncio
+import random
+
+from btcp.client_socket import BTCPClientSocket
+from btcp.server_socket import BTCPServerConnection, BTCPServerSocket
+from btcp.constants import *
+
+
+# Hands every datagram that arrives at an endpoint to the socket that owns it
+class _BTCPProtocol(asyncio.DatagramProtocol):
+    def __init__(self, bTCP_sock):
+        self._bTCP_sock = bTCP_sock
+
+    def datagram_received(self, data, addr):
+        self._bTCP_sock.lossy_layer_input(data, addr)
+
+
+# Takes the place of the lossy layer: puts segments into the network through an asyncio datagram transport
+class _TransportLayer:
+    def __init__(self, transport=None, address=None):
+        self.transport = transport
+        self.address = address
+
+    def send_segment(self, segment):
+        self.send_segments([segment])
+
+    def send_segments(self, segments):
+        for segment in segments:
+            if isinstance(segment, list):
+                segment = b"".join(segment)
+
+            self.transport.sendto(segment, self.address)
+
+    # The transport belongs to the socket that created it, which closes it
+    def destroy(self):
+        pass
+
+
+# Takes the place of RetransmissionTimer: calls callback from the event loop once it expires (times in ms)
+class _LoopTimer:
+    def __init__(self, callback):
+        self._callback = callback
+        self._handle = None
+
+    def start(self, timeout):
+        self.stop()
+        self._handle = asyncio.get_running_loop().call_later(timeout / 1000, self._expire)
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    @property
+    def running(self):
+        return self._handle is not None
+
+    def destroy(self):
+        self.stop()
+
+    def _expire(self):
+        self._handle = None
+        self._callback()
+
+
+# Wait until predicate holds, waking up whenever event is set. Returns False if that did not happen within timeout
+# seconds (None waits forever).
+async def _wait_for(event, predicate, timeout=None):
+    async def wait():
+        while not predicate():
+            event.clear()
+            await event.wait()
+
+    try:
+        await asyncio.wait_for(wait(), timeout)
+    except asyncio.TimeoutError:
+        return False
+
+    return True
+
+
+# The coroutines of the sending half (see BTCPSender), for the client and the connections of the server
+class _AsyncSender:
+    # Send data originating from the application in a reliable way to the other side (see BTCPSender.send)
+    async def send(self, data, wait=True):
+        data = memoryview(data).cast("B")
+
+        for buffer in self._buffers(data):
+            index = 0
+            end = False
+
+            while not end:
+                with self._cond:
+                    index, end, sent = self._fill_window(buffer, index, end)
+
+                # The window is full: wait until an ACK arrives
+                if not sent:
+                    self._changed.clear()
+                    await self._changed.wait()
+
+        if wait:
+            await self.flush()
+
+    # Wait until everything that has been sent is acknowledged
+    async def flush(self):
+        await _wait_for(self._changed, lambda: len(self._buffer_packets) == 0)
+
+    # The persist timer can open a closed window, which send waits for
+    def _on_timeout(self):
+        super()._on_timeout()
+        self._changed.set()
+
+
+# The coroutines of the receiving half (see BTCPReceiver), for the client and the connections of the server
+class _AsyncReceiver:
+    # Wait until data is available or the other side has closed the connection
+    async def _wait_readable_async(self, timeout):
+        if not await _wait_for(self._changed, lambda: len(self._recv_queue) > 0 or self._finished, timeout):
+            raise TimeoutError("no bTCP data received")
+
+    # Return at most max_bytes of in-order data, or b"" once the connection has been closed and all data was
+    # read (see BTCPReceiver.recv)
+    async def recv(self, max_bytes=None, timeout=None):
+        await self._wait_readable_async(timeout)
+
+        return super().recv(max_bytes)
+
+    # Like recv, but copy the data into buffer and return the number of bytes written
+    async def recv_into(self, buffer, nbytes=0, timeout=None):
+        await self._wait_readable_async(timeout)
+
+        return super().recv_into(buffer, nbytes)
+
+
+# bTCP client socket for asyncio
+# An application makes use of it by awaiting connect, send, recv and disconnect, and calling close
+class AsyncBTCPClientSocket(_AsyncSender, _AsyncReceiver, BTCPClientSocket):
+    def __init__(self, window, timeout, address=(SERVER_IP, SERVER_PORT), local_address=(CLIENT_IP, CLIENT_PORT),
+                 congestion_control="reno", mss=PAYLOAD_SIZE, trace=None, profile=False, fec=None, compression=None,
+                 resume=None, ack_every=ACK_EVERY, ack_delay=ACK_DELAY, buffer_size=RECV_BUFFER_SIZE):
+        # Set whenever an incoming segment has been processed
+        self._changed = asyncio.Event()
+        self._transport = None
+        super().__init__(window, timeout, address, local_address, congestion_control, mss, trace=trace,
+                         profile=profile, fec=fec, compression=compression, resume=resume, ack_every=ack_every,
+                         ack_delay=ack_delay, buffer_size=buffer_size)
+
+    def _create_timer(self, callback):
+        return _LoopTimer(callback)
+
+    def _create_lossy_layer(self):
+        return _TransportLayer()
+
+    def lossy_layer_input(self, segment, address):
+        super().lossy_layer_input(segment, address)
+        self._changed.set()
+
+    # Perform a three-way handshake to establish a connection. Returns 1 on success and 0 on failure, like
+    # BTCPClientSocket.connect.
+    async def connect(self):
+        loop = asyncio.get_running_loop()
+        self._transport, _ = await loop.create_datagram_endpoint(lambda: _BTCPProtocol(self),
+                                                                 local_addr=self._local_address,
+                                                                 remote_addr=self._address)
+        self._lossy_layer.transport = self._transport
+
+        self._seq_num = random.getrandbits(16)
+        self._ack_num = self._seq_num
+        segment_packet = self._build_syn()
+
+        for tries in range(self._tries):
+            startTime = self._now()
+            self._lossy_layer.send_segment(segment_packet)
+            self.stats.segments_sent += 1
+
+            # Wait until the SYN+ACK arrives or the timeout expires
+            if await _wait_for(self._changed, lambda: self._connected, self._rto.rto / 1000):
+                # The SYN gives the first RTT sample, unless it had to be retransmitted, for both halves
+                if tries == 0:
+                    self._recv_rtt = self._now() - startTime
+                    self._rto.sample(self._recv_rtt)
+
+                self._lossy_layer.send_segment(self._build_control(ACK))
+                self.stats.segments_sent += 1
+                self._ack_num = self._seq_num
+                return 1
+
+            self._rto.backoff()
+
+        return 0
+
+    # Perform a handshake to terminate a connection
+    async def disconnect(self):
+        await self.flush()
+        with self._cond:
+            segment_packet = self._build_control(FIN)
+
+        for _ in range(self._tries):
+            self._lossy_layer.send_segment(segment_packet)
+            self.stats.segments_sent += 1
+
+            # Wait until the FIN+ACK arrives or the timeout expires
+            if await _wait_for(self._changed, lambda: not self._connected, self._rto.rto / 1000):
+                break
+
+            self._rto.backoff()
+
+    # Clean up any state
+    def close(self):
+        self._timer.destroy()
+        self._ack_timer.destroy()
+        if self._transport is not None:
+            self._transport.close()
+
+
+# A connection accepted by AsyncBTCPServerSocket
+class AsyncBTCPConnection(_AsyncSender, _AsyncReceiver, BTCPServerConnection):
+    def __init__(self, listener, lossy_layer, address, window, timeout, ack_every=ACK_EVERY, ack_delay=ACK_DELAY,
+                 mss=MAX_PAYLOAD_SIZE, tracer=None, profile=False, accept_fec=True, accept_compression=True,
+                 resume=None, congestion_control="reno", buffer_size=RECV_BUFFER_SIZE):
+        # Set whenever an incoming segment has been processed
+        self._changed = asyncio.Event()
+        super().__init__(listener, lossy_layer, address, window, timeout, ack_every, ack_delay, mss, tracer, profile,
+                         accept_fec, accept_compression, resume, congestion_control, buffer_size)
+
+    def _create_timer(self, callback):
+        return _LoopTimer(callback)
+
+    def lossy_layer_input(self, segment, address):
+        super().lossy_layer_input(segment, address)
+        self._changed.set()
+
+
+# bTCP server socket for asyncio
+# Like BTCPServerSocket, it demultiplexes the segments of all clients by their address into connections.
+# An application makes use of it by awaiting listen and accept, and calling close.
+class AsyncBTCPServerSocket(BTCPServerSocket):
+    def __init__(self, window, timeout, address=(SERVER_IP, SERVER_PORT), ack_every=ACK_EVERY, ack_delay=ACK_DELAY,
+                 mss=MAX_PAYLOAD_SIZE, trace=None, profile=False, accept_fec=True, accept_compression=True,
+                 resume=None, congestion_control="reno", buffer_size=RECV_BUFFER_SIZE):
+        # Set whenever a new connection is requested
+        self._changed = asyncio.Event()
+        super().__init__(window, timeout, address, ack_every, ack_delay, mss, trace=trace, profile=profile,
+                         accept_fec=accept_fec, accept_compression=accept_compression, resume=resume,
+                         congestion_control=congestion_control, buffer_size=buffer_size)
+
+    def _create_lossy_layer(self):
+        return _TransportLayer()
+
+    def _create_connection(self, address):
+        return AsyncBTCPConnection(self, _TransportLayer(self._lossy_layer.transport, address), address,
+                                   self._window_a, self._timeout, self._ack_every, self._ack_delay, self._mss,
+                                   self._tracer, self._profile, self._accept_fec, self._accept_compression,
+                                   self._resume, self._congestion_control, self._buffer_size)
+
+    # Start receiving connection requests. Returns the address actually bound, which tells the port that was picked
+    # when port 0 was given.
+    async def listen(self):
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(lambda: _BTCPProtocol(self), local_addr=self._address)
+        self._lossy_layer.transport = transport
+
+        return transport.get_extra_info("sockname")
+
+    def lossy_layer_input(self, segment, address):
+        super().lossy_layer_input(segment, address)
+        self._changed.set()
+
+    # Wait for a client to initiate a three-way handshake and return its connection. Raises TimeoutError if no
+    # client connected within timeout seconds (None waits forever).
+    async def accept(self, timeout=None):
+        if not await _wait_for(self._changed, lambda: len(self._accept_queue) > 0, timeout):
+            raise TimeoutError("no bTCP connection request received")
+
+        return super().accept()
+
+    # Clean up any state
+    def close(self):
+        if self._lossy_layer.transport is not None:
+            self._lossy_layer.transport.close()
@@ -1,34 +1,62 @@
 # Onno de Gouw
 # Stefan Popa
 
+from btcp import checksum, codec
+from btcp.stats import ConnectionStats, StageProfile
+from btcp.constants import *
+
+
+# Base class of the bTCP sockets, with the segment format they share
 class BTCPSocket:
     def __init__(self, window, timeout):
         self._window_a = window
         self._timeout = timeout
         self._tries = 10
-   
+
+    # Set up the instrumentation of a connection: the counters in stats, which are always kept, the tracer (a
+    # stats.Tracer or None) that receives its events, and when profile is true the timing of the hot-path stages in
+    # self.profile. Must be called once the lossy layer exists, whose send_segments is timed as the send stage.
+    def _instrument(self, name, tracer, profile):
+        self.stats = ConnectionStats()
+        self._trace_name = name
+        self._tracer = tracer
+        self.profile = None
+
+        if profile:
+            self.profile = StageProfile()
+            self.build_segment = self.profile.wrap("build", self.build_segment)
+            self.build_segment_parts = self.profile.wrap("build", self.build_segment_parts)
+            self.check_cksum = self.profile.wrap("checksum", self.check_cksum)
+            self._handle_segment = self.profile.wrap("dispatch", self._handle_segment)
+            self._lossy_layer.send_segments = self.profile.wrap("send", self._lossy_layer.send_segments)
+
+    # Write an event to the trace. Callers check self._tracer first, so that the arguments are not even built while
+    # tracing is off.
+    def _trace(self, name, **data):
+        self._tracer.event(self._trace_name, name, **data)
+
     # Return the Internet checksum of data
     @staticmethod
     def in_cksum(data):
-        # If the length of data is not a multiple of 16-bit words, then pad with one byte of zeros.
+        return checksum.in_cksum(data)
 
-        data = bytearray(data)
-        cksum = 0
-        countTo = (len(data) // 2) * 2
+    # A method the checks if the received segment has the correct checksum
+    def check_cksum(self, segment):
+        return checksum.is_valid(segment)
 
-        for count in range(0, countTo, 2):
-            value = data[count + 1] * 256 + data[count]
-            cksum = cksum + value
-            cksum = cksum & 0xffffffff
+    # A method that builds the header for a segment
+    def build_header(self, seq_num, ack_num, flags, window, data_length, data):
+        return codec.encode_header(seq_num, ack_num, flags, window, data_length, data)
 
-        if countTo < len(data):
-            cksum = cksum + data[-1]
-            cksum = cksum & 0xffffffff
+    # A method that builds a bTCP segment
+    def build_segment(self, seq_num, ack_num, flags, window, data_length, data):
+        return codec.encode(seq_num, ack_num, flags, window, data_length, data)
 
-        cksum = (cksum >> 16) + (cksum & 0xffff)
-        cksum = cksum + (cksum >> 16)
-        checksum = ~cksum
-        checksum = checksum & 0xffff
-        checksum = checksum >> 8 | (checksum << 8 & 0xff00)
+    # A method that builds a bTCP segment as a list of buffers, header and data. The lossy layer sends the list as
+    # one datagram with a gathering write, so the data (a memoryview into the application's buffer) is never copied.
+    def build_segment_parts(self, seq_num, ack_num, flags, window, data_length, data):
+        return [codec.encode_header(seq_num, ack_num, flags, window, data_length, data), data]
 
-        return checksum
\ No newline at end of file
+    # A method that unpacks the received segment into a Segment, whose data is a memoryview on the datagram
+    def unpack_segment(self, datagram):
+        return codec.decode(datagram)
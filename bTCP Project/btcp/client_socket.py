@@ -1,208 +1,238 @@
 # Onno de Gouw
 # Stefan Popa
 
-import struct
 import random
-import time
+import threading
 
 from socket import *
+from btcp import codec
 from btcp.btcp_socket import BTCPSocket
+from btcp.sender import BTCPSender
+from btcp.receiver import BTCPReceiver
 from btcp.lossy_layer import LossyLayer
+from btcp.impairment import ImpairedLayer
+from btcp.timer import RetransmissionTimer
+from btcp.fec import Redundancy
+from btcp.compression import FrameEncoder, compression_option, parse_compression
+from btcp.resume import parse_held_option
+from btcp.stats import Tracer, finite
 from btcp.constants import *
 
 
 # bTCP client socket
-# A client application makes use of the services provided by bTCP by calling connect, send, disconnect, and close
-class BTCPClientSocket(BTCPSocket):
-    def __init__(self, window, timeout):
+# A client application makes use of the services provided by bTCP by calling connect, send (and recv, recv_into or
+# recv_to_file for the data of the server, which end once the server shuts its side down), disconnect, and close
+# The client connects to the server at address from local_address (an ephemeral port by default). Its counters are in
+# stats and info returns them together with the current state of the connection. Given a file as trace, it writes
+# every event of the connection to it as JSON lines; with profile set it times the stages of the hot path in profile.
+# fec asks the server for forward error correction (see btcp.fec): the number of data segments per parity segment,
+# or "auto" to adapt it to the loss rate. None sends no parity segments. compression asks the server for compression
+# of the data (see btcp.compression), described like "zlib", "zlib:9" or "lzma:1". Both only apply to the data the
+# client sends. resume offers the ChunkIndex of the file to send (see btcp.resume); resume_held then holds the chunks
+# the server already has, or None if it does not resume transfers. ack_every and ack_delay set the delayed ACK policy
+# for the data of the server, and buffer_size the memory budget (in bytes) its receive window autotunes up to, from
+# window segments on.
+class BTCPClientSocket(BTCPSender, BTCPReceiver, BTCPSocket):
+    def __init__(self, window, timeout, address=(SERVER_IP, SERVER_PORT), local_address=(CLIENT_IP, CLIENT_PORT),
+                 congestion_control="reno", mss=PAYLOAD_SIZE, impairment=None, trace=None, profile=False, fec=None,
+                 compression=None, resume=None, ack_every=ACK_EVERY, ack_delay=ACK_DELAY,
+                 buffer_size=RECV_BUFFER_SIZE):
         super().__init__(window, timeout)
-        self._lossy_layer = LossyLayer(self, CLIENT_IP, CLIENT_PORT, SERVER_IP, SERVER_PORT)
+        self._address = address
+        self._local_address = local_address
+        # Network impairments to emulate on the segments sent (see btcp.impairment), or None
+        self._impairment = impairment
         self._connected = False
-        self._window_b = 0
-        self._buffer_packets = []
-        self._seq_num = 0
-        self._ack_num = 0
-        self._startTime = 0
-        self._counter_packet = 0
-        self._counter_ack = 1
-
-    # A method the checks if the received segment has the correct checksum
-    def check_cksum(self, segment):
-        if self.in_cksum(segment) == 0:
-            return True
-
-        return False
-
-    # A method that builds the header for a segment
-    def build_header(self, seq_num, ack_num, flags, window, data_length, data):
-        header = struct.pack("HHBBhH",
-                             seq_num,
-                             ack_num,
-                             flags,
-                             window,
-                             data_length,
-                             0)
-
-        myChecksum = self.in_cksum(header + data)
-        myChecksum = htons(myChecksum) & 0xffff
-
-        header = struct.pack("HHBBhH",
-                             seq_num,
-                             ack_num,
-                             flags,
-                             window,
-                             data_length,
-                             myChecksum)
-
-        return header
-
-    # A method that builds a bTCP segment
-    def build_segment(self, seq_num, ack_num, flags, window, data_length, data):
-        header = self.build_header(seq_num, ack_num, flags, window, data_length, data)
-        segment = header + data
-
-        return segment
-
-    # A method that unpacks the received segment
-    def unpack_segment(self, segment):
-        header = segment[:HEADER_SIZE]
-        data = segment[HEADER_SIZE:]
-
-        seq_num, ack_num, flags, window, data_length, checksum = struct.unpack("HHBBhH", header)
-
-        return seq_num, ack_num, flags, window, data_length, checksum, header, data
+        # Maximum segment size: the payload size proposed in the SYN, lowered to the one the server accepts
+        self._mss = mss
+        self._init_sender(timeout, congestion_control)
+        self._init_receiver(ack_every, ack_delay, buffer_size)
+        # Forward error correction and compression as requested (the number of data segments per parity segment, and
+        # the method and level of compression), which the sending half uses once the server has accepted them
+        self._fec = fec
+        self._compression = parse_compression(compression) if compression is not None else None
+        # The chunk index offered to the server, and the chunks it holds once it has agreed to resume
+        self._resume = resume
+        self.resume_held = None
+        # Guards the state above; signalled whenever lossy_layer_input changes it
+        self._cond = threading.Condition()
+        self._lossy_layer = self._create_lossy_layer()
+        self._instrument("{}:{}".format(*address), Tracer(trace) if trace is not None else None, profile)
+
+    # Create a timer that calls callback (the retransmission timer and the delayed ACK timer) and the lossy layer. The
+    # asyncio socket overrides these to run them on an event loop instead of in threads of their own.
+    def _create_timer(self, callback):
+        return RetransmissionTimer(callback)
+
+    def _create_lossy_layer(self):
+        if self._impairment is not None:
+            return ImpairedLayer(self, self._local_address[0], self._local_address[1], self._address[0],
+                                 self._address[1], self._impairment)
+
+        return LossyLayer(self, self._local_address[0], self._local_address[1], self._address[0], self._address[1])
 
     # Called by the lossy layer from another thread whenever a segment arrives.
     def lossy_layer_input(self, segment, address):
+        with self._cond:
+            self._handle_segment(segment, address)
 
-        # Timeout: Resend the oldest unacknowledged packet and restart timer
-        if (self._startTime + self._timeout - int(round(time.time() * 1000))) > 0 and self._counter_packet < self._window_b\
-                and len(self._buffer_packets) > 0:
-            self._startTime = int(round(time.time() * 1000))
-            self._lossy_layer.send_segment(self._buffer_packets[0])
-            self._counter_packet += 1
+            # Wake up connect, send, recv or disconnect, which sleep until the state they wait for has changed
+            self._cond.notify_all()
+
+    # Process an incoming segment. The caller must hold self._cond.
+    def _handle_segment(self, segment, address):
+
+        self.stats.segments_received += 1
 
-        # ACK received: Update the unacknowledged packet list and start the timer, if needed
-        # Fast Retransmit: If three duplicate ACKs are received, resend the packet that was lost
         if self.check_cksum(segment):
-            _, ack_num, flags, temp_window_b, _, _, inp_header, inp_data = self.unpack_segment(segment)
+            inp_segment = self.unpack_segment(segment)
+            flags, temp_window_b = inp_segment.flags, inp_segment.window
+
+            # Restore the full ACK number around the oldest unacknowledged sequence number
+            ack_num = codec.unwrap(inp_segment.ack_num, self._ack_num)
+            if self._tracer is not None:
+                self._trace("packet_received", flags=flags, ack_num=ack_num, window=temp_window_b,
+                            length=inp_segment.data_length)
 
             # The second step of the three-way handshake, when the server send a SYN+ACK segment and the client
-            # receives it
+            # receives it. Its sequence number is the initial one of the server.
             if flags == SYNACK:
                 if ack_num == self._seq_num + 1:
                     self._connected = True
                     self._seq_num += 1
+                    self._recv_seq = inp_segment.seq_num + 1
                     self._window_b = temp_window_b
+                    self._mss = min(self._mss, codec.mss_option(inp_segment))
+                    options = codec.decode_options(inp_segment)
+                    if self._fec is not None and OPTION_FEC in options:
+                        self._redundancy = Redundancy(FEC_BLOCK, True) if self._fec == "auto" else Redundancy(self._fec)
+                        self._fec_seq = self._seq_num
+                    if self._compression is not None and OPTION_COMPRESSION in options:
+                        self._encoder = FrameEncoder(*self._compression)
+                    if self._resume is not None and OPTION_RESUME in options:
+                        self.resume_held = parse_held_option(options[OPTION_RESUME], len(self._resume.hashes))
 
             # The second step of the connection termination handshake, when the server send a FIN+ACK segment and the
-            # client receives it
-            if flags == FINACK:
+            # client receives it. recv returns b"" once the data of the server has been read.
+            elif flags == FINACK:
                 self._connected = False
-
-            if flags == ACK:
-                if ack_num > self._ack_num:
-                    self._counter_ack = 1
-                    from_index = self._ack_num
-                    self._ack_num = ack_num
-                    self._counter_packet = self._window_b - temp_window_b
-
-                    for i in range(from_index, self._ack_num):
-                        if len(self._buffer_packets) > 0:
-                            self._buffer_packets.pop(0)
-
-                    if len(self._buffer_packets) != 0:
-                        self._startTime = int(round(time.time() * 1000))
-                    else:
-                        self._startTime = 0
-                else:
-                    if self._ack_num == ack_num:
-                        self._counter_ack += 1
-
-                        if self._counter_ack >= 3 and self._counter_packet < self._window_b\
-                                and len(self._buffer_packets) > 0:
-                            self._lossy_layer.send_segment(self._buffer_packets[0])
-                            self._counter_packet += 1
+                self._finished = True
+
+            # The server has ended the data it sends: recv returns b"" once all of it has been read. The FIN is answered
+            # like the server answers the FIN of the client, and acknowledges the data of the client as well.
+            elif flags == FIN:
+                self._on_ack(ack_num, temp_window_b)
+                if codec.unwrap(inp_segment.seq_num, self._recv_seq) == self._recv_seq:
+                    self._finished = True
+                    segment_packet = self.build_segment(self._seq_num, self._recv_seq + 1, FINACK, self._advertise(),
+                                                        0, b"")
+                    self._lossy_layer.send_segment(segment_packet)
+                    self.stats.segments_sent += 1
+                    self._unacked = 0
+                    self._ack_timer.stop()
+
+            # An ACK, with the SACK blocks as its data
+            elif flags == ACK:
+                self._on_ack(ack_num, temp_window_b, inp_segment.data[:inp_segment.data_length])
+
+            # Data of the server, which acknowledges the data of the client as well
+            elif flags == 0:
+                self._on_ack(ack_num, temp_window_b)
+                self._receive_data(codec.unwrap(inp_segment.seq_num, self._recv_seq), inp_segment.data)
+        else:
+            self.stats.checksum_failures += 1
+            if self._tracer is not None:
+                self._trace("checksum_failure", length=len(segment))
 
         self._src_address = address
 
+    # Build the SYN, which proposes the maximum segment size and asks for forward error correction, compression and
+    # resuming if requested
+    def _build_syn(self):
+        options = {}
+        if self._fec is not None:
+            options[OPTION_FEC] = b""
+        if self._compression is not None:
+            options[OPTION_COMPRESSION] = compression_option(*self._compression)
+        if self._resume is not None:
+            options[OPTION_RESUME] = self._resume.option()
+        option = codec.encode_options(self._mss, options)
+
+        return self.build_segment(self._seq_num, 0, SYN, self._free_window(), len(option), option)
+
+    # Build the segment without data that carries flags (the ACK of the handshake or the FIN). It acknowledges the
+    # data of the server like any other segment.
+    def _build_control(self, flags):
+        ack_num, window = self._piggyback()
+
+        return self.build_segment(self._seq_num, ack_num, flags, window, 0, b"")
+
     # Perform a three-way handshake to establish a connection
     def connect(self):
         self._seq_num = random.getrandbits(16)
-        segment_packet = self.build_segment(self._seq_num, 0, SYN, self._window_a, 0, struct.pack("d", 0))
-        triesCounter = 0
-        recv = False
+        self._ack_num = self._seq_num
+        segment_packet = self._build_syn()
 
-        while triesCounter < self._tries:
-            startTime = int(round(time.time() * 1000))
-            self._lossy_layer.send_segment(segment_packet)
+        with self._cond:
+            for tries in range(self._tries):
+                startTime = self._now()
+                self._lossy_layer.send_segment(segment_packet)
+                self.stats.segments_sent += 1
 
-            while (startTime + self._timeout - int(round(time.time() * 1000))) > 0:
-                if self._connected:
-                    segment_packet = self.build_header(0, 0, ACK, self._window_a, 0, struct.pack("d", 0))
+                # Sleep until the SYN+ACK arrives or the timeout expires
+                if self._cond.wait_for(lambda: self._connected, self._rto.rto / 1000):
+                    # The SYN gives the first RTT sample, unless it had to be retransmitted, for both halves
+                    if tries == 0:
+                        self._recv_rtt = self._now() - startTime
+                        self._rto.sample(self._recv_rtt)
 
-                    self._lossy_layer.send_segment(segment_packet)
+                    self._lossy_layer.send_segment(self._build_control(ACK))
+                    self.stats.segments_sent += 1
                     self._ack_num = self._seq_num
-                    recv = True
-                    break
+                    return 1
 
-            if not recv:
-                triesCounter += 1
-            else:
-                return 1
+                self._rto.backoff()
 
         return 0
 
-    # Send data originating from the application in a reliable way to the server
-    def send(self, data):
-        index = 0
-        end = False
-
-        while True:
-            # This takes care of the last block of data which may be shorter than PAYLOAD_SIZE
-            # and the case when the data is shorter the the PAYLOAD_SIZE
-            if self._counter_packet < self._window_b and not end:
-                if index + PAYLOAD_SIZE >= len(data):
-                    data_packet = data[index:len(data)]
-                    end = True
-                else:
-                    data_packet = data[index:index + PAYLOAD_SIZE]
-                    index += PAYLOAD_SIZE
-
-                segment_packet = self.build_segment(self._seq_num, 0, 0, self._window_a, 0, data_packet)
-                self._buffer_packets.append(segment_packet)
-
-                # Normal: Send a segment and start timer (if not started yet)
-                if self._startTime == 0:
-                    self._startTime = int(round(time.time() * 1000))
-
-                self._lossy_layer.send_segment(segment_packet)
-                self._counter_packet += 1
-                self._seq_num += 1
-
-            if end and len(self._buffer_packets) == 0:
-                break
+    # Return the counters of the connection together with its current state, like TCP_INFO: the round-trip time
+    # estimates and retransmission timeout (in ms), the congestion window and slow start threshold, the window
+    # advertised by the server and the segments in flight (in segments) and the maximum segment size (in bytes). With
+    # compression, the bytes given to send and the bytes their frames took. For the data of the server, the free
+    # receive window and the segments waiting to be read and in the reorder buffer (in segments), the bytes waiting to
+    # be read and the current memory budget, and the round-trip time of the handshake that autotuning starts from.
+    def info(self):
+        with self._cond:
+            info = self.stats.as_dict()
+            info.update(srtt=self._rto.srtt, rttvar=self._rto.rttvar, rto=self._rto.rto, cwnd=finite(self._cc.cwnd),
+                        ssthresh=finite(self._cc.ssthresh), window=self._window_b, in_flight=len(self._buffer_packets),
+                        mss=self._mss, receive_window=self._free_window(), buffered=len(self._recv_queue),
+                        buffered_bytes=self._recv_bytes, buffer_size=self._budget(),
+                        reorder_buffer=len(self._out_of_order), receive_rtt=self._recv_rtt)
+            if self._encoder is not None:
+                info.update(uncompressed_bytes=self._encoder.bytes_in, compressed_bytes=self._encoder.bytes_out)
+
+        return info
 
     # Perform a handshake to terminate a connection
     def disconnect(self):
-        segment_packet = self.build_segment(self._seq_num, 0, FIN, self._window_a, 0, struct.pack("d", 0))
-        triesCounter = 0
-        recv = False
+        self.flush()
 
-        while triesCounter < self._tries:
-            startTime = int(round(time.time() * 1000))
-            self._lossy_layer.send_segment(segment_packet)
+        with self._cond:
+            segment_packet = self._build_control(FIN)
+
+            for _ in range(self._tries):
+                self._lossy_layer.send_segment(segment_packet)
+                self.stats.segments_sent += 1
 
-            while (startTime + self._timeout - int(round(time.time() * 1000))) > 0:
-                if not self._connected:
-                    recv = True
+                # Sleep until the FIN+ACK arrives or the timeout expires
+                if self._cond.wait_for(lambda: not self._connected, self._rto.rto / 1000):
                     break
 
-            if not recv:
-                triesCounter += 1
-            else:
-                break
+                self._rto.backoff()
 
     # Clean up any state
     def close(self):
+        self._timer.destroy()
+        self._ack_timer.destroy()
         self._lossy_layer.destroy()
@@ -0,0 +1,117 @@
+# Onno de Gouw
+# Stefan Popa
+
+import struct
+
+from socket import htons
+from btcp import checksum
+from btcp.constants import *
+
+
+# The segment codec shared by all bTCP sockets. The formats are compiled once, headers are packed straight into
+# the buffer that is sent and received segments are parsed in place, without copying the payload.
+
+# seq_num, ack_num, flags, window, data_length, checksum
+HEADER = struct.Struct("HHBBhH")
+# The checksum field, the last field of the header
+CHECKSUM = struct.Struct("H")
+CHECKSUM_OFFSET = HEADER_SIZE - CHECKSUM.size
+# The data of a SYN and a SYN+ACK: the maximum segment size, the largest payload the sender proposes or accepts,
+# followed by options, each a kind and the length of its value, then the value
+MSS_OPTION = struct.Struct("H")
+OPTION = struct.Struct("BH")
+# A selective acknowledgement block in the data of an ACK: start and end (exclusive) sequence number, wrapped like
+# the sequence numbers in the header
+SACK_BLOCK = struct.Struct("HH")
+# The start of the data of a parity segment: the number of data segments it covers and the XOR of their lengths
+PARITY_HEADER = struct.Struct("BH")
+
+
+# Sequence numbers are unbounded integers inside the sockets, so transfers of any length never wrap there. On the
+# wire only the low 16 bits are sent; the receiver restores the full number with serial number arithmetic
+# (RFC 1982): it is the one closest to a reference number it expects, like the next sequence number or the oldest
+# unacknowledged one. Windows are far smaller than half the sequence space, so this is never ambiguous.
+def wrap(seq_num):
+    return seq_num % SEQ_SPACE
+
+
+def unwrap(seq_num, reference):
+    return reference + (seq_num - reference + SEQ_SPACE // 2) % SEQ_SPACE - SEQ_SPACE // 2
+
+
+# A received segment. It is a view on the datagram: data refers to the payload through a memoryview, so parsing
+# never copies it.
+class Segment:
+    __slots__ = ("seq_num", "ack_num", "flags", "window", "data_length", "checksum", "data")
+
+    def __init__(self, datagram):
+        view = memoryview(datagram)
+        self.seq_num, self.ack_num, self.flags, self.window, self.data_length, self.checksum = HEADER.unpack_from(view)
+        self.data = view[HEADER_SIZE:]
+
+
+# Return the data of a SYN or SYN+ACK: the maximum segment size followed by options, a dict of kind to value
+def encode_options(mss, options=None):
+    data = bytearray(MSS_OPTION.pack(mss))
+    for kind, value in (options or {}).items():
+        data += OPTION.pack(kind, len(value)) + value
+
+    return bytes(data)
+
+
+# Return the maximum segment size carried by a received SYN or SYN+ACK. A peer that does not negotiate sends
+# padding without a data length, and uses PAYLOAD_SIZE.
+def mss_option(inp_segment):
+    if inp_segment.data_length < MSS_OPTION.size or len(inp_segment.data) < MSS_OPTION.size:
+        return PAYLOAD_SIZE
+
+    return MSS_OPTION.unpack_from(inp_segment.data)[0]
+
+
+# Return the options that follow the maximum segment size in a received SYN or SYN+ACK, as a dict of kind to value.
+# The caller ignores the kinds it does not know.
+def decode_options(inp_segment):
+    data = inp_segment.data[:inp_segment.data_length]
+    options = {}
+    index = MSS_OPTION.size
+
+    while index + OPTION.size <= len(data):
+        kind, length = OPTION.unpack_from(data, index)
+        index += OPTION.size
+        options[kind] = bytes(data[index:index + length])
+        index += length
+
+    return options
+
+
+# Return the value of the checksum field for a header (with a zero checksum field) followed by data whose one's
+# complement sum is data_sum. Two folded sums only need a single end-around carry.
+def _header_checksum(header, data_sum):
+    total = checksum.ones_sum(header) + data_sum
+    total = (total & 0xffff) + (total >> 16)
+
+    return htons(checksum.finish(total)) & 0xffff
+
+
+# Return the header of a segment carrying data. The data is summed where it is, it is neither copied nor joined
+# with the header.
+def encode_header(seq_num, ack_num, flags, window, data_length, data):
+    header = bytearray(HEADER_SIZE)
+    HEADER.pack_into(header, 0, seq_num % SEQ_SPACE, ack_num % SEQ_SPACE, flags, window, data_length, 0)
+    CHECKSUM.pack_into(header, CHECKSUM_OFFSET, _header_checksum(header, checksum.ones_sum(data)))
+
+    return header
+
+
+# Return a complete segment, built in a single buffer and summed in a single pass
+def encode(seq_num, ack_num, flags, window, data_length, data):
+    segment = bytearray(HEADER_SIZE + len(data))
+    HEADER.pack_into(segment, 0, seq_num % SEQ_SPACE, ack_num % SEQ_SPACE, flags, window, data_length, 0)
+    segment[HEADER_SIZE:] = data
+    CHECKSUM.pack_into(segment, CHECKSUM_OFFSET, _header_checksum(segment, 0))
+
+    return segment
+
+
+# Parse a received segment
+decode = Segment
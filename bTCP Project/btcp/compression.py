@@ -0,0 +1,143 @@
+# Onno de Gouw
+# Stefan Popa
+
+import struct
+import zlib
+
+from btcp.constants import *
+
+# lzma is an optional part of the standard library: Python can be built without it
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+
+# Streaming payload compression, negotiated in the handshake. The client cuts the data of every send into chunks of
+# COMPRESSION_CHUNK bytes and sends each as a frame: its length and whether it is compressed, followed by the chunk,
+# compressed on its own or as it is. Memory use is bounded by one chunk on either side, whatever the size of the
+# file. A chunk is only compressed when a fast trial compression of a sample shows that it is worth the CPU time,
+# and when compressing does not make it smaller it is sent as it is, so incompressible data costs almost nothing.
+
+# Length of the frame data and whether it is compressed
+FRAME = struct.Struct("IB")
+
+# Compression methods by name, with their number on the wire
+METHODS = {"zlib": 1, "lzma": 2}
+
+
+# Return the names of the methods this Python supports
+def available():
+    return [name for name in METHODS if name != "lzma" or lzma is not None]
+
+
+# Parse a description like "zlib", "zlib:9" or "lzma:1" into a method and a level (None for the default level)
+def parse_compression(spec):
+    name, _, level = spec.partition(":")
+    if name not in available():
+        raise ValueError("unsupported compression method: {}".format(name))
+
+    level = int(level) if level else None
+    if level is not None and not 0 <= level <= 9:
+        raise ValueError("compression level must be between 0 and 9")
+
+    return name, level
+
+
+# Return the value of the compression option of the SYN for method and level, and the method and level in a
+# received one (None for an unknown method)
+def compression_option(method, level):
+    return bytes([METHODS[method], 255 if level is None else level])
+
+
+def parse_compression_option(value):
+    for name in available():
+        if len(value) == 2 and METHODS[name] == value[0]:
+            return name, None if value[1] == 255 else value[1]
+
+    return None
+
+
+def _compress(method, level, data):
+    if method == "lzma":
+        return lzma.compress(data, preset=level)
+
+    return zlib.compress(data, -1 if level is None else level)
+
+
+def _decompressor(method):
+    if method == "lzma":
+        return lzma.LZMADecompressor()
+
+    return zlib.decompressobj()
+
+
+# Turns the data of the client into frames
+class FrameEncoder:
+    def __init__(self, method, level):
+        self._method = method
+        self._level = level
+        # Statistics: bytes given and bytes put into frames
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    # Return whether a chunk is likely to compress, judged by a fast compression of a sample of it
+    @staticmethod
+    def _compressible(chunk):
+        sample = chunk[:COMPRESSION_SAMPLE]
+
+        return len(zlib.compress(sample, 1)) < len(sample) * COMPRESSION_RATIO
+
+    # Yield the frames of data, one chunk at a time
+    def frames(self, data):
+        for start in range(0, len(data), COMPRESSION_CHUNK):
+            chunk = data[start:start + COMPRESSION_CHUNK]
+            compressed = _compress(self._method, self._level, chunk) if self._compressible(chunk) else None
+
+            if compressed is not None and len(compressed) < len(chunk):
+                frame = FRAME.pack(len(compressed), 1) + compressed
+            else:
+                frame = FRAME.pack(len(chunk), 0) + chunk
+
+            self.bytes_in += len(chunk)
+            self.bytes_out += len(frame)
+            yield frame
+
+
+# Turns the frames received by the server back into the data of the client, as they arrive segment by segment. A
+# compressed frame is decompressed while its segments come in, so it never has to be collected first.
+class FrameDecoder:
+    def __init__(self, method):
+        self._method = method
+        self._header = bytearray()
+        # Bytes of the current frame that have not arrived yet, and its decompressor (None for a frame that is not
+        # compressed)
+        self._remaining = 0
+        self._decompressor = None
+
+    # Return the data decoded from the next received bytes, as a list of bytes-like objects
+    def decode(self, data):
+        data = memoryview(data)
+        decoded = []
+
+        while len(data) > 0:
+            if self._remaining == 0:
+                needed = FRAME.size - len(self._header)
+                self._header += data[:needed]
+                data = data[needed:]
+                if len(self._header) == FRAME.size:
+                    self._remaining, compressed = FRAME.unpack(self._header)
+                    self._header.clear()
+                    self._decompressor = _decompressor(self._method) if compressed else None
+                continue
+
+            part = data[:self._remaining]
+            data = data[len(part):]
+            self._remaining -= len(part)
+
+            # Data that was not compressed is passed on without copying it
+            part = part if self._decompressor is None else self._decompressor.decompress(part)
+            if len(part) > 0:
+                decoded.append(part)
+
+        return decoded
@@ -0,0 +1,121 @@
+# Onno de Gouw
+# Stefan Popa
+
+import time
+
+from btcp.constants import *
+
+
+# Congestion controllers for the client. A controller keeps a congestion window (cwnd, in segments) that limits the
+# segments in flight together with the window advertised by the server. The client reports every new cumulative
+# ACK (on_ack), every loss detected through duplicate ACKs or SACK blocks (on_loss, at most once per window of
+# data) and every retransmission timeout (on_timeout).
+
+
+# No congestion control: only the window advertised by the server limits the sender
+class NoCongestionControl:
+    def __init__(self):
+        self.cwnd = float("inf")
+        self.ssthresh = float("inf")
+
+    # The number of segments that may be in flight
+    @property
+    def window(self):
+        return self.cwnd
+
+    # acked segments were newly acknowledged; rtt is the smoothed round-trip time in ms (None before the first sample)
+    def on_ack(self, acked, rtt):
+        pass
+
+    # A segment was lost while flight segments were outstanding
+    def on_loss(self, flight):
+        pass
+
+    # The retransmission timer expired while flight segments were outstanding
+    def on_timeout(self, flight):
+        pass
+
+
+# Slow start and congestion avoidance with fast recovery (RFC 5681). The client enters fast recovery itself, by
+# retransmitting the lost segments; the controller only halves the window.
+class NewReno(NoCongestionControl):
+    def __init__(self):
+        super().__init__()
+        self.cwnd = INITIAL_CWND
+
+    @property
+    def window(self):
+        return max(int(self.cwnd), 1)
+
+    def on_ack(self, acked, rtt):
+        if self.cwnd < self.ssthresh:
+            # Slow start: grow by one segment per acknowledged segment
+            self.cwnd += acked
+        else:
+            # Congestion avoidance: grow by about one segment per round trip
+            self.cwnd += acked / self.cwnd
+
+    def on_loss(self, flight):
+        self.ssthresh = max(flight / 2, 2)
+        self.cwnd = self.ssthresh
+
+    def on_timeout(self, flight):
+        self.ssthresh = max(flight / 2, 2)
+        self.cwnd = 1
+
+
+# CUBIC (RFC 8312): after a loss, the window grows as a cubic function of the time since that loss, so it quickly
+# returns to the window at which the loss happened and only probes carefully beyond it. In the TCP-friendly region
+# it grows at least as fast as NewReno would.
+class Cubic(NewReno):
+    def __init__(self):
+        super().__init__()
+        self._w_max = 0
+        self._k = 0
+        self._epoch = None
+        self._w_est = 0
+
+    def on_ack(self, acked, rtt):
+        if self.cwnd < self.ssthresh:
+            self.cwnd += acked
+            return
+
+        now = time.monotonic()
+        if self._epoch is None:
+            # First congestion avoidance round after slow start or a loss
+            self._epoch = now
+            self._w_max = max(self._w_max, self.cwnd)
+            self._k = ((self._w_max * (1 - CUBIC_BETA)) / CUBIC_C) ** (1 / 3)
+            self._w_est = self.cwnd
+
+        t = now - self._epoch + (rtt or 0) / 1000
+        target = CUBIC_C * (t - self._k) ** 3 + self._w_max
+
+        # Window NewReno would have reached in the same time (TCP-friendly region)
+        self._w_est += 3 * (1 - CUBIC_BETA) / (1 + CUBIC_BETA) * acked / self.cwnd
+        target = max(target, self._w_est)
+
+        if target > self.cwnd:
+            self.cwnd += (target - self.cwnd) / self.cwnd * acked
+        else:
+            self.cwnd += acked / (100 * self.cwnd)
+
+    def on_loss(self, flight):
+        self._epoch = None
+        self._w_max = self.cwnd
+        self.ssthresh = max(self.cwnd * CUBIC_BETA, 2)
+        self.cwnd = self.ssthresh
+
+    def on_timeout(self, flight):
+        self._epoch = None
+        self._w_max = self.cwnd
+        self.ssthresh = max(self.cwnd * CUBIC_BETA, 2)
+        self.cwnd = 1
+
+
+# Congestion controllers by name, as accepted by BTCPClientSocket and the -c option of client_app.py
+CONGESTION_CONTROLS = {
+    "none": NoCongestionControl,
+    "reno": NewReno,
+    "cubic": Cubic,
+}
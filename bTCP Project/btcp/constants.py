@@ -2,7 +2,8 @@
 # Stefan Popa
 
 CLIENT_IP = 'localhost'
-CLIENT_PORT = 20000
+# Port 0 lets the operating system pick a free (ephemeral) port, so any number of clients can run side by side
+CLIENT_PORT = 0
 SERVER_IP = 'localhost'
 SERVER_PORT = 30000
 SYN = 48
@@ -10,6 +11,66 @@ SYNACK = 60
 ACK = 12
 FIN = 3
 FINACK = 15
+# Flags of a parity segment of forward error correction (see btcp.fec)
+PARITY = 64
+# Sequence and ACK numbers are 16 bits on the wire; the sockets count them without bound (see codec.unwrap)
+SEQ_SPACE = 1 << 16
 HEADER_SIZE = 10
 PAYLOAD_SIZE = 1008
 SEGMENT_SIZE = HEADER_SIZE + PAYLOAD_SIZE
+# The maximum segment size is negotiated in the handshake; PAYLOAD_SIZE is the default. A UDP datagram over IPv4
+# carries at most 65507 bytes, and IP and UDP headers take 28 bytes of the MTU.
+MAX_PAYLOAD_SIZE = 65507 - HEADER_SIZE
+MAX_SEGMENT_SIZE = HEADER_SIZE + MAX_PAYLOAD_SIZE
+IP_UDP_HEADER_SIZE = 28
+# Bounds (in ms) and gains of the retransmission timeout estimator (RFC 6298)
+MIN_RTO = 10
+MAX_RTO = 60000
+RTO_GRANULARITY = 1
+RTO_ALPHA = 1 / 8
+RTO_BETA = 1 / 4
+# Selective acknowledgements: blocks per ACK, and SACKed segments above a hole before it is considered lost
+MAX_SACK_BLOCKS = 4
+DUP_ACK_THRESHOLD = 3
+# Maximum number of buffers passed to a single vectored write
+IOV_MAX = 1024
+# Size of the send and receive buffers of the UDP socket (the kernel may cap it)
+UDP_BUFFER_SIZE = 4 * 1024 * 1024
+# Congestion control: initial congestion window in segments (RFC 6928) and the CUBIC constants (RFC 8312)
+INITIAL_CWND = 10
+CUBIC_C = 0.4
+CUBIC_BETA = 0.7
+# Delayed ACKs: the server acknowledges every ACK_EVERY-th in-order segment, or ACK_DELAY ms after the first
+# unacknowledged one (RFC 5681 allows up to 500 ms, but it must stay well below MIN_RTO)
+ACK_EVERY = 2
+ACK_DELAY = 5
+# Receive buffer: the default memory budget (in bytes) of the data that has been received but not read yet, the
+# largest window the one-byte window field can advertise (in segments), and the shortest interval (in ms) over which
+# the drain rate of the application is measured to autotune the window
+RECV_BUFFER_SIZE = 4 * 1024 * 1024
+MAX_WINDOW = 255
+AUTOTUNE_INTERVAL = 10
+# Kinds of the options that follow the maximum segment size in a SYN and SYN+ACK (see codec.encode_options)
+OPTION_FEC = 1
+OPTION_COMPRESSION = 2
+OPTION_RESUME = 3
+# Forward error correction: data segments per parity segment, initially and within which it adapts to the loss rate,
+# and the gain of the loss rate estimate
+FEC_BLOCK = 8
+FEC_MIN_BLOCK = 2
+FEC_MAX_BLOCK = 32
+FEC_LOSS_GAIN = 1 / 8
+# Compression: bytes per frame, bytes of the sample a chunk is judged by, and the compression ratio the sample must
+# reach for the chunk to be compressed
+COMPRESSION_CHUNK = 256 * 1024
+COMPRESSION_SAMPLE = 16 * 1024
+COMPRESSION_RATIO = 0.9
+# Resumable transfers: the smallest chunk of the file that is hashed and committed on its own, the largest number of
+# chunks a file is cut into (larger files get larger chunks) and the bytes of a chunk hash
+RESUME_CHUNK = 4 * 1024 * 1024
+RESUME_MAX_CHUNKS = 1024
+RESUME_HASH_SIZE = 8
+# Sessions: records with up to SESSION_JOIN_SIZE bytes of data are sent in one piece with their header, and files up
+# to SESSION_READ_SIZE bytes are read into memory to be sent, larger ones are memory-mapped
+SESSION_JOIN_SIZE = 64 * 1024
+SESSION_READ_SIZE = 1024 * 1024
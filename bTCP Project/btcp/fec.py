@@ -0,0 +1,80 @@
+# Onno de Gouw
+# Stefan Popa
+
+from btcp.codec import PARITY_HEADER
+from btcp.constants import *
+
+
+# Forward error correction with XOR parity. When negotiated in the handshake, the client sends a parity segment after
+# every block of data segments. Its sequence number is that of the first segment of the block (parity segments do not
+# take sequence numbers of their own) and its data is the number of segments in the block and the XOR of their
+# lengths, followed by the XOR of their payloads, each padded with zeros to the longest. The server rebuilds a single
+# lost segment of a block from the parity and the other segments, without waiting a round trip for the
+# retransmission. Payloads are XORed as wide integers, so every segment is combined in a single operation instead of
+# byte by byte.
+
+
+# Accumulates the parity of the block of data segments the client is sending
+class ParityEncoder:
+    def __init__(self):
+        self.first = 0
+        self.count = 0
+        self._xor = 0
+        self._length_xor = 0
+        self._length = 0
+
+    # Add the data segment with sequence number seq_num to the block
+    def add(self, seq_num, data):
+        if self.count == 0:
+            self.first = seq_num
+
+        self._xor ^= int.from_bytes(data, "little")
+        self._length_xor ^= len(data)
+        self._length = max(self._length, len(data))
+        self.count += 1
+
+    # Return the data of the parity segment of the block and start a new block
+    def finish(self):
+        parity = PARITY_HEADER.pack(self.count, self._length_xor) + self._xor.to_bytes(self._length, "little")
+        self.count = self._xor = self._length_xor = self._length = 0
+
+        return parity
+
+
+# Return the number of data segments a parity segment covers
+def parity_count(parity):
+    return parity[0]
+
+
+# Return the data of the one missing segment of a block, given the data of its parity segment and the data of all
+# other segments of the block
+def recover(parity, others):
+    _, length = PARITY_HEADER.unpack_from(parity)
+    value = int.from_bytes(parity[PARITY_HEADER.size:], "little")
+
+    for data in others:
+        value ^= int.from_bytes(data, "little")
+        length ^= len(data)
+
+    return value.to_bytes(length, "little")
+
+
+# The number of data segments per parity segment. A fixed block size is used as given; an adaptive one follows the
+# loss rate measured by the client, so that a block holds a quarter of a loss on average: one parity segment only
+# repairs a single loss per block, and a block with two losses costs a round trip again.
+class Redundancy:
+    def __init__(self, block=FEC_BLOCK, adaptive=False):
+        self.block = block
+        self.adaptive = adaptive
+        self.loss_rate = 0.0
+
+    # lost of the sent segments since the last update were lost
+    def update(self, sent, lost):
+        if not self.adaptive or sent <= 0:
+            return
+
+        self.loss_rate += FEC_LOSS_GAIN * (min(lost / sent, 1) - self.loss_rate)
+        if self.loss_rate > 0:
+            self.block = min(max(int(1 / (4 * self.loss_rate)), FEC_MIN_BLOCK), FEC_MAX_BLOCK)
+        else:
+            self.block = FEC_MAX_BLOCK
@@ -0,0 +1,241 @@
+# Onno de Gouw
+# Stefan Popa
+
+import heapq
+import random
+import re
+import threading
+import time
+
+from btcp.lossy_layer import LossyLayer
+from btcp.constants import *
+
+
+# Network impairments to emulate, described like the arguments of tc netem. For example
+#     Impairment.parse("corrupt 1% duplicate 10% loss 10% 25% delay 20ms reorder 25% 50% seed 7")
+# Supported are loss P [CORRELATION], loss gemodel P [R [1-H [1-K]]] (Gilbert-Elliott bursts), duplicate P,
+# corrupt P, delay TIME [JITTER], reorder P [CORRELATION], rate RATE and seed N. Probabilities are fractions,
+# times are in ms and the rate is in bytes per second.
+class Impairment:
+    def __init__(self, seed=0, loss=0, loss_correlation=0, gemodel=None, duplicate=0, corrupt=0, delay=0, jitter=0,
+                 reorder=0, reorder_correlation=0, rate=None):
+        self.seed = seed
+        self.loss = loss
+        self.loss_correlation = loss_correlation
+        # Gilbert-Elliott model: (p, r, loss in the bad state, loss in the good state), where p is the probability
+        # to go from the good to the bad state and r that to go back
+        self.gemodel = gemodel
+        self.duplicate = duplicate
+        self.corrupt = corrupt
+        self.delay = delay
+        self.jitter = jitter
+        # Like netem, reordering sends a fraction of the segments immediately while the others are delayed
+        self.reorder = reorder
+        self.reorder_correlation = reorder_correlation
+        self.rate = rate
+
+    # Build an Impairment from a netem style description
+    @classmethod
+    def parse(cls, spec):
+        words = spec.split()
+        impairment = cls()
+        index = 0
+
+        # Consume and return the optional numeric arguments that follow a keyword
+        def arguments(parse, limit):
+            nonlocal index
+            values = []
+            while index < len(words) and len(values) < limit and re.match(r"[\d.]", words[index]):
+                values.append(parse(words[index]))
+                index += 1
+            return values
+
+        while index < len(words):
+            word = words[index]
+            index += 1
+
+            if word == "loss" and index < len(words) and words[index] == "gemodel":
+                index += 1
+                values = arguments(_percentage, 4)
+                if len(values) == 0:
+                    raise ValueError("loss gemodel needs at least one probability")
+                p = values[0]
+                r = values[1] if len(values) > 1 else 1 - p
+                impairment.gemodel = (p, r, values[2] if len(values) > 2 else 1, values[3] if len(values) > 3 else 0)
+            elif word in ("loss", "reorder"):
+                values = arguments(_percentage, 2) + [0]
+                setattr(impairment, word, values[0])
+                setattr(impairment, word + "_correlation", values[1])
+            elif word in ("duplicate", "corrupt"):
+                setattr(impairment, word, arguments(_percentage, 1)[0])
+            elif word == "delay":
+                values = arguments(_milliseconds, 2) + [0]
+                impairment.delay, impairment.jitter = values[0], values[1]
+            elif word == "rate":
+                impairment.rate = arguments(_rate, 1)[0]
+            elif word == "seed":
+                impairment.seed = arguments(int, 1)[0]
+            else:
+                raise ValueError("unknown impairment: {}".format(word))
+
+        return impairment
+
+
+# Parse "10%" or "0.1" into a fraction
+def _percentage(word):
+    if word.endswith("%"):
+        return float(word[:-1]) / 100
+
+    return float(word)
+
+
+# Parse "20ms", "1s" or "500us" into milliseconds
+def _milliseconds(word):
+    number, unit = re.fullmatch(r"([\d.]+)(us|ms|s)?", word).groups()
+
+    return float(number) * {"us": 0.001, "ms": 1, "s": 1000, None: 1}[unit]
+
+
+# Parse a rate like tc does ("10mbit", "1gbit" or "1000000" in bits per second, "100kbps" in bytes per second) into
+# bytes per second
+def _rate(word):
+    number, prefix, unit = re.fullmatch(r"([\d.]+)([kmg]?)(bit|bps)?", word.lower()).groups()
+    value = float(number) * {"": 1, "k": 1e3, "m": 1e6, "g": 1e9}[prefix]
+
+    return value if unit == "bps" else value / 8
+
+
+# A correlated random choice as made by netem: every draw is mixed with the previous one
+class _CorrelatedChoice:
+    def __init__(self, rng, probability, correlation):
+        self._rng = rng
+        self._probability = probability
+        self._correlation = correlation
+        self._last = rng.random()
+
+    def __call__(self):
+        if self._probability <= 0:
+            return False
+
+        self._last = (1 - self._correlation) * self._rng.random() + self._correlation * self._last
+
+        return self._last < self._probability
+
+
+# A drop-in replacement for LossyLayer that impairs every segment it sends, without root privileges or tc netem.
+# Receiving is unchanged, so when both sockets use it both directions are impaired, just like netem on lo. All
+# random decisions come from one generator seeded with impairment.seed: the same sequence of segments is always
+# impaired in the same way. Segments that have to wait (delay, reordering or the rate limit) are kept in a
+# priority queue by the time they leave, which a single scheduler thread sends out.
+class ImpairedLayer(LossyLayer):
+    def __init__(self, bTCP_sock, a_ip, a_port, b_ip, b_port, impairment):
+        super().__init__(bTCP_sock, a_ip, a_port, b_ip, b_port)
+        self._impairment = impairment
+        self._rng = random.Random(impairment.seed)
+        self._lose = _CorrelatedChoice(self._rng, impairment.loss, impairment.loss_correlation)
+        self._reorder = _CorrelatedChoice(self._rng, impairment.reorder, impairment.reorder_correlation)
+        self._bad_state = False
+        # Time (monotonic, in seconds) at which the emulated link has sent everything queued for it
+        self._link_free = 0
+        self._queue = []
+        self._counter = 0
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._scheduler = threading.Thread(target=self._run, daemon=True)
+        self._scheduler.start()
+
+    # Segments that are still queued have already been sent as far as the socket is concerned, just like those in the
+    # queue of netem: they are delivered before the layer is destroyed
+    def destroy(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+        self._scheduler.join()
+        super().destroy()
+
+    def send_segments(self, segments, address=None):
+        address = address or self._b_address
+        now = time.monotonic()
+        immediate = []
+
+        with self._cond:
+            for segment in segments:
+                if isinstance(segment, list):
+                    segment = b"".join(segment)
+
+                for _ in range(2 if self._rng.random() < self._impairment.duplicate else 1):
+                    if self._lost():
+                        continue
+
+                    copy = segment
+                    if self._rng.random() < self._impairment.corrupt:
+                        copy = self._flip_bit(segment)
+
+                    departure = self._departure(now, len(copy))
+                    if departure <= now and len(self._queue) == 0:
+                        immediate.append(copy)
+                    else:
+                        heapq.heappush(self._queue, (departure, self._counter, copy, address))
+                        self._counter += 1
+
+            self._cond.notify()
+
+        if len(immediate) > 0:
+            super().send_segments(immediate, address)
+
+    # Decide whether the next segment is lost, with the Gilbert-Elliott model if configured. The caller must hold
+    # self._cond.
+    def _lost(self):
+        if self._impairment.gemodel is None:
+            return self._lose()
+
+        p, r, bad_loss, good_loss = self._impairment.gemodel
+        if self._rng.random() < (r if self._bad_state else p):
+            self._bad_state = not self._bad_state
+
+        return self._rng.random() < (bad_loss if self._bad_state else good_loss)
+
+    # Return a copy of segment with one random bit inverted. The caller must hold self._cond.
+    def _flip_bit(self, segment):
+        segment = bytearray(segment)
+        bit = self._rng.randrange(len(segment) * 8)
+        segment[bit // 8] ^= 1 << (bit % 8)
+
+        return bytes(segment)
+
+    # Return the time at which a segment of size bytes, sent now, arrives at the other end of the emulated link. The
+    # caller must hold self._cond.
+    def _departure(self, now, size):
+        departure = now
+        if self._impairment.rate is not None:
+            self._link_free = max(self._link_free, now) + size / self._impairment.rate
+            departure = self._link_free
+
+        if self._impairment.delay > 0 and not self._reorder():
+            delay = self._impairment.delay
+            if self._impairment.jitter > 0:
+                delay += self._rng.uniform(-self._impairment.jitter, self._impairment.jitter)
+            departure += max(delay, 0) / 1000
+
+        return departure
+
+    # Send every queued segment once its time has come
+    def _run(self):
+        with self._cond:
+            while not self._stopped or len(self._queue) > 0:
+                if len(self._queue) == 0:
+                    self._cond.wait()
+                    continue
+
+                remaining = self._queue[0][0] - time.monotonic()
+                if remaining > 0:
+                    self._cond.wait(remaining)
+                    continue
+
+                _, _, segment, address = heapq.heappop(self._queue)
+                self._cond.release()
+                try:
+                    LossyLayer.send_segments(self, [segment], address)
+                finally:
+                    self._cond.acquire()
@@ -3,44 +3,106 @@
 
 import socket
 import select
+import sys
 import threading
 from btcp.constants import *
 
 
-# Continuously read from the socket and whenever a segment arrives,
-# call the lossy_layer_input method of the associated socket. 
+# Continuously read from the socket and whenever segments arrive,
+# call the lossy_layer_input method of the associated socket for each of them.
 # When flagged, return from the function.
-def handle_incoming_segments(bTCP_sock, event, udp_sock):
+def handle_incoming_segments(bTCP_sock, event, udp_sock, wake_sock):
+    # Without MSG_DONTWAIT (Windows) only one datagram can be read safely per wake-up
+    dontwait = getattr(socket, "MSG_DONTWAIT", 0)
+
     while not event.is_set():
-        # We do not block here, because we might never check the loop condition in that case
-        rlist, wlist, elist = select.select([udp_sock], [], [], 1)
-        if rlist:
-            segment, address = udp_sock.recvfrom(SEGMENT_SIZE)
+        # Block until a datagram arrives or destroy wakes us up through wake_sock
+        rlist, wlist, elist = select.select([udp_sock, wake_sock], [], [])
+        if udp_sock not in rlist:
+            continue
+
+        # Drain every datagram that is ready, instead of going back to select for each of them
+        flags = 0
+        while True:
+            try:
+                # Segments of any negotiated size fit; a larger buffer costs nothing, recvfrom shrinks it
+                segment, address = udp_sock.recvfrom(MAX_SEGMENT_SIZE, flags)
+            except BlockingIOError:
+                break
+
             bTCP_sock.lossy_layer_input(segment, address)
 
+            if not dontwait:
+                break
+            flags = dontwait
+
+
+# Return the largest payload of a segment to address that does not need IP fragmentation, based on the MTU of the
+# route to it. The MTU can only be queried on Linux; elsewhere this returns the default PAYLOAD_SIZE.
+def path_mss(address):
+    ip_mtu = getattr(socket, "IP_MTU", 14 if sys.platform.startswith("linux") else None)
+    if ip_mtu is None:
+        return PAYLOAD_SIZE
+
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp_sock:
+            udp_sock.connect(address)
+            mtu = udp_sock.getsockopt(socket.IPPROTO_IP, ip_mtu)
+    except OSError:
+        return PAYLOAD_SIZE
+
+    return max(min(mtu - IP_UDP_HEADER_SIZE - HEADER_SIZE, MAX_PAYLOAD_SIZE), 1)
+
 
 # The lossy layer emulates the network layer in that it provides bTCP with 
 # an unreliable segment delivery service between a and b. When the lossy layer is created, 
 # a thread is started that calls handle_incoming_segments. 
+# A listening server has no fixed b; it passes None and gives the address of the client with every send.
 class LossyLayer:
     def __init__(self, bTCP_sock, a_ip, a_port, b_ip, b_port):
         self._bTCP_sock = bTCP_sock
-        self._b_ip = b_ip
-        self._b_port = b_port
+        # Resolve the address once, instead of on every send
+        self._b_address = None if b_ip is None else (socket.gethostbyname(b_ip), b_port)
         self._udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self._udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # Room for a few full windows, so bursts are not dropped while the receiving thread is busy
+        self._udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_BUFFER_SIZE)
+        self._udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, UDP_BUFFER_SIZE)
         self._udp_sock.bind((a_ip, a_port))
         self._event = threading.Event()
+        # Writing to the other end of this pair wakes up the thread immediately when the layer is destroyed
+        self._wake_sock, self._waker = socket.socketpair()
         self._thread = threading.Thread(target=handle_incoming_segments,
-                                        args=(self._bTCP_sock, self._event, self._udp_sock))
+                                        args=(self._bTCP_sock, self._event, self._udp_sock, self._wake_sock))
         self._thread.start()
 
     # Flag the thread that it can stop and close the socket.
     def destroy(self):
         self._event.set()
+        self._waker.send(b"\0")
         self._thread.join()
         self._udp_sock.close()
+        self._wake_sock.close()
+        self._waker.close()
+
+    # Put the segment into the network, to address or else to b. A segment given as a list of buffers (header and
+    # data) is sent as one datagram with a gathering write, so the buffers do not have to be joined first.
+    def send_segment(self, segment, address=None):
+        self.send_segments([segment], address)
+
+    # Put a batch of segments into the network in one call. Python has no sendmmsg, so this still takes one system
+    # call per segment, but the per-call overhead is paid once for the whole batch.
+    def send_segments(self, segments, address=None):
+        address = address or self._b_address
+        sendto = self._udp_sock.sendto
+        sendmsg = getattr(self._udp_sock, "sendmsg", None)
+
+        for segment in segments:
+            if isinstance(segment, list):
+                if sendmsg is not None:
+                    sendmsg(segment, [], 0, address)
+                    continue
+
+                segment = b"".join(segment)
 
-    # Put the segment into the network
-    def send_segment(self, segment):
-        self._udp_sock.sendto(segment, (self._b_ip, self._b_port))
+            sendto(segment, address)
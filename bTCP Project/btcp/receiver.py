@@ -0,0 +1,392 @@
+# Onno de Gouw
+# Stefan Popa
+
+import os
+from collections import deque
+
+from btcp import codec, fec
+from btcp.constants import *
+
+
+# Write a list of buffers to file, with vectored writes when the file has a descriptor. Given an offset, they are
+# written at that position with positional writes, which leave the file position alone, so several connections can
+# write into one file at the same time.
+def _write_chunks(file, chunks, offset=None):
+    try:
+        fd = file.fileno()
+    except (AttributeError, OSError):
+        fd = None
+
+    if fd is None or not hasattr(os, "writev"):
+        if offset is not None:
+            file.seek(offset)
+        file.writelines(chunks)
+        return
+
+    file.flush()
+    if offset is not None and not hasattr(os, "pwritev"):
+        os.lseek(fd, offset, os.SEEK_SET)
+        offset = None
+
+    chunks = [memoryview(chunk) for chunk in chunks if len(chunk) > 0]
+    while len(chunks) > 0:
+        if offset is None:
+            count = os.writev(fd, chunks[:IOV_MAX])
+        else:
+            count = os.pwritev(fd, chunks[:IOV_MAX], offset)
+            offset += count
+
+        # Drop what has been written; a short write can end in the middle of a chunk
+        while len(chunks) > 0 and count >= len(chunks[0]):
+            count -= len(chunks.pop(0))
+        if count > 0:
+            chunks[0] = chunks[0][count:]
+
+
+# The receiving half of a bTCP connection: it delivers the data segments of the other side in order, keeps those
+# that arrive after a gap, acknowledges them and hands the data to the application. The client and the connections
+# of the server both receive, so this is a mixin of both. ACKs are delayed, and an outgoing data segment of the
+# sending half acknowledges all data as well (see _piggyback), so a separate ACK is only sent when no data goes the
+# other way in time. It relies on the socket for the lossy layer, _cond, the counters and the round-trip time
+# estimate of its sending half. A side that only receives has no such estimate; the socket then sets _recv_rtt from
+# the handshake.
+# The data waiting to be read is limited by a memory budget in bytes, and the window advertises the whole segments
+# that still fit in it; the reorder buffer only holds segments within that window. When the application stops
+# reading, the window closes and data beyond it is dropped; once the application reads again a window update reopens
+# it. The budget starts at the initial window and grows with the rate at which the application reads (see
+# _consumed), up to buffer_size, so a slow reader does not take memory it cannot use while a fast one gets the window
+# the path needs.
+class BTCPReceiver:
+    # Set up the state of the receiving half. The socket sets _recv_seq to the first sequence number of the other
+    # side once it is known from the handshake.
+    def _init_receiver(self, ack_every, ack_delay, buffer_size):
+        # The sequence number expected next, and the in-order data waiting to be read
+        self._recv_seq = 0
+        self._recv_queue = deque()
+        # Number of bytes of the first packet in _recv_queue that the application has already read
+        self._recv_offset = 0
+        # Memory budget: the bytes waiting in _recv_queue, the largest budget and the budget autotuning has grown to so
+        # far, and the end of the window last advertised (a sequence number)
+        self._recv_bytes = 0
+        self._buffer_size = buffer_size
+        self._tuned_size = 0
+        self._window_edge = 0
+        # Drain rate: bytes read by the application since the start of the current measurement (in ms), and the
+        # round-trip time (in ms) measured in the handshake, or None
+        self._drained = 0
+        self._drain_start = self._now()
+        self._recv_rtt = None
+        # Reorder buffer: segments that arrived after a gap, by sequence number, and the one that arrived last
+        self._out_of_order = {}
+        self._last_out_of_order = None
+        # Set once the other side has closed the connection
+        self._finished = False
+        # Delayed ACKs: in-order segments received since the last ACK, and the timer that acknowledges them when no
+        # further segment arrives (ack_every=1 acknowledges every segment immediately)
+        self._ack_every = ack_every
+        self._ack_delay = ack_delay
+        self._unacked = 0
+        self._ack_timer = self._create_timer(self._on_ack_timeout)
+        # Forward error correction (see btcp.fec): whether it was agreed on, the parity segments by the first sequence
+        # number of their block, and the last FEC_MAX_BLOCK delivered segments by sequence number, which a block
+        # with a lost segment may still need after the application has read them
+        self._fec_agreed = False
+        self._parities = {}
+        self._delivered = {}
+        # Compression (see btcp.compression): the decoder of the frames once it was agreed on. Received data is
+        # decoded as it is delivered, so the application reads the data as the other side sent it.
+        self._decoder = None
+
+    # Deliver or buffer the data segment with sequence number seq_num, received or rebuilt from parity, and
+    # acknowledge it. The caller must hold self._cond.
+    def _receive_data(self, seq_num, data):
+        # Backpressure: while the window is closed, the application has data to read and nothing more is taken, not
+        # even a window probe
+        if seq_num == self._recv_seq and self._free_window() == 0:
+            self.stats.out_of_window += 1
+            if self._tracer is not None:
+                self._trace("out_of_window", seq_num=seq_num, expected=self._recv_seq)
+            self._send_ack()
+        elif seq_num == self._recv_seq:
+            filled_gap = len(self._out_of_order) > 0
+            self.stats.bytes_received += len(data)
+
+            while data is not None:
+                if self._decoder is None:
+                    self._recv_queue.append(data)
+                    self._recv_bytes += len(data)
+                else:
+                    for decoded in self._decoder.decode(data):
+                        self._recv_queue.append(decoded)
+                        self._recv_bytes += len(decoded)
+                if self._fec_agreed:
+                    self._delivered[self._recv_seq] = data
+                    self._delivered.pop(self._recv_seq - FEC_MAX_BLOCK, None)
+
+                self._recv_seq += 1
+                data = self._out_of_order.pop(self._recv_seq, None)
+
+            # Delayed ACK: acknowledge every ack_every-th segment, or once the timer expires. A segment that
+            # fills a gap is acknowledged at once, as is one that closes the window, so the other side learns
+            # about it without waiting for the timer.
+            self._unacked += 1
+            if self._free_window() == 0:
+                self.stats.window_stalls += 1
+                if self._tracer is not None:
+                    self._trace("window_stall", buffered=len(self._recv_queue))
+
+            if filled_gap or self._unacked >= self._ack_every or self._free_window() == 0:
+                self._send_ack()
+            elif not self._ack_timer.running:
+                self._ack_timer.start(self._ack_delay)
+        else:
+            if seq_num < self._recv_seq or seq_num in self._out_of_order:
+                self.stats.duplicates += 1
+                if self._tracer is not None:
+                    self._trace("duplicate", seq_num=seq_num)
+            elif seq_num - self._recv_seq < self._free_window():
+                self._out_of_order[seq_num] = data
+                self._last_out_of_order = seq_num
+                self.stats.out_of_order += 1
+                self.stats.bytes_received += len(data)
+                if self._tracer is not None:
+                    self._trace("out_of_order", seq_num=seq_num, expected=self._recv_seq)
+            else:
+                # Beyond the window: dropped, the other side sends it again once the window has moved on
+                self.stats.out_of_window += 1
+                if self._tracer is not None:
+                    self._trace("out_of_window", seq_num=seq_num, expected=self._recv_seq)
+
+            # An out-of-order or duplicate segment is acknowledged immediately, so fast retransmit works
+            self._send_ack()
+
+    # Rebuild the lost segment of every block of which all other segments and the parity have arrived, and forget
+    # the parity of blocks that have been delivered completely. The caller must hold self._cond.
+    def _repair(self):
+        for first, parity in list(self._parities.items()):
+            last = first + fec.parity_count(parity)
+            if last <= self._recv_seq:
+                del self._parities[first]
+                continue
+
+            missing = [seq_num for seq_num in range(max(first, self._recv_seq), last)
+                       if seq_num not in self._out_of_order]
+            if len(missing) != 1:
+                continue
+
+            others = [self._delivered.get(seq_num) if seq_num < self._recv_seq else self._out_of_order[seq_num]
+                      for seq_num in range(first, last) if seq_num != missing[0]]
+            del self._parities[first]
+            if None in others:
+                continue
+
+            self.stats.fec_recovered += 1
+            if self._tracer is not None:
+                self._trace("fec_recovered", seq_num=missing[0])
+            self._receive_data(missing[0], memoryview(fec.recover(parity, others)))
+
+    # Called by the delayed ACK timer when it expires
+    def _on_ack_timeout(self):
+        with self._cond:
+            # An ACK was sent just before this call, or the timer was restarted
+            if self._ack_timer.running or self._unacked == 0:
+                return
+
+            self.stats.delayed_acks += 1
+            self._send_ack()
+
+    # Send a cumulative ACK for all in-order data, which also covers any segments whose ACK was delayed. If segments
+    # are waiting in the reorder buffer, the ACK carries selective acknowledgement blocks (start and end sequence
+    # number of each contiguous range) as its data, with the block holding the most recently received segment first
+    # (RFC 2018).
+    def _send_ack(self):
+        blocks = []
+        for seq_num in sorted(self._out_of_order):
+            if len(blocks) > 0 and blocks[-1][1] == seq_num:
+                blocks[-1][1] += 1
+            else:
+                blocks.append([seq_num, seq_num + 1])
+
+        blocks.sort(key=lambda block: not block[0] <= self._last_out_of_order < block[1])
+        data = b"".join(codec.SACK_BLOCK.pack(codec.wrap(start), codec.wrap(end))
+                        for start, end in blocks[:MAX_SACK_BLOCKS])
+
+        # Without SACK blocks, an ACK is only a header
+        window = self._advertise()
+        segment_packet = self.build_segment(self._seq_num, self._recv_seq, ACK, window, len(data), data)
+        self._lossy_layer.send_segment(segment_packet)
+        self.stats.segments_sent += 1
+        self.stats.acks_sent += 1
+        if self._tracer is not None:
+            self._trace("ack_sent", ack_num=self._recv_seq, window=window, covers=self._unacked,
+                        sack=blocks[:MAX_SACK_BLOCKS])
+
+        self._unacked = 0
+        self._ack_timer.stop()
+
+    # Return the ACK number and window for an outgoing segment of the sending half. It acknowledges all in-order
+    # data, so any delayed ACK is no longer needed. The caller must hold self._cond.
+    def _piggyback(self):
+        if self._unacked > 0:
+            self.stats.acks_piggybacked += 1
+            if self._tracer is not None:
+                self._trace("ack_piggybacked", ack_num=self._recv_seq, covers=self._unacked)
+            self._unacked = 0
+            self._ack_timer.stop()
+
+        return self._recv_seq, self._advertise()
+
+    # Return the window to advertise in an outgoing segment, and remember where it ends. The caller must hold
+    # self._cond.
+    def _advertise(self):
+        window = self._free_window()
+        self._window_edge = self._recv_seq + window
+
+        return window
+
+    # Return the memory budget of the data held: the initial window, or the size autotuning has grown it to, but no
+    # more than buffer_size (and at least one segment)
+    def _budget(self):
+        return min(max(self._window_a * self._mss, self._tuned_size), max(self._buffer_size, self._mss))
+
+    # The number of segments the other side may still send: the whole segments that still fit in the budget, which
+    # the one-byte window field can carry. Decompressed data can overfill the budget, so never advertise less than
+    # zero.
+    def _free_window(self):
+        return min(max((self._budget() - self._recv_bytes) // self._mss, 0), MAX_WINDOW)
+
+    # Account for count bytes the application has read: they leave the budget, and they are part of the drain rate.
+    # Once per round trip (but not more often than every AUTOTUNE_INTERVAL ms) the budget grows to twice what the
+    # application reads in a round trip at that rate, so that the window keeps up with the sender while its
+    # congestion window grows. The round trip is the one the sending half measures, or the one of the handshake
+    # while it has sent nothing. The caller must hold self._cond.
+    def _consumed(self, count):
+        self._recv_bytes -= count
+        self._drained += count
+
+        now = self._now()
+        rtt = self._rto.srtt if self._rto.srtt is not None else self._recv_rtt
+        interval = max(rtt or 0, AUTOTUNE_INTERVAL)
+        if now - self._drain_start >= interval:
+            size = int(2 * self._drained * interval / (now - self._drain_start))
+            if size > self._budget() and self._budget() < self._buffer_size:
+                self._tuned_size = min(size, self._buffer_size)
+                if self._tracer is not None:
+                    self._trace("autotune", buffer=self._tuned_size, window=self._free_window())
+            self._drained = 0
+            self._drain_start = now
+
+        self._update_window()
+
+    # Send a window update once reading has opened the window to at least twice what the other side may still send
+    # after the last advertisement, and to at least half the budget: a window that is mostly used up is reopened in
+    # one step, instead of a segment at a time (receiver-side silly window syndrome avoidance, RFC 1122). The caller
+    # must hold self._cond.
+    def _update_window(self):
+        window = self._free_window()
+        usable = max(self._window_edge - self._recv_seq, 0)
+        if self._connected and window >= max(2 * usable, min(self._budget() // self._mss, MAX_WINDOW) // 2, 1):
+            self.stats.window_updates += 1
+            if self._tracer is not None:
+                self._trace("window_update", window=window)
+            self._send_ack()
+
+    # Wait until data is available or the other side has closed the connection. The caller must hold self._cond.
+    def _wait_readable(self, timeout):
+        if not self._cond.wait_for(lambda: len(self._recv_queue) > 0 or self._finished, timeout):
+            raise TimeoutError("no bTCP data received")
+
+    # Send any incoming data to the application layer: return at most max_bytes of in-order data (the rest of the
+    # next segment if max_bytes is None) and b"" once the connection has been closed and all data was read
+    def recv(self, max_bytes=None, timeout=None):
+        with self._cond:
+            self._wait_readable(timeout)
+            if len(self._recv_queue) == 0:
+                return b""
+
+            inp_data = self._recv_queue[0]
+            start = self._recv_offset
+            end = len(inp_data) if max_bytes is None else min(len(inp_data), start + max_bytes)
+
+            if end == len(inp_data):
+                self._recv_queue.popleft()
+                self._recv_offset = 0
+            else:
+                self._recv_offset = end
+            self._consumed(end - start)
+
+            # The queued data are memoryviews on the received datagrams; this is the one place where they are copied
+            return bytes(inp_data[start:end])
+
+    # Like recv, but copy the data into buffer instead of returning it. Returns the number of bytes written, which
+    # is 0 once the connection has been closed and all data was read.
+    def recv_into(self, buffer, nbytes=0, timeout=None):
+        view = memoryview(buffer).cast("B")
+        nbytes = nbytes or len(view)
+        written = 0
+
+        with self._cond:
+            self._wait_readable(timeout)
+
+            # Copy as many queued segments as fit without waiting for more data to arrive
+            while written < nbytes and len(self._recv_queue) > 0:
+                inp_data = self._recv_queue[0]
+                count = min(len(inp_data) - self._recv_offset, nbytes - written)
+                view[written:written + count] = inp_data[self._recv_offset:self._recv_offset + count]
+                written += count
+
+                if self._recv_offset + count == len(inp_data):
+                    self._recv_queue.popleft()
+                    self._recv_offset = 0
+                else:
+                    self._recv_offset += count
+            self._consumed(written)
+
+        return written
+
+    # Write all incoming data to file until the connection is closed, or nbytes of it if given, and return the
+    # number of bytes written. Every time data is available, all queued segments are taken at once and written with a
+    # single vectored write (or writelines for file objects without a file descriptor), so memory use is bounded by the
+    # receive window instead of the size of the file. Given an offset, the data is written from that position of the
+    # file on with positional writes (see _write_chunks).
+    def recv_to_file(self, file, timeout=None, offset=None, nbytes=None):
+        written = 0
+
+        while nbytes is None or written < nbytes:
+            with self._cond:
+                self._wait_readable(timeout)
+                if len(self._recv_queue) == 0:
+                    return written
+
+                chunks = self._take_chunks(None if nbytes is None else nbytes - written)
+
+            _write_chunks(file, chunks, offset + written if offset is not None else None)
+            written += sum(len(chunk) for chunk in chunks)
+
+        return written
+
+    # Take the queued data off the delivery queue, at most limit bytes of it if given, and return it as a list of
+    # chunks. The caller must hold self._cond.
+    def _take_chunks(self, limit=None):
+        if limit is None:
+            chunks = list(self._recv_queue)
+            chunks[0] = chunks[0][self._recv_offset:]
+            self._recv_queue.clear()
+            self._recv_offset = 0
+            self._consumed(sum(len(chunk) for chunk in chunks))
+            return chunks
+
+        chunks = []
+        while limit > 0 and len(self._recv_queue) > 0:
+            chunk = self._recv_queue[0][self._recv_offset:self._recv_offset + limit]
+            chunks.append(chunk)
+            limit -= len(chunk)
+
+            if self._recv_offset + len(chunk) == len(self._recv_queue[0]):
+                self._recv_queue.popleft()
+                self._recv_offset = 0
+            else:
+                self._recv_offset += len(chunk)
+        self._consumed(sum(len(chunk) for chunk in chunks))
+
+        return chunks
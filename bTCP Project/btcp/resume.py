@@ -0,0 +1,239 @@
+# Onno de Gouw
+# Stefan Popa
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+
+from btcp.constants import *
+
+
+# Resumable transfers. A file is cut into chunks of at least RESUME_CHUNK bytes, and the client offers the hash of
+# every chunk of the file it sends in the resume option of its SYN (a ChunkIndex). The server keeps a manifest next to
+# its output file: every chunk that has been written and synced to disk is recorded there with its hash, so the
+# manifest survives the server, the client or the connection dying. In the SYN+ACK the server answers with a bitmap of
+# the chunks it already holds with the same hash, and the client only sends the others: after an interruption only
+# what is missing is sent, and on a second transfer of a changed file only the chunks that changed. The missing
+# chunks are sent back to back in the order of the file, so both sides know where every byte belongs without any
+# framing.
+
+# Size of the file and of its chunks, followed by the hashes of the chunks
+INDEX_HEADER = struct.Struct("QQ")
+
+
+# Flush the data of a file to disk (fdatasync is not available on every platform)
+_sync = getattr(os, "fdatasync", os.fsync)
+
+
+# Return the hash of a chunk
+def chunk_hash(data):
+    return hashlib.blake2b(data, digest_size=RESUME_HASH_SIZE).digest()
+
+
+# The chunks of a file and their hashes, as offered by the client
+class ChunkIndex:
+    def __init__(self, size, chunk, hashes):
+        self.size = size
+        self.chunk = chunk
+        self.hashes = hashes
+
+    # Return the size of the chunks of a file of size bytes: RESUME_CHUNK, or a multiple of it that cuts the file into
+    # at most RESUME_MAX_CHUNKS chunks
+    @staticmethod
+    def chunk_size(size):
+        chunks = max(-(-size // RESUME_CHUNK), 1)
+
+        return -(-chunks // RESUME_MAX_CHUNKS) * RESUME_CHUNK
+
+    # Build the index of the file at path, which is read once to hash it
+    @classmethod
+    def from_file(cls, path):
+        with open(path, "rb") as file:
+            size = os.fstat(file.fileno()).st_size
+            chunk = cls.chunk_size(size)
+            if size == 0:
+                return cls(size, chunk, [])
+
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data, memoryview(data) as view:
+                return cls(size, chunk, [chunk_hash(view[offset:offset + chunk]) for offset in range(0, size, chunk)])
+
+    # Return the value of the resume option of the SYN, and the index in a received one (None if it is malformed)
+    def option(self):
+        return INDEX_HEADER.pack(self.size, self.chunk) + b"".join(self.hashes)
+
+    @classmethod
+    def parse(cls, value):
+        if len(value) < INDEX_HEADER.size:
+            return None
+
+        size, chunk = INDEX_HEADER.unpack_from(value)
+        hashes = [value[offset:offset + RESUME_HASH_SIZE] for offset in range(INDEX_HEADER.size, len(value),
+                                                                              RESUME_HASH_SIZE)]
+        if chunk == 0 or len(hashes) != -(-size // chunk) or any(len(digest) != RESUME_HASH_SIZE for digest in hashes):
+            return None
+
+        return cls(size, chunk, hashes)
+
+    # Return the offset and length of every chunk
+    def chunks(self):
+        return [(offset, min(self.chunk, self.size - offset)) for offset in range(0, self.size, self.chunk)]
+
+    # Return the offset and length of the runs of consecutive chunks that are not in held, in the order of the file
+    def missing(self, held):
+        runs = []
+        for number, (offset, length) in enumerate(self.chunks()):
+            if number in held:
+                continue
+            if len(runs) > 0 and sum(runs[-1]) == offset:
+                runs[-1] = (runs[-1][0], runs[-1][1] + length)
+            else:
+                runs.append((offset, length))
+
+        return runs
+
+
+# Return the value of the resume option of the SYN+ACK for the chunks in held out of count, and the chunks held in a
+# received one
+def held_option(held, count):
+    bitmap = bytearray(-(-count // 8))
+    for number in held:
+        bitmap[number // 8] |= 1 << (number % 8)
+
+    return bytes(bitmap)
+
+
+def parse_held_option(value, count):
+    return {number for number in range(min(count, len(value) * 8)) if value[number // 8] & (1 << (number % 8))}
+
+
+# The manifest of the output file at path, kept in path + ".manifest" as JSON lines: the size of the file and of its
+# chunks, followed by a line for every chunk that has been committed, with its hash. A line that was cut short when
+# the server died is ignored.
+class Manifest:
+    def __init__(self, path):
+        self.path = path
+        self._manifest_path = path + ".manifest"
+        self._file = None
+
+    # Return the size of the file and of its chunks and the hashes of the committed chunks by number, or None if there
+    # is no manifest
+    def _load(self):
+        try:
+            with open(self._manifest_path) as file:
+                lines = file.read().splitlines()
+        except FileNotFoundError:
+            return None
+
+        records = []
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                pass
+        if len(records) == 0 or "size" not in records[0]:
+            return None
+
+        return (records[0]["size"], records[0]["chunk"],
+                {record["number"]: bytes.fromhex(record["hash"]) for record in records[1:] if "number" in record})
+
+    # Return the chunks of index that the output file holds: those committed with the same hash. This is the resume
+    # callable of a server socket.
+    def held(self, index):
+        manifest = self._load()
+        if manifest is None or manifest[:2] != (index.size, index.chunk):
+            return set()
+        try:
+            if os.stat(self.path).st_size != index.size:
+                return set()
+        except FileNotFoundError:
+            return set()
+
+        committed = manifest[2]
+
+        return {number for number, digest in enumerate(index.hashes) if committed.get(number) == digest}
+
+    # Start receiving the file of index, of which the output file holds the chunks in held. The manifest is replaced
+    # by one that only records those: every other chunk is about to be overwritten.
+    def start(self, index, held):
+        temporary = self._manifest_path + ".new"
+        with open(temporary, "w") as file:
+            file.write(json.dumps({"size": index.size, "chunk": index.chunk}) + "\n")
+            for number in sorted(held):
+                file.write(json.dumps({"number": number, "hash": index.hashes[number].hex()}) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, self._manifest_path)
+
+        self._file = open(self._manifest_path, "a")
+
+    # Record that chunk number, with hash digest, is on disk. The data must have been synced first.
+    def commit(self, number, digest):
+        self._file.write(json.dumps({"number": number, "hash": digest.hex()}) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+# Send the file at path, whose index was offered when connecting, over the connected client socket: only the chunks
+# the server does not hold, or all of them if the server does not resume transfers
+def send_file(client, path, index):
+    held = client.resume_held or set()
+    if index.size == 0:
+        return
+
+    with open(path, "rb") as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data, memoryview(data) as view:
+            for offset, length in index.missing(held):
+                client.send(view[offset:offset + length])
+
+
+# Receive the chunks the client sends over connection, which agreed to resume, into the output file of manifest.
+# Every chunk is written to its place in the file, synced and committed to the manifest once all of it has arrived
+# with the hash the client offered. Returns whether the file is complete once the client has closed the connection.
+def receive_file(connection, manifest):
+    index, held = connection.resume_index, connection.resume_held
+    buffer = bytearray(min(index.chunk, RESUME_CHUNK))
+    complete = True
+
+    manifest.start(index, held)
+    fd = os.open(manifest.path, os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+        os.ftruncate(fd, index.size)
+
+        for number, (offset, length) in enumerate(index.chunks()):
+            if number in held:
+                continue
+
+            hasher = hashlib.blake2b(digest_size=RESUME_HASH_SIZE)
+            received = 0
+            while received < length:
+                count = connection.recv_into(buffer, min(len(buffer), length - received))
+                if count == 0:
+                    return False
+                os.pwrite(fd, memoryview(buffer)[:count], offset + received)
+                hasher.update(memoryview(buffer)[:count])
+                received += count
+
+            # A chunk that changed while it was being sent is not committed, the next transfer sends it again
+            digest = hasher.digest()
+            if digest != index.hashes[number]:
+                complete = False
+                continue
+            _sync(fd)
+            manifest.commit(number, digest)
+
+        # Read on until the client closes the connection, so that all data is acknowledged. The client never sends
+        # more than the missing chunks.
+        while connection.recv_into(buffer) > 0:
+            complete = False
+    finally:
+        os.close(fd)
+        manifest.close()
+
+    return complete
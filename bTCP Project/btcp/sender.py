@@ -0,0 +1,390 @@
+# Onno de Gouw
+# Stefan Popa
+
+import time
+from collections import deque
+
+from btcp import codec
+from btcp.timer import RTOEstimator
+from btcp.congestion import CONGESTION_CONTROLS
+from btcp.fec import ParityEncoder
+from btcp.stats import finite
+from btcp.constants import *
+
+
+# The sending half of a bTCP connection: it cuts the data of the application into segments, keeps them until they
+# are acknowledged and retransmits them when they are lost. The client and the connections of the server both send,
+# so this is a mixin of both; the socket calls _on_ack for the ACK number and window of every ACK and every data
+# segment that arrives, since data segments carry an ACK for the other direction as well. It relies on the socket
+# for the lossy layer, _cond, the counters and the ACK number and window of its receiving half (see
+# BTCPReceiver._piggyback).
+class BTCPSender:
+    # Set up the state of the sending half. The socket sets _seq_num and _ack_num to its initial sequence number.
+    def _init_sender(self, timeout, congestion_control):
+        self._window_b = 0
+        self._buffer_packets = []
+        self._seq_num = 0
+        self._ack_num = 0
+        self._counter_ack = 1
+        # Scoreboard for selective repeat: sequence numbers the other side has selectively acknowledged, and those
+        # that have been retransmitted since the last timeout
+        self._sacked = set()
+        self._retransmitted = set()
+        # After a timeout, every ACK below _recover (the next sequence number at the time) resends the next hole
+        self._recover = None
+        # The timeout given by the application is only the initial retransmission timeout, it adapts to the
+        # measured round-trip time. One segment at a time is timed (seq number and send time in ms).
+        self._rto = RTOEstimator(timeout)
+        self._rtt_seq = None
+        self._rtt_start = 0
+        # Persist timer: the number of window probes sent since the window of the other side closed, which back off
+        # the interval between them (see _persist_interval). A dropped probe is not a loss.
+        self._persist_backoffs = 0
+        # Congestion control (a name from CONGESTION_CONTROLS or a controller class). The window is only reduced once
+        # per loss episode: losses detected before _cc_recover (the next sequence number at the time) is acknowledged
+        # belong to the same episode.
+        if isinstance(congestion_control, str):
+            congestion_control = CONGESTION_CONTROLS[congestion_control]
+        self._cc = congestion_control()
+        self._cc_recover = None
+        # Forward error correction, once agreed on: the redundancy and the parity of the current block. Losses in a
+        # block whose parity has been sent are left to the other side to repair (see _awaiting_parity): _blocks
+        # holds the first and end sequence number of those blocks, _deferred the losses that were left to it and
+        # _repaired counts those it did repair. The loss rate is measured from the sequence number and the number of
+        # losses at its last update.
+        self._redundancy = None
+        self._parity = ParityEncoder()
+        self._blocks = deque()
+        self._deferred = set()
+        self._repaired = 0
+        self._fec_seq = 0
+        self._fec_losses = 0
+        # Compression, once agreed on: the encoder of the frames
+        self._encoder = None
+        self._timer = self._create_timer(self._on_timeout)
+
+    # Process the ACK number and window of an incoming segment. sack holds the SACK blocks of a segment that only
+    # acknowledges (None for a data segment): only those count as duplicate ACKs, and only while data is outstanding
+    # (RFC 5681), since a data segment repeats the ACK number whenever the other side has nothing new to
+    # acknowledge. The caller must hold self._cond.
+    def _on_ack(self, ack_num, window, sack=None):
+        # An ACK for data that was never sent is ignored
+        if ack_num > self._seq_num:
+            return
+
+        # ACK received: Update the unacknowledged packet list and restart the timer, if needed
+        if ack_num > self._ack_num:
+            self._counter_ack = 1
+            from_index = self._ack_num
+            self._ack_num = ack_num
+            self._window_b = window
+            self._persist_backoffs = 0
+
+            # A cumulative ACK can cover many packets (the other side delays its ACKs): drop them all at once
+            for segment_packet in self._buffer_packets[:ack_num - from_index]:
+                self.stats.bytes_acked += len(segment_packet[1])
+            del self._buffer_packets[:ack_num - from_index]
+
+            if len(self._sacked) > 0:
+                self._sacked = {seq_num for seq_num in self._sacked if seq_num >= ack_num}
+            if len(self._deferred) > 0:
+                self._repaired += sum(1 for seq_num in self._deferred
+                                      if seq_num < ack_num and seq_num not in self._retransmitted)
+                self._deferred = {seq_num for seq_num in self._deferred if seq_num >= ack_num}
+            while len(self._blocks) > 0 and self._blocks[0][1] <= ack_num:
+                self._blocks.popleft()
+            if len(self._retransmitted) > 0:
+                self._retransmitted = {seq_num for seq_num in self._retransmitted if seq_num >= ack_num}
+
+            # RTT measurement: the timed segment has been acknowledged
+            if self._rtt_seq is not None and ack_num > self._rtt_seq:
+                self._rto.sample(self._now() - self._rtt_start)
+                self._rtt_seq = None
+                if self._tracer is not None:
+                    self._trace("rtt_sample", srtt=self._rto.srtt, rttvar=self._rto.rttvar, rto=self._rto.rto)
+            self._rto.reset_backoff()
+
+            # Congestion control: grow the window, unless the ACK belongs to the recovery from a loss
+            if self._cc_recover is not None and ack_num >= self._cc_recover:
+                self._cc_recover = None
+            if self._cc_recover is None:
+                self._cc.on_ack(self._ack_num - from_index, self._rto.srtt)
+
+            # Recovery after a timeout: the next unacknowledged packet was most likely lost as well
+            if self._recover is not None:
+                if ack_num < self._recover and len(self._buffer_packets) > 0:
+                    if ack_num not in self._retransmitted:
+                        self._retransmit(0)
+                else:
+                    self._recover = None
+
+            if len(self._buffer_packets) != 0:
+                self._timer.start(self._rto.rto)
+            else:
+                self._timer.stop()
+        elif self._ack_num == ack_num:
+            previous_window, self._window_b = self._window_b, window
+
+            # A window update that reopens a closed window: the window probe sent while it was closed was dropped, so
+            # it is sent again. Neither that update nor the ACK of a dropped probe, which repeats the zero window, is
+            # a duplicate ACK: the other side is not losing data, it is not reading it.
+            if window > 0 and (previous_window == 0 or self._persist_backoffs > 0):
+                self._persist_backoffs = 0
+                if len(self._buffer_packets) > 0 and ack_num not in self._retransmitted:
+                    self._probe()
+            elif sack is not None and window > 0 and len(self._buffer_packets) > 0:
+                self._counter_ack += 1
+                self.stats.duplicate_acks += 1
+
+                # Fast Retransmit: If three duplicate ACKs are received, resend the packet that was lost
+                if self._counter_ack == DUP_ACK_THRESHOLD and ack_num not in self._retransmitted\
+                        and not self._awaiting_parity(ack_num):
+                    self._on_loss()
+                    self._retransmit(0)
+                    self.stats.fast_retransmits += 1
+
+        # Selective Repeat: Resend only the packets that the SACK blocks show to be lost
+        if sack is not None and ack_num == self._ack_num:
+            for start, end in codec.SACK_BLOCK.iter_unpack(sack):
+                start, end = codec.unwrap(start, ack_num), codec.unwrap(end, ack_num)
+                self._sacked.update(range(max(start, ack_num), min(end, self._seq_num)))
+
+            self._retransmit_lost()
+
+    # Return the current time in milliseconds
+    @staticmethod
+    def _now():
+        return time.monotonic() * 1000
+
+    # Resend the unacknowledged packet at the given index of the buffer. The caller must hold self._cond.
+    def _retransmit(self, index):
+        self._lossy_layer.send_segment(self._buffer_packets[index])
+        self._retransmitted.add(self._ack_num + index)
+        self.stats.segments_sent += 1
+        self.stats.retransmissions += 1
+        if self._tracer is not None:
+            self._trace("retransmission", seq_num=self._ack_num + index)
+
+        # Karn's rule: a retransmitted segment must not be used for RTT measurement
+        self._rtt_seq = None
+
+    # Resend the oldest unacknowledged packet as a window probe: the other side dropped it because its window was
+    # closed, so unlike a retransmission it says nothing about the path. The caller must hold self._cond.
+    def _probe(self):
+        self._lossy_layer.send_segment(self._buffer_packets[0])
+        self.stats.segments_sent += 1
+        self.stats.window_probes += 1
+        if self._tracer is not None:
+            self._trace("window_probe", seq_num=self._ack_num, backoffs=self._persist_backoffs)
+
+        # The probe waits for the window to open before it is acknowledged, so it gives no RTT sample either
+        self._rtt_seq = None
+
+    # Return the interval of the persist timer: the retransmission timeout, doubled for every window probe that found
+    # the window still closed
+    def _persist_interval(self):
+        return min(self._rto.rto * 2 ** self._persist_backoffs, MAX_RTO)
+
+    # Resend every packet that has not been retransmitted yet and is considered lost because at least
+    # DUP_ACK_THRESHOLD packets after it have been selectively acknowledged (RFC 6675). The caller must hold
+    # self._cond.
+    def _retransmit_lost(self):
+        sacked_above = len(self._sacked)
+
+        for index in range(len(self._buffer_packets)):
+            if sacked_above < DUP_ACK_THRESHOLD:
+                break
+
+            seq_num = self._ack_num + index
+            if seq_num in self._sacked:
+                sacked_above -= 1
+            elif seq_num not in self._retransmitted and not self._awaiting_parity(seq_num):
+                self._on_loss()
+                self._retransmit(index)
+                self.stats.fast_retransmits += 1
+
+    # Return whether the lost packet seq_num is left to forward error correction: it belongs to a block whose parity
+    # has been sent, and fewer than DUP_ACK_THRESHOLD packets sent after that parity have been selectively
+    # acknowledged, so the parity may still arrive and rebuild it. A loss the other side repairs costs neither a
+    # retransmission nor a reduction of the congestion window. The caller must hold self._cond.
+    def _awaiting_parity(self, seq_num):
+        for first, end in self._blocks:
+            if first <= seq_num < end:
+                if sum(1 for sacked in self._sacked if sacked >= end) >= DUP_ACK_THRESHOLD:
+                    return False
+
+                self._deferred.add(seq_num)
+                return True
+
+        return False
+
+    # Tell the congestion controller about a lost packet, once per loss episode. The caller must hold self._cond.
+    def _on_loss(self):
+        if self._cc_recover is None:
+            self._cc.on_loss(len(self._buffer_packets))
+            self._cc_recover = self._seq_num
+            if self._tracer is not None:
+                self._trace("congestion", cause="loss", cwnd=finite(self._cc.cwnd), ssthresh=finite(self._cc.ssthresh))
+
+    # Called by the retransmission timer from its own thread when it expires. While the window of the other side is
+    # closed, or a window probe is waiting for it to open, it is the persist timer instead.
+    def _on_timeout(self):
+        with self._cond:
+            # The timer was restarted by an ACK that arrived just before this call
+            if self._timer.running:
+                return
+
+            # Persist timer: the window is still closed. Send the oldest unacknowledged packet again as a window probe,
+            # or, with nothing outstanding, open the window by one segment, which send sends as one. The other side
+            # answers it with its current window. This is no congestion signal: the timeout is backed off, but neither
+            # the congestion window nor the retransmission timeout is touched.
+            if self._window_b == 0 or self._persist_backoffs > 0:
+                if self._persist_interval() < MAX_RTO:
+                    self._persist_backoffs += 1
+                if len(self._buffer_packets) > 0:
+                    self._probe()
+                    self._timer.start(self._persist_interval())
+                elif self._window_b == 0:
+                    self._window_b = 1
+                    self.stats.window_probes += 1
+                    self._cond.notify_all()
+                return
+
+            if len(self._buffer_packets) == 0:
+                return
+
+            # Timeout: Resend the oldest unacknowledged packet and restart the timer with a doubled timeout. Any
+            # retransmission may have been lost as well, so the lost packets are eligible to be resent again.
+            self.stats.timeouts += 1
+            self._rto.backoff()
+            self._cc.on_timeout(len(self._buffer_packets))
+            if self._tracer is not None:
+                self._trace("timeout", seq_num=self._ack_num, rto=self._rto.rto, in_flight=len(self._buffer_packets))
+                self._trace("congestion", cause="timeout", cwnd=finite(self._cc.cwnd),
+                            ssthresh=finite(self._cc.ssthresh))
+            self._cc_recover = self._seq_num
+            self._recover = self._seq_num
+            self._retransmitted.clear()
+            self._retransmit(0)
+            self._timer.start(self._rto.rto)
+
+    # Build the parity segment of the current block, and adapt the block size to the loss rate. The caller must hold
+    # self._cond.
+    def _build_parity(self):
+        first = self._parity.first
+        parity = self._parity.finish()
+        self._blocks.append((first, self._seq_num))
+        self.stats.parity_sent += 1
+
+        # Both retransmitted and repaired packets were lost
+        sent = self._seq_num - self._fec_seq
+        if self._redundancy.adaptive and sent >= self._redundancy.block:
+            losses = self.stats.retransmissions + self._repaired
+            self._redundancy.update(sent, losses - self._fec_losses)
+            self._fec_seq = self._seq_num
+            self._fec_losses = losses
+
+        return self.build_segment(first, 0, PARITY, self._window_a, len(parity), parity)
+
+    # Send data originating from the application in a reliable way to the other side. data can be any bytes-like
+    # object, such as an mmap of the file to send: it is split into memoryview slices, so it is never copied.
+    # With compression, the data is sent as frames, one chunk at a time. send returns once all data has been
+    # acknowledged; with wait unset it returns as soon as the last segment has been sent, so that the next send follows
+    # without waiting for a round trip. The data must then stay unchanged until flush returns.
+    def send(self, data, wait=True):
+        data = memoryview(data).cast("B")
+
+        with self._cond:
+            for buffer in self._buffers(data):
+                index = 0
+                end = False
+
+                while not end:
+                    index, end, sent = self._fill_window(buffer, index, end)
+
+                    # The window is full: sleep until an ACK arrives. Retransmissions are taken care of by the
+                    # retransmission timer.
+                    if not sent:
+                        self._cond.wait()
+
+            if wait:
+                self.flush()
+
+    # Sleep until everything that has been sent is acknowledged
+    def flush(self):
+        with self._cond:
+            while len(self._buffer_packets) > 0:
+                self._cond.wait()
+
+    # Return the buffers to send for data: the frames of data with compression, data itself without
+    def _buffers(self, data):
+        if self._encoder is None:
+            return [data]
+
+        return self._encoder.frames(data)
+
+    # Fill the open part of the window with segments of data, starting at index, and put the new segments on the
+    # network as one batch. Every segment carries the ACK number and window of the receiving half, so no separate
+    # ACK is needed while data flows in both directions. Returns the new index, whether the end of the data was
+    # reached, and whether anything was sent. The caller must hold self._cond.
+    def _fill_window(self, data, index, end):
+        batch = []
+        ack_num = None
+
+        # This takes care of the last block of data which may be shorter than the maximum segment size
+        # and the case when the data is shorter the the maximum segment size. When the other side advertised a zero
+        # window nothing is sent until its window update arrives, or the persist timer opens the window for a window
+        # probe in case that update was lost (see _on_timeout). The congestion window limits the packets in flight as
+        # well. With forward error correction a parity segment follows every block of data segments; it has to fit in
+        # the maximum segment size as well.
+        mss = self._mss if self._redundancy is None else self._mss - codec.PARITY_HEADER.size
+        window = min(self._window_b, self._cc.window)
+        while not end and len(self._buffer_packets) < window:
+            if index + mss >= len(data):
+                data_packet = data[index:len(data)]
+                end = True
+            else:
+                data_packet = data[index:index + mss]
+                index += mss
+
+            if ack_num is None:
+                ack_num, receive_window = self._piggyback()
+
+            segment_packet = self.build_segment_parts(self._seq_num, ack_num, 0, receive_window, 0, data_packet)
+            self._buffer_packets.append(segment_packet)
+            batch.append(segment_packet)
+            self.stats.bytes_sent += len(data_packet)
+            if self._tracer is not None:
+                self._trace("packet_sent", seq_num=self._seq_num, length=len(data_packet))
+
+            # Time this segment if no other segment is being timed
+            if self._rtt_seq is None:
+                self._rtt_seq = self._seq_num
+                self._rtt_start = self._now()
+
+            if self._redundancy is not None:
+                self._parity.add(self._seq_num, data_packet)
+
+            self._seq_num += 1
+
+            if self._redundancy is not None and (self._parity.count >= self._redundancy.block or end):
+                batch.append(self._build_parity())
+
+        if len(batch) > 0:
+            # Normal: Send the segments and start timer (if not started yet). A window probe waits for the persist
+            # interval instead.
+            if not self._timer.running:
+                self._timer.start(self._persist_interval())
+
+            self._lossy_layer.send_segments(batch)
+            self.stats.segments_sent += len(batch)
+        elif not end:
+            # Window stall: data is waiting, but the window of the other side or the congestion window is full
+            if len(self._buffer_packets) == 0 and not self._timer.running:
+                self._timer.start(self._persist_interval())
+            self.stats.window_stalls += 1
+            if self._tracer is not None:
+                self._trace("window_stall", in_flight=len(self._buffer_packets), window=self._window_b,
+                            cwnd=finite(self._cc.cwnd))
+
+        return index, end, len(batch) > 0
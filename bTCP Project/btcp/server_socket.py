@@ -1,142 +1,337 @@
 # Onno de Gouw
 # Stefan Popa
 
-import struct
 import random
+import threading
+from collections import deque
 
 from socket import *
 from btcp.lossy_layer import LossyLayer
+from btcp.impairment import ImpairedLayer
+from btcp import codec
 from btcp.btcp_socket import BTCPSocket
+from btcp.sender import BTCPSender
+from btcp.receiver import BTCPReceiver
+from btcp.timer import RetransmissionTimer
+from btcp.stats import Tracer, finite
+from btcp.compression import FrameDecoder, parse_compression_option
+from btcp.resume import ChunkIndex, held_option
 from btcp.constants import *
 
 
-# The bTCP server socket
-# A server application makes use of the services provided by bTCP by calling accept, recv, and close
-class BTCPServerSocket(BTCPSocket):
-    def __init__(self, window, timeout):
+# Sends the segments of one connection through the lossy layer of the listening socket, to the client of that
+# connection
+class _ConnectionLayer:
+    def __init__(self, lossy_layer, address):
+        self._lossy_layer = lossy_layer
+        self._address = address
+
+    def send_segment(self, segment):
+        self.send_segments([segment])
+
+    def send_segments(self, segments):
+        self._lossy_layer.send_segments(segments, self._address)
+
+    # The lossy layer belongs to the listening socket, which destroys it
+    def destroy(self):
+        pass
+
+
+# A connection accepted by the bTCP server socket, holding all state of the transfer from one client
+# A server application makes use of it by calling recv (or recv_into or recv_to_file), send and close. Its counters
+# are in stats and info returns them together with the current state of the connection. Its events are written to
+# tracer (a stats.Tracer shared by the connections of a server socket, or None); with profile set it times the stages
+# of the hot path in profile. With accept_fec and accept_compression set it accepts forward error correction and
+# compression of the data of the client when the client asks for them. The data the connection sends back uses
+# congestion_control, without either. The receive window starts at window segments and autotunes up to a memory
+# budget of buffer_size bytes (see btcp.receiver).
+class BTCPServerConnection(BTCPSender, BTCPReceiver, BTCPSocket):
+    def __init__(self, listener, lossy_layer, address, window, timeout, ack_every=ACK_EVERY, ack_delay=ACK_DELAY,
+                 mss=MAX_PAYLOAD_SIZE, tracer=None, profile=False, accept_fec=True, accept_compression=True,
+                 resume=None, congestion_control="reno", buffer_size=RECV_BUFFER_SIZE):
         super().__init__(window, timeout)
-        self._lossy_layer = LossyLayer(self, SERVER_IP, SERVER_PORT, CLIENT_IP, CLIENT_PORT)
+        self._listener = listener
+        self._lossy_layer = lossy_layer
+        # The address of the client
+        self.address = address
         self._connected = False
-        self._window_b = 0
-        self._buffer_packets = []
-        self._seq_num = 0
-
-    # A method the checks if the received segment has the correct checksum
-    def check_cksum(self, segment):
-        if self.in_cksum(segment) == 0:
-            return True
-
-        return False
-
-    # A method that builds the header for a segment
-    def build_header(self, seq_num, ack_num, flags, window, data_length, data):
-        header = struct.pack("HHBBhH",
-                             seq_num,
-                             ack_num,
-                             flags,
-                             window,
-                             data_length,
-                             0)
-
-        myChecksum = self.in_cksum(header + data)
-        myChecksum = htons(myChecksum) & 0xffff
-
-        header = struct.pack("HHBBhH",
-                             seq_num,
-                             ack_num,
-                             flags,
-                             window,
-                             data_length,
-                             myChecksum)
-
-        return header
-
-    # A method that builds a bTCP segment
-    def build_segment(self, seq_num, ack_num, flags, window, data_length, data):
-        header = self.build_header(seq_num, ack_num, flags, window, data_length, data)
-        segment = header + data
-
-        return segment
-
-    # A method that unpacks the received segment
-    def unpack_segment(self, segment):
-        header = segment[:HEADER_SIZE]
-        data = segment[HEADER_SIZE:]
-
-        seq_num, ack_num, flags, window, data_length, checksum = struct.unpack("HHBBhH", header)
+        # Maximum segment size: the largest this connection accepts, and the one agreed with the client
+        self._max_mss = mss
+        self._mss = min(mss, PAYLOAD_SIZE)
+        self._init_sender(timeout, congestion_control)
+        self._init_receiver(ack_every, ack_delay, buffer_size)
+        # The SYN+ACK, kept to answer a retransmitted SYN with the same initial sequence number and options, and the
+        # time it was sent (in ms) until the client answers it, which gives the receiving half its round-trip time
+        self._synack = None
+        self._synack_time = None
+        self._accept_fec = accept_fec
+        self._accept_compression = accept_compression
+        # Resumable transfers (see btcp.resume): the callable that returns the chunks of an offered ChunkIndex that
+        # are already held, or None to refuse, and once agreed on the offered index and the chunks held
+        self._resume = resume
+        self.resume_index = None
+        self.resume_held = None
+        # Guards the state above; signalled whenever lossy_layer_input changes it
+        self._cond = threading.Condition()
+        self._instrument("{}:{}".format(*address), tracer, profile)
+
+    # Create a timer that calls callback (the delayed ACK timer and the retransmission timer). The asyncio connection
+    # overrides this to run them on the event loop.
+    def _create_timer(self, callback):
+        return RetransmissionTimer(callback)
+
+    # Called by the listening socket whenever a segment of this connection arrives
+    def lossy_layer_input(self, segment, address):
+        with self._cond:
+            self._handle_segment(segment, address)
 
-        return seq_num, ack_num, flags, window, data_length, checksum, header, data
+            # Wake up recv or send, which sleep until data or an ACK arrives
+            self._cond.notify_all()
 
-    # Called by the lossy layer from another thread whenever a segment arrives
-    def lossy_layer_input(self, segment, address):
+    # Process an incoming segment. The caller must hold self._cond.
+    def _handle_segment(self, segment, address):
         recv = False
+        self.stats.segments_received += 1
 
         # Normal: If correct segment arrives, send and ACK for the segment
-        if self.check_cksum(segment):
-            seq_num_x_1, _, flags_1, self._window_b, _, _, inp_header_1, inp_data_1 = self.unpack_segment(segment)
-
-            # Handshake: SYN flag received
+        valid = self.check_cksum(segment)
+        if valid:
+            inp_segment = self.unpack_segment(segment)
+            seq_num_x_1, flags_1, inp_data_1 = inp_segment.seq_num, inp_segment.flags, inp_segment.data
+
+            # Restore the full sequence number around the one expected next, and the full ACK number around the
+            # oldest unacknowledged one. A SYN carries a new initial sequence number.
+            if flags_1 != SYN:
+                seq_num_x_1 = codec.unwrap(seq_num_x_1, self._recv_seq)
+            ack_num = codec.unwrap(inp_segment.ack_num, self._ack_num)
+            if self._tracer is not None:
+                self._trace("packet_received", flags=flags_1, seq_num=seq_num_x_1, length=len(inp_data_1))
+
+            # The first segment after the SYN+ACK, the ACK of the handshake or the data that follows it when that ACK
+            # was lost, completes the round trip of the handshake
+            if flags_1 != SYN and self._synack_time is not None:
+                self._recv_rtt = self._now() - self._synack_time
+                self._synack_time = None
+                if self._tracer is not None:
+                    self._trace("rtt_sample", receive_rtt=self._recv_rtt)
+
+            # Handshake: SYN flag received. A retransmitted SYN gets the same answer.
             if flags_1 == SYN:
                 recv = True
-                self._connected = True
-                self._seq_num = seq_num_x_1 + 1
-
-                seq_num_y = random.getrandbits(16)
-                segment_packet = self.build_segment(seq_num_y, self._seq_num, SYNACK, self._window_a, 0, struct.pack("d", 0))
-
-                self._lossy_layer.send_segment(segment_packet)
-
-            # Handshake: If the segment with the ACK flag set in the three way handshake was received, simply
-            # drop this segment
-            if flags_1 == ACK:
+                if self._synack is None:
+                    self._synack = self._accept_syn(inp_segment)
+                    self._synack_time = self._now()
+                else:
+                    # Karn's rule: the answer to a retransmitted SYN+ACK is no RTT sample
+                    self._synack_time = None
+
+                self._lossy_layer.send_segment(self._synack)
+                self.stats.segments_sent += 1
+
+            # An ACK: the last step of the handshake, or an acknowledgement of the data sent to the client with the
+            # SACK blocks as its data
+            elif flags_1 == ACK:
                 recv = True
-
-            # Connection termination: FIN flag received
-            if flags_1 == FIN:
-                segment_packet = self.build_segment(0, self._seq_num + 1, FINACK, self._window_a, 0, struct.pack("d", 0))
-
-                self._lossy_layer.send_segment(segment_packet)
+                self._on_ack(ack_num, inp_segment.window, inp_data_1[:inp_segment.data_length])
+
+            # Connection termination: FIN flag received after all data has arrived. A FIN that overtook some data
+            # is treated like any other out-of-order segment, so the client retransmits the missing data first. It
+            # acknowledges the data sent to the client as well.
+            elif flags_1 == FIN:
+                self._on_ack(ack_num, inp_segment.window)
+                if seq_num_x_1 == self._recv_seq:
+                    segment_packet = self.build_segment(self._seq_num, self._recv_seq + 1, FINACK,
+                                                        self._advertise(), 0, b"")
+
+                    self._lossy_layer.send_segment(segment_packet)
+                    self.stats.segments_sent += 1
+                    recv = True
+                    self._connected = False
+                    self._finished = True
+
+                    # The FIN+ACK acknowledges all data as well
+                    self._unacked = 0
+                    self._ack_timer.stop()
+
+            # Parity: keep it until its block is complete, it may rebuild a lost segment of the block
+            elif flags_1 == PARITY:
                 recv = True
-                self._connected = False
 
-            if seq_num_x_1 == self._seq_num:
-                segment_packet = self.build_segment(0, self._seq_num + 1, ACK, self._window_a - len(self._buffer_packets) - 1,
-                                                    0, struct.pack("d", 0))
+                if self._fec_agreed and seq_num_x_1 not in self._parities:
+                    self._parities[seq_num_x_1] = inp_data_1
+                    self._repair()
 
-                self._lossy_layer.send_segment(segment_packet)
-                self._seq_num += 1
+            # Data: deliver an in-order segment together with the buffered segments that follow it, and keep an
+            # out-of-order segment that fits in the window until the gap before it has been filled. Its ACK number
+            # and window acknowledge the data sent to the client.
+            else:
                 recv = True
+                self._on_ack(ack_num, inp_segment.window)
+                self._receive_data(seq_num_x_1, inp_data_1)
 
-                self._buffer_packets.append(inp_data_1)
+                if len(self._parities) > 0:
+                    self._repair()
 
         # Previously received segment/ checksum check fail segment / Out-of-order segment:
         # Fast Retransmit process start / Send an ACK and drop packet
         if not recv and self._connected:
-            segment_packet = self.build_segment(0, self._seq_num, ACK, self._window_a - len(self._buffer_packets),
-                                                0, struct.pack("d", 0))
+            self._send_ack()
 
-            self._lossy_layer.send_segment(segment_packet)
+        if not valid:
+            self.stats.checksum_failures += 1
+            if self._tracer is not None:
+                self._trace("checksum_failure", length=len(segment))
 
         self._src_adress = address
 
-    # Wait for the client to initiate a three-way handshake
-    def accept(self):
-        while True:
-            if self._connected:
-                break
+    # Accept the connection requested by a SYN and return the SYN+ACK. It carries the initial sequence number of the
+    # data sent to the client. The caller must hold self._cond.
+    def _accept_syn(self, inp_segment):
+        self._connected = True
+        self._recv_seq = inp_segment.seq_num + 1
+        self._window_b = inp_segment.window
+
+        # Accept the maximum segment size proposed by the client, up to our own limit, and forward error
+        # correction if the client asks for it and we allow it
+        self._mss = min(self._max_mss, codec.mss_option(inp_segment))
+        options = codec.decode_options(inp_segment)
+        self._fec_agreed = self._accept_fec and OPTION_FEC in options
+        accepted = {OPTION_FEC: b""} if self._fec_agreed else {}
+
+        # Compression, if the client asks for a method we know and we allow it
+        method = None
+        if self._accept_compression and OPTION_COMPRESSION in options:
+            method = parse_compression_option(options[OPTION_COMPRESSION])
+        if method is not None:
+            self._decoder = FrameDecoder(method[0])
+            accepted[OPTION_COMPRESSION] = options[OPTION_COMPRESSION]
+
+        # Resuming, if the client offers the index of its file and we hold part of a previous transfer of it
+        index = None
+        if self._resume is not None and OPTION_RESUME in options:
+            index = ChunkIndex.parse(options[OPTION_RESUME])
+        if index is not None:
+            self.resume_index = index
+            self.resume_held = self._resume(index)
+            accepted[OPTION_RESUME] = held_option(self.resume_held, len(index.hashes))
+        option = codec.encode_options(self._mss, accepted)
+
+        seq_num_y = random.getrandbits(16)
+        self._seq_num = self._ack_num = seq_num_y + 1
+
+        return self.build_segment(seq_num_y, self._recv_seq, SYNACK, self._advertise(), len(option), option)
+
+    # Return the counters of the connection together with its current state, like TCP_INFO: the free receive window,
+    # the segments waiting to be read and in the reorder buffer (in segments), the bytes waiting to be read, the
+    # current memory budget and the maximum segment size (in bytes), and the round-trip time of the handshake (in ms).
+    # For the data sent to the client, the round-trip time estimates and retransmission timeout (in ms), the
+    # congestion window and slow start threshold, the window advertised by the client and the segments in flight.
+    def info(self):
+        with self._cond:
+            info = self.stats.as_dict()
+            info.update(window=self._free_window(), buffered=len(self._recv_queue),
+                        reorder_buffer=len(self._out_of_order), buffered_bytes=self._recv_bytes,
+                        buffer_size=self._budget(), mss=self._mss, receive_rtt=self._recv_rtt, srtt=self._rto.srtt,
+                        rttvar=self._rto.rttvar, rto=self._rto.rto, cwnd=finite(self._cc.cwnd),
+                        ssthresh=finite(self._cc.ssthresh), send_window=self._window_b,
+                        in_flight=len(self._buffer_packets))
+
+        return info
+
+    # Clean up any state. Segments that arrive from the same client afterwards are treated as a new connection request.
+    def close(self):
+        self._ack_timer.destroy()
+        self._timer.destroy()
+        self._listener._remove_connection(self.address)
+
+
+# The bTCP server socket
+# It receives the segments of all clients on one port and demultiplexes them by the address of the client into
+# connections. A server application makes use of the services provided by bTCP by calling accept, which returns
+# a BTCPServerConnection for every client, and close. ack_every and ack_delay set the delayed ACK policy of the
+# connections, mss the largest maximum segment size they accept. impairment describes the network impairments to
+# emulate on the segments sent (see btcp.impairment), or is None. Given a file as trace, the events of all connections
+# are written to it as JSON lines; with profile set every connection times the stages of its hot path. accept_fec
+# and accept_compression tell whether connections accept forward error correction and compression. resume makes
+# connections agree to resume transfers (see btcp.resume): called with the ChunkIndex a client offers, it returns the
+# chunks of it that are already held, like Manifest.held. congestion_control is used for the data the connections
+# send to their clients. The receive window of the connections starts at window segments and autotunes up to a
+# memory budget of buffer_size bytes.
+class BTCPServerSocket(BTCPSocket):
+    def __init__(self, window, timeout, address=(SERVER_IP, SERVER_PORT), ack_every=ACK_EVERY, ack_delay=ACK_DELAY,
+                 mss=MAX_PAYLOAD_SIZE, impairment=None, trace=None, profile=False, accept_fec=True,
+                 accept_compression=True, resume=None, congestion_control="reno", buffer_size=RECV_BUFFER_SIZE):
+        super().__init__(window, timeout)
+        self._address = address
+        self._congestion_control = congestion_control
+        self._buffer_size = buffer_size
+        self._impairment = impairment
+        self._tracer = Tracer(trace) if trace is not None else None
+        self._profile = profile
+        self._accept_fec = accept_fec
+        self._accept_compression = accept_compression
+        self._resume = resume
+        self._ack_every = ack_every
+        self._ack_delay = ack_delay
+        self._mss = mss
+        self._connections = {}
+        # Connections whose SYN has arrived but that have not been returned by accept yet
+        self._accept_queue = deque()
+        # Guards the state above; signalled whenever a new connection is requested
+        self._cond = threading.Condition()
+        # The lossy layer starts receiving before it is assigned here; until then connection requests are dropped
+        self._lossy_layer = None
+        self._lossy_layer = self._create_lossy_layer()
+
+    # Create the lossy layer and the connections. The asyncio server overrides these to use an asyncio transport.
+    def _create_lossy_layer(self):
+        if self._impairment is not None:
+            return ImpairedLayer(self, self._address[0], self._address[1], None, None, self._impairment)
+
+        return LossyLayer(self, self._address[0], self._address[1], None, None)
+
+    def _create_connection(self, address):
+        return BTCPServerConnection(self, _ConnectionLayer(self._lossy_layer, address), address,
+                                    self._window_a, self._timeout, self._ack_every, self._ack_delay, self._mss,
+                                    self._tracer, self._profile, self._accept_fec, self._accept_compression,
+                                    self._resume, self._congestion_control, self._buffer_size)
+
+    # Called by the lossy layer from another thread whenever a segment arrives: hand it to the connection of the
+    # client it came from. A SYN from an unknown client creates a new connection, which is handed out by accept once
+    # it has processed the SYN, so that the options agreed on are known.
+    def lossy_layer_input(self, segment, address):
+        with self._cond:
+            connection = self._connections.get(address)
+            new = connection is None
+
+            if new:
+                if (self._lossy_layer is None or not self.check_cksum(segment)
+                        or self.unpack_segment(segment).flags != SYN):
+                    return
+
+                connection = self._create_connection(address)
+                self._connections[address] = connection
+
+        connection.lossy_layer_input(segment, address)
+
+        if new:
+            with self._cond:
+                self._accept_queue.append(connection)
+                self._cond.notify_all()
 
-    # Send any incoming data to the application layer
-    @property
-    def recv(self):
-        while True:
-            if len(self._buffer_packets) != 0:
-                inp_data = self._buffer_packets.pop(0)
+    # Wait for a client to initiate a three-way handshake and return its connection. Raises TimeoutError if no
+    # client connected within timeout seconds (None waits forever).
+    def accept(self, timeout=None):
+        with self._cond:
+            if not self._cond.wait_for(lambda: len(self._accept_queue) > 0, timeout):
+                raise TimeoutError("no bTCP connection request received")
 
-                if self._connected:
-                    return inp_data
+            return self._accept_queue.popleft()
 
-                return
+    def _remove_connection(self, address):
+        with self._cond:
+            self._connections.pop(address, None)
 
     # Clean up any state
     def close(self):
-        self._lossy_layer.destroy()
\ No newline at end of file
+        self._lossy_layer.destroy()
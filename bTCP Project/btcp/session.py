@@ -0,0 +1,138 @@
+# Onno de Gouw
+# Stefan Popa
+
+import mmap
+import os
+import struct
+
+from btcp.constants import *
+
+
+# Sessions: many files or messages over one connection. Every record is sent as a header with the length of its name
+# and the size of its data, followed by the name (UTF-8) and the data. The client pipelines the records: it sends the
+# next record without waiting for the previous one to be acknowledged, so a batch of small files takes one handshake
+# and about one round trip in total instead of a handshake, a round trip and a termination handshake per file. The
+# server reads the records off the delivery queue of its connection one after the other.
+
+# Length of the name and size of the data of a record
+RECORD = struct.Struct("HQ")
+
+
+# Send a record named name with data, any bytes-like object, over the connected client socket. The record is only
+# sent, not acknowledged: data must stay unchanged until client.flush or client.disconnect returns. A small record is
+# joined with its header, so that it does not take a segment of its own.
+def send_record(client, name, data):
+    name = name.encode()
+    header = RECORD.pack(len(name), len(data)) + name
+
+    if len(data) <= SESSION_JOIN_SIZE:
+        client.send(header + bytes(data), wait=False)
+    else:
+        client.send(header, wait=False)
+        client.send(data, wait=False)
+
+
+# Send the file at path as a record named name. Small files are read into memory; larger ones are memory-mapped and
+# acknowledged before the mapping is closed, which costs one round trip per large file.
+def send_file(client, path, name):
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size <= SESSION_READ_SIZE:
+            send_record(client, name, file.read())
+            return
+
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            send_record(client, name, data)
+            client.flush()
+
+
+# Return the path and record name of every file to send for inputs, a list of files and directories. A file is
+# named after itself, the files in a directory (and below) by their path relative to it, with / as separator.
+def input_files(inputs):
+    files = []
+    for path in inputs:
+        if not os.path.isdir(path):
+            files.append((path, os.path.basename(path)))
+            continue
+
+        for directory, directories, names in os.walk(path):
+            directories.sort()
+            for name in sorted(names):
+                file_path = os.path.join(directory, name)
+                files.append((file_path, os.path.relpath(file_path, path).replace(os.sep, "/")))
+
+    return files
+
+
+# Send every file of inputs (see input_files) as a record over the connected client socket and wait until all of them
+# have been acknowledged
+def send_files(client, inputs):
+    for path, name in input_files(inputs):
+        send_file(client, path, name)
+
+    client.flush()
+
+
+# Return the next nbytes of data on connection. Returns None if the client closed the connection before sending any of
+# them and at_end is set, and raises EOFError if it closed it otherwise.
+def _recv_exactly(connection, nbytes, at_end=False):
+    buffer = bytearray(nbytes)
+    received = 0
+
+    while received < nbytes:
+        count = connection.recv_into(memoryview(buffer)[received:])
+        if count == 0:
+            if received == 0 and at_end:
+                return None
+            raise EOFError("bTCP session ended in the middle of a record")
+        received += count
+
+    return buffer
+
+
+# Return the name and size of the next record on connection, or None once the client has closed the connection. The
+# data of the record must be read next, for example with recv_to_file(file, nbytes=size).
+def recv_record_header(connection):
+    header = _recv_exactly(connection, RECORD.size, True)
+    if header is None:
+        return None
+
+    name_length, size = RECORD.unpack(header)
+
+    return _recv_exactly(connection, name_length).decode(), size
+
+
+# Return the name and data of the next record on connection, or None once the client has closed the connection
+def recv_record(connection):
+    header = recv_record_header(connection)
+    if header is None:
+        return None
+
+    return header[0], bytes(_recv_exactly(connection, header[1]))
+
+
+# Return the path below directory for a record name, refusing names that would lead out of it
+def _output_path(directory, name):
+    parts = name.split("/")
+    if any(part in ("", ".", "..") or os.sep in part or (os.altsep and os.altsep in part) for part in parts):
+        raise ValueError("unsafe record name: {!r}".format(name))
+
+    return os.path.join(directory, *parts)
+
+
+# Receive records into files below directory until the client closes the connection, and return their names. Every
+# record is written straight from the delivery queue to its file with vectored writes.
+def receive_files(connection, directory):
+    names = []
+
+    while True:
+        header = recv_record_header(connection)
+        if header is None:
+            return names
+
+        name, size = header
+        path = _output_path(directory, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as file:
+            if connection.recv_to_file(file, nbytes=size) != size:
+                raise EOFError("bTCP session ended in the middle of a record")
+        names.append(name)
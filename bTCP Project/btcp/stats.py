@@ -0,0 +1,76 @@
+# Onno de Gouw
+# Stefan Popa
+
+import json
+import threading
+import time
+
+
+# Counters of one connection, in the spirit of TCP_INFO. The sockets update them unconditionally: an attribute
+# increment is cheap enough for the hot path. The info method of a socket combines them with its current state, like
+# the round-trip time and the windows.
+class ConnectionStats:
+    __slots__ = ("segments_sent", "segments_received", "bytes_sent", "bytes_acked", "bytes_received",
+                 "retransmissions", "fast_retransmits", "timeouts", "duplicate_acks", "checksum_failures",
+                 "out_of_order", "out_of_window", "duplicates", "acks_sent", "delayed_acks", "acks_piggybacked",
+                 "window_stalls", "window_updates", "window_probes", "parity_sent",
+                 "fec_recovered")
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, 0)
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+# Return value, or None if it is infinite (like the congestion window without congestion control), so that it can be
+# written as JSON
+def finite(value):
+    return None if value == float("inf") else value
+
+
+# Writes a trace of the events of one or more connections as JSON lines, loosely following qlog: every line holds
+# the time in ms since the tracer was created, the connection, the name of the event and its data. Sockets only
+# call event when they have a tracer, so tracing costs nothing while it is off.
+class Tracer:
+    def __init__(self, file):
+        self._file = file
+        self._start = time.monotonic()
+        # Connections of a server socket share one tracer, from different threads
+        self._lock = threading.Lock()
+
+    def event(self, connection, name, **data):
+        line = json.dumps({"time": round((time.monotonic() - self._start) * 1000, 3), "connection": connection,
+                           "name": name, "data": data})
+
+        with self._lock:
+            self._file.write(line + "\n")
+
+
+# Time spent in the stages of the hot path (build, checksum, send and dispatch). A socket that profiles replaces the
+# methods of those stages by timed wrappers, so profiling costs nothing while it is off. The time of a stage
+# includes the stages it calls: dispatching an incoming segment includes sending the ACK for it.
+class StageProfile:
+    def __init__(self):
+        # Stage name: [number of calls, total time in seconds]
+        self.stages = {}
+
+    # Return function wrapped so that its calls are timed as stage
+    def wrap(self, stage, function):
+        totals = self.stages.setdefault(stage, [0, 0.0])
+        perf_counter = time.perf_counter
+
+        def timed(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                totals[0] += 1
+                totals[1] += perf_counter() - start
+
+        return timed
+
+    def as_dict(self):
+        return {stage: {"calls": calls, "seconds": seconds, "us_per_call": seconds / calls * 1e6 if calls else 0}
+                for stage, (calls, seconds) in self.stages.items()}
@@ -0,0 +1,124 @@
+# Onno de Gouw
+# Stefan Popa
+
+import mmap
+import multiprocessing
+import os
+import struct
+
+from btcp.client_socket import BTCPClientSocket
+from btcp.server_socket import BTCPServerSocket
+from btcp.constants import *
+
+
+# Striped transfers: the file is split into one contiguous range (stripe) per connection, and every stripe is carried
+# by its own bTCP connection, to port SERVER_PORT + i of the server for stripe i. Every connection runs in a worker
+# process of its own on either side, so the transfer is not limited by one Python thread. A stripe starts with its
+# offset and length and the size of the file; the server preallocates the output file and every worker writes its
+# stripe straight to its place in the file with positional writes, so nothing is reassembled in memory.
+
+# Offset and length of the stripe, and size of the file
+STRIPE_HEADER = struct.Struct("QQQ")
+
+
+# Return the offset and length of each of count stripes of a file of size bytes. Stripes are multiples of the page
+# size, so that every worker can map its own stripe of the file.
+def stripes(size, count):
+    length = -(-size // count // mmap.ALLOCATIONGRANULARITY) * mmap.ALLOCATIONGRANULARITY
+    offsets = [min(index * length, size) for index in range(count + 1)]
+
+    return [(offsets[index], offsets[index + 1] - offsets[index]) for index in range(count)]
+
+
+# Make sure the file takes size bytes, with the blocks allocated up front where the file system supports it
+def _preallocate(fd, size):
+    if size == 0:
+        return
+
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError:
+            pass
+
+    if os.fstat(fd).st_size < size:
+        os.ftruncate(fd, size)
+
+
+# Worker of the client: send one stripe of the file at path to address. Exits with status 1 if the connection could
+# not be established.
+def _send_stripe(path, offset, length, address, window, timeout, options):
+    client = BTCPClientSocket(window, timeout, address, **options)
+    if client.connect() == 0:
+        client.close()
+        raise SystemExit(1)
+
+    with open(path, "rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        client.send(STRIPE_HEADER.pack(offset, length, size))
+
+        if length > 0:
+            with mmap.mmap(file.fileno(), length, access=mmap.ACCESS_READ, offset=offset) as data:
+                client.send(data)
+
+    client.disconnect()
+    client.close()
+
+
+# Worker of the server: receive one stripe on address and write it to its place in the file at path. Exits with
+# status 1 if the stripe is incomplete.
+def _receive_stripe(path, address, window, timeout, options):
+    server = BTCPServerSocket(window, timeout, address, **options)
+    connection = server.accept()
+
+    header = bytearray(STRIPE_HEADER.size)
+    received = 0
+    while received < len(header):
+        count = connection.recv_into(memoryview(header)[received:])
+        if count == 0:
+            raise SystemExit(1)
+        received += count
+    offset, length, size = STRIPE_HEADER.unpack(header)
+
+    with open(path, "r+b") as file:
+        _preallocate(file.fileno(), size)
+        written = connection.recv_to_file(file, offset=offset)
+
+    connection.close()
+    server.close()
+
+    if written != length:
+        raise SystemExit(1)
+
+
+# Run a worker process per set of arguments and return whether all of them succeeded
+def _run_workers(target, arguments):
+    workers = [multiprocessing.Process(target=target, args=args) for args in arguments]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    return all(worker.exitcode == 0 for worker in workers)
+
+
+# Send the file at path over count connections to the server at address, which must receive it with
+# receive_file_striped and the same count. options are passed on to BTCPClientSocket. Returns whether every stripe
+# was sent.
+def send_file_striped(path, count, window, timeout, address=(SERVER_IP, SERVER_PORT), **options):
+    size = os.stat(path).st_size
+    host, port = address
+
+    return _run_workers(_send_stripe, [(path, offset, length, (host, port + index), window, timeout, options)
+                                       for index, (offset, length) in enumerate(stripes(size, count))])
+
+
+# Receive a file sent with send_file_striped over count connections on the ports from address on, and write it to
+# path. options are passed on to BTCPServerSocket. Returns whether every stripe was received completely.
+def receive_file_striped(path, count, window, timeout, address=(SERVER_IP, SERVER_PORT), **options):
+    host, port = address
+    open(path, "wb").close()
+
+    return _run_workers(_receive_stripe, [(path, (host, port + index), window, timeout, options)
+                                          for index in range(count)])
@@ -0,0 +1,106 @@
+# Onno de Gouw
+# Stefan Popa
+
+import threading
+import time
+
+from btcp.constants import *
+
+
+# Estimates the retransmission timeout from round-trip time samples as described in RFC 6298. All times are in
+# milliseconds. The initial timeout is the one given on the command line; it is only used until the first sample.
+class RTOEstimator:
+    def __init__(self, initial_rto):
+        self.srtt = None
+        self.rttvar = None
+        self._base_rto = initial_rto
+        self._backoffs = 0
+
+    # The current retransmission timeout, including the exponential backoff
+    @property
+    def rto(self):
+        return min(self._base_rto * 2 ** self._backoffs, MAX_RTO)
+
+    # Process a round-trip time sample. Following Karn's rule, the caller must not take samples from segments that
+    # were retransmitted.
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - RTO_BETA) * self.rttvar + RTO_BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - RTO_ALPHA) * self.srtt + RTO_ALPHA * rtt
+
+        self._base_rto = min(max(self.srtt + max(RTO_GRANULARITY, 4 * self.rttvar), MIN_RTO), MAX_RTO)
+        self._backoffs = 0
+
+    # Double the timeout after it expired (exponential backoff)
+    def backoff(self):
+        if self.rto < MAX_RTO:
+            self._backoffs += 1
+
+    # Undo the backoff once the connection makes progress again. Without this, a recovery in which every ACK
+    # covers a retransmitted segment (and therefore yields no sample) would keep the doubled timeout. Before the
+    # first sample the backoff is all there is to go by: when the initial timeout is shorter than the round-trip
+    # time, every segment times out before its ACK arrives, so no sample is ever taken.
+    def reset_backoff(self):
+        if self.srtt is not None:
+            self._backoffs = 0
+
+
+# A timer that calls callback from its own thread once it expires, independently of any segments arriving.
+# The callback is run without holding the timer's lock, so it may restart or stop the timer itself. Because the
+# timer can be restarted right after it expired, the callback should check running before acting on the expiry.
+class RetransmissionTimer:
+    def __init__(self, callback):
+        self._callback = callback
+        self._cond = threading.Condition()
+        self._deadline = None
+        self._destroyed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    # (Re)start the timer so that it expires after timeout milliseconds
+    def start(self, timeout):
+        with self._cond:
+            self._deadline = time.monotonic() + timeout / 1000
+            self._cond.notify()
+
+    # Stop the timer without calling the callback
+    def stop(self):
+        with self._cond:
+            self._deadline = None
+            self._cond.notify()
+
+    @property
+    def running(self):
+        with self._cond:
+            return self._deadline is not None
+
+    # Stop the thread of the timer
+    def destroy(self):
+        with self._cond:
+            self._destroyed = True
+            self._cond.notify()
+
+        if threading.current_thread() is not self._thread:
+            self._thread.join()
+
+    def _run(self):
+        with self._cond:
+            while not self._destroyed:
+                if self._deadline is None:
+                    self._cond.wait()
+                    continue
+
+                remaining = self._deadline - time.monotonic()
+                if remaining > 0:
+                    self._cond.wait(remaining)
+                    continue
+
+                self._deadline = None
+                self._cond.release()
+                try:
+                    self._callback()
+                finally:
+                    self._cond.acquire()
@@ -4,36 +4,157 @@
 # Stefan Popa
 
 import argparse
+import json
+import mmap
+import os
 from btcp.client_socket import BTCPClientSocket
+from btcp.congestion import CONGESTION_CONTROLS
+from btcp.constants import *
+from btcp.lossy_layer import path_mss
+from btcp.impairment import Impairment
+from btcp.compression import parse_compression
+from btcp.striping import send_file_striped
+from btcp.resume import ChunkIndex, send_file
+from btcp.session import send_files
+
+
+# A maximum segment size must fit in a UDP datagram
+def parse_mss(value):
+    if value == "auto":
+        return value
+
+    mss = int(value)
+    if not 0 < mss <= MAX_PAYLOAD_SIZE:
+        raise argparse.ArgumentTypeError("must be between 1 and {}".format(MAX_PAYLOAD_SIZE))
+
+    return mss
+
+
+# Forward error correction: a number of data segments per parity segment, or "auto"
+def parse_fec(value):
+    if value == "auto":
+        return value
+
+    block = int(value)
+    if not 0 < block <= 255:
+        raise argparse.ArgumentTypeError("must be between 1 and 255")
+
+    return block
+
+
+# A compression method, optionally with a level
+def parse_compress(value):
+    try:
+        parse_compression(value)
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(str(error))
+
+    return value
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-w", "--window", help="Define bTCP window size", type=int, default=100)
-    parser.add_argument("-t", "--timeout", help="Define bTCP timeout in milliseconds", type=int, default=100)
-    parser.add_argument("-i", "--input", help="File to send", default="input.file")
+    parser.add_argument("-t", "--timeout", help="Define the initial bTCP retransmission timeout in milliseconds",
+                        type=int, default=100)
+    parser.add_argument("-i", "--input", help="File to send; with --batch any number of files and directories",
+                        nargs="+", default=["input.file"])
+    parser.add_argument("-c", "--congestion", help="Define the congestion control algorithm",
+                        choices=sorted(CONGESTION_CONTROLS), default="reno")
+    parser.add_argument("-m", "--mss", help="Define the maximum segment size (payload bytes) to propose, or 'auto' for "
+                        "the largest that does not fragment on the route to the server", type=parse_mss,
+                        default=PAYLOAD_SIZE)
+    parser.add_argument("-n", "--impair", help="Emulate network impairments on the segments sent, described like the "
+                        "arguments of tc netem (for example \"loss 10%% 25%% delay 20ms seed 1\")",
+                        type=Impairment.parse)
+    parser.add_argument("-f", "--fec", help="Send a parity segment after every FEC data segments so the server can "
+                        "rebuild lost segments, or 'auto' to adapt the redundancy to the loss rate", type=parse_fec)
+    parser.add_argument("-z", "--compress", help="Compress the data if the server agrees, with zlib or lzma and an "
+                        "optional level (for example zlib:6 or lzma:1)", type=parse_compress)
+    parser.add_argument("-p", "--parallel", help="Send the file in stripes over this many connections, from as many "
+                        "processes, to the ports from the server port on", type=int, default=1)
+    parser.add_argument("-r", "--resume", help="Offer the hashes of the chunks of the file, so that a server that kept "
+                        "part of it from an earlier transfer only gets the chunks it is missing", action="store_true")
+    parser.add_argument("-b", "--batch", help="Send every input file, and every file below the input directories, as "
+                        "a named record over one connection, to a server in batch mode", action="store_true")
+    parser.add_argument("--trace", help="Write a trace of the connection events to this file (JSON lines)")
+    parser.add_argument("--stats", help="Print the connection statistics and the time spent per hot-path stage when "
+                        "done", action="store_true")
     args = parser.parse_args()
+    if args.parallel < 1:
+        parser.error("--parallel must be at least 1")
+    if args.parallel > 1 and (args.trace is not None or args.stats):
+        parser.error("--trace and --stats cannot be combined with --parallel")
+    if args.parallel > 1 and args.resume:
+        parser.error("--resume cannot be combined with --parallel")
+    if args.batch and (args.parallel > 1 or args.resume):
+        parser.error("--batch cannot be combined with --parallel or --resume")
+    if not args.batch:
+        if len(args.input) > 1:
+            parser.error("only one input can be sent without --batch")
+        args.input = args.input[0]
+    trace = open(args.trace, "w") if args.trace is not None else None
+
+    if args.mss == "auto":
+        args.mss = path_mss((SERVER_IP, SERVER_PORT))
+
+    # Striped transfer: every connection is set up, used and cleaned up by a worker process of its own
+    if args.parallel > 1:
+        print("Sending...")
+        if send_file_striped(args.input, args.parallel, args.window, args.timeout, congestion_control=args.congestion,
+                             mss=args.mss, impairment=args.impair, fec=args.fec, compression=args.compress):
+            print("Done sending.")
+        else:
+            print("Connection establishment has failed. Please try again.")
+        return
 
-    # Create a bTCP client socket with the given window size and timeout value
-    s = BTCPClientSocket(args.window, args.timeout)
+    # Hash the chunks of the file to offer them to the server
+    index = ChunkIndex.from_file(args.input) if args.resume else None
+
+    # Create a bTCP client socket with the given window size, timeout value, congestion control and maximum
+    # segment size
+    s = BTCPClientSocket(args.window, args.timeout, congestion_control=args.congestion, mss=args.mss,
+                         impairment=args.impair, trace=trace, profile=args.stats, fec=args.fec,
+                         compression=args.compress, resume=index)
 
     # Connect to the server socket
     if s.connect() == 0:
         print("Connection establishment has failed. Please try again.")
     else:
-        # Send the given file to the server
-        file = open(args.input, 'rb')
-        data = file.read()
         print("Sending...")
-        s.send(data)
+        if args.batch:
+            # Send all files as records, one after the other, without waiting for a round trip in between
+            send_files(s, args.input)
+        elif index is not None:
+            # Send the chunks of the file the server does not hold yet
+            send_file(s, args.input, index)
+        else:
+            # Send the given file to the server. The file is memory-mapped rather than read, so memory use does not
+            # grow with the size of the file (an empty file cannot be mapped).
+            file = open(args.input, 'rb')
+            if os.fstat(file.fileno()).st_size > 0:
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                data = b""
+            s.send(data)
+
+            if isinstance(data, mmap.mmap):
+                data.close()
+            file.close()
 
         # The full file has been sent
         print("Done sending.")
-        file.close()
         s.disconnect()
 
+        if args.stats:
+            print(json.dumps({"info": s.info(), "profile": s.profile.as_dict()}, indent=2))
+
         # Clean up any state
         s.close()
 
+    if trace is not None:
+        trace.close()
+
 
-main()
+if __name__ == "__main__":
+    main()
@@ -4,38 +4,121 @@
 # Stefan Popa
 
 import argparse
+import json
+import os
 from btcp.server_socket import BTCPServerSocket
+from btcp.impairment import Impairment
+from btcp.striping import receive_file_striped
+from btcp.resume import Manifest, receive_file
+from btcp.session import receive_files
+from btcp.constants import ACK_DELAY, ACK_EVERY, MAX_PAYLOAD_SIZE, RECV_BUFFER_SIZE
+
+
+# A maximum segment size must fit in a UDP datagram
+def parse_mss(value):
+    mss = int(value)
+    if not 0 < mss <= MAX_PAYLOAD_SIZE:
+        raise argparse.ArgumentTypeError("must be between 1 and {}".format(MAX_PAYLOAD_SIZE))
+
+    return mss
 
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("-w", "--window", help="Define bTCP window size", type=int, default=100)
+    parser.add_argument("-w", "--window", help="Define the initial bTCP window size, which autotunes up to the buffer "
+                        "size", type=int, default=100)
+    parser.add_argument("-B", "--buffer-size", help="Define the memory budget in bytes of the data received but not "
+                        "written yet", type=int, default=RECV_BUFFER_SIZE)
     parser.add_argument("-t", "--timeout", help="Define bTCP timeout in milliseconds", type=int, default=100)
-    parser.add_argument("-o", "--output", help="Where to store the file", default="output.file")
+    parser.add_argument("-o", "--output", help="Where to store the file; with --batch the directory to store the "
+                        "files in", default="output.file")
+    parser.add_argument("-a", "--ack-every", help="Acknowledge every Nth in-order segment", type=int, default=ACK_EVERY)
+    parser.add_argument("-d", "--ack-delay", help="Define the delayed ACK timeout in milliseconds", type=int,
+                        default=ACK_DELAY)
+    parser.add_argument("-m", "--mss", help="Define the largest maximum segment size (payload bytes) to accept",
+                        type=parse_mss, default=MAX_PAYLOAD_SIZE)
+    parser.add_argument("-n", "--impair", help="Emulate network impairments on the segments sent, described like the "
+                        "arguments of tc netem (for example \"loss 10%% 25%% delay 20ms seed 1\")",
+                        type=Impairment.parse)
+    parser.add_argument("--no-fec", help="Refuse forward error correction", action="store_true")
+    parser.add_argument("--no-compression", help="Refuse compression", action="store_true")
+    parser.add_argument("-p", "--parallel", help="Receive the file in stripes over this many connections, in as many "
+                        "processes, on the ports from the server port on", type=int, default=1)
+    parser.add_argument("-r", "--resume", help="Keep a manifest of the chunks written to the output file, so that a "
+                        "client that offers the hashes of its file only sends the chunks that are missing",
+                        action="store_true")
+    parser.add_argument("-b", "--batch", help="Receive the files a client in batch mode sends over one connection "
+                        "into the output directory", action="store_true")
+    parser.add_argument("--trace", help="Write a trace of the connection events to this file (JSON lines)")
+    parser.add_argument("--stats", help="Print the connection statistics and the time spent per hot-path stage when "
+                        "done", action="store_true")
     args = parser.parse_args()
+    if args.parallel < 1:
+        parser.error("--parallel must be at least 1")
+    if args.buffer_size < 1:
+        parser.error("--buffer-size must be at least 1")
+    if args.parallel > 1 and (args.trace is not None or args.stats):
+        parser.error("--trace and --stats cannot be combined with --parallel")
+    if args.parallel > 1 and args.resume:
+        parser.error("--resume cannot be combined with --parallel")
+    if args.batch and (args.parallel > 1 or args.resume):
+        parser.error("--batch cannot be combined with --parallel or --resume")
+    trace = open(args.trace, "w") if args.trace is not None else None
 
-    # Create a bTCP server socket
-    s = BTCPServerSocket(args.window, args.timeout)
+    # Striped transfer: every stripe is received and written to its place in the file by a worker process of its own
+    if args.parallel > 1:
+        print("Receiving...")
+        if not receive_file_striped(args.output, args.parallel, args.window, args.timeout, ack_every=args.ack_every,
+                                    ack_delay=args.ack_delay, mss=args.mss, impairment=args.impair,
+                                    accept_fec=not args.no_fec, accept_compression=not args.no_compression,
+                                    buffer_size=args.buffer_size):
+            print("The file was not received completely.")
+        return
+
+    # The manifest of the chunks of the output file that have been received, kept next to it
+    manifest = Manifest(args.output) if args.resume else None
+
+    # Create a bTCP server socket with the given delayed ACK policy, maximum segment size and receive buffer
+    s = BTCPServerSocket(args.window, args.timeout, ack_every=args.ack_every, ack_delay=args.ack_delay, mss=args.mss,
+                         impairment=args.impair, trace=trace, profile=args.stats, accept_fec=not args.no_fec,
+                         accept_compression=not args.no_compression, resume=manifest.held if manifest else None,
+                         buffer_size=args.buffer_size)
 
     # Accept the connection request
-    s.accept()
+    connection = s.accept()
 
-    # Receive data from the client and write it in a file
-    file = open(args.output, 'wb')
+    print("Receiving...")
+    if args.batch:
+        # Receive every record into a file of its own below the output directory
+        os.makedirs(args.output, exist_ok=True)
+        try:
+            print("Received {} files.".format(len(receive_files(connection, args.output))))
+        except (EOFError, ValueError) as error:
+            print("The files were not received completely: {}".format(error))
+            # Read the rest of the session, so that the client can finish
+            while connection.recv() != b"":
+                pass
+    elif connection.resume_index is not None:
+        # Receive the chunks the client sends into their place in the file, committing every one to the manifest
+        if not receive_file(connection, manifest):
+            print("The file was not received completely, the chunks received are kept for the next transfer.")
+    else:
+        # Receive data from the client and write it straight to the file as it arrives
+        file = open(args.output, 'wb')
+        connection.recv_to_file(file)
 
-    data = b""
-    new_data = s.recv
-    while new_data:
-        print("Receiving...")
-        data += new_data
-        new_data = s.recv
-    file.write(data)
+        # The full file has been received
+        file.close()
+    connection.close()
 
-    # The full file has been received
-    file.close()
+    if args.stats:
+        print(json.dumps({"info": connection.info(), "profile": connection.profile.as_dict()}, indent=2))
 
     # Clean up any state
     s.close()
+    if trace is not None:
+        trace.close()
 
 
-main()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,832 @@
+# Onno de Gouw
+# Stefan Popa
+
+import asyncio
+import io
+import json
+import mmap
+import tempfile
+import os
+import random
+import socket
+import threading
+import time
+import unittest
+from unittest import mock
+
+from btcp import checksum, codec
+from btcp.aio import AsyncBTCPClientSocket, AsyncBTCPServerSocket
+from btcp.btcp_socket import BTCPSocket
+from btcp.client_socket import BTCPClientSocket
+from btcp.lossy_layer import path_mss
+from btcp.impairment import Impairment, ImpairedLayer
+from btcp.congestion import Cubic, NewReno
+from btcp.fec import ParityEncoder, Redundancy, recover
+from btcp.compression import FRAME, FrameDecoder, FrameEncoder, available
+from btcp.resume import ChunkIndex, Manifest, receive_file, send_file
+from btcp.session import recv_record, receive_files, send_files, send_record
+from btcp.striping import receive_file_striped, send_file_striped, stripes
+from btcp.server_socket import BTCPServerSocket
+from btcp.timer import RTOEstimator, RetransmissionTimer
+from btcp.constants import *
+
+
+class TestChecksum(unittest.TestCase):
+    """The checksum engine must match the original per-word implementation bit for bit"""
+
+    def test_matches_reference(self):
+        rng = random.Random(1)
+        for length in list(range(0, 40)) + [1017, 1018, 1019, 65535]:
+            data = bytes(rng.getrandbits(8) for _ in range(length))
+            self.assertEqual(checksum.in_cksum(data), checksum.in_cksum_reference(data), length)
+            self.assertEqual(BTCPSocket.in_cksum(memoryview(data)), checksum.in_cksum_reference(data), length)
+
+    def test_edge_values(self):
+        for data in [b"", b"\x00" * 10, b"\xff" * 10, b"\xff\xff\x00\x00", b"\x01", b"\xff"]:
+            self.assertEqual(checksum.in_cksum(data), checksum.in_cksum_reference(data), data)
+
+    def test_split_sums(self):
+        header = os.urandom(10)
+        data = os.urandom(1008)
+        total = checksum.add(checksum.ones_sum(header), checksum.ones_sum(data))
+        self.assertEqual(checksum.finish(total), checksum.in_cksum_reference(header + data))
+
+    def test_incremental_update(self):
+        header = os.urandom(10)
+        new_header = os.urandom(10)
+        data = os.urandom(1007)
+        total = checksum.ones_sum(header + data)
+        updated = checksum.update(total, header, new_header)
+        self.assertEqual(checksum.finish(updated), checksum.in_cksum_reference(new_header + data))
+
+    def test_validity(self):
+        header = bytearray(os.urandom(10))
+        header[8:10] = b"\x00\x00"
+        data = os.urandom(1008)
+        cksum = checksum.in_cksum(bytes(header) + data)
+        header[8:10] = cksum.to_bytes(2, "big")
+        self.assertTrue(checksum.is_valid(bytes(header) + data))
+        header[0] ^= 1
+        self.assertFalse(checksum.is_valid(bytes(header) + data))
+
+
+class TestCodec(unittest.TestCase):
+    """Segments are encoded with a valid checksum and decoded without copying the payload"""
+
+    def test_round_trip(self):
+        payload = os.urandom(PAYLOAD_SIZE)
+        segment = bytes(codec.encode(65535, 7, ACK, 255, -1, payload))
+        self.assertTrue(checksum.is_valid(segment))
+        self.assertEqual(bytes(codec.encode_header(65535, 7, ACK, 255, -1, payload)) + payload, segment)
+
+        inp_segment = codec.decode(segment)
+        self.assertEqual((inp_segment.seq_num, inp_segment.ack_num, inp_segment.flags, inp_segment.window,
+                          inp_segment.data_length), (65535, 7, ACK, 255, -1))
+        self.assertEqual(inp_segment.data, payload)
+        self.assertIs(inp_segment.data.obj, segment)
+
+    def test_unwrap(self):
+        for reference in [0, 100, 65535, 65536, 3 * SEQ_SPACE - 1, 10 ** 9]:
+            for offset in [-1000, -1, 0, 1, 255, 1000]:
+                seq_num = reference + offset
+                self.assertEqual(codec.unwrap(codec.wrap(seq_num), reference), seq_num, (reference, offset))
+
+
+class TestRetransmissionTimeout(unittest.TestCase):
+    """RTO estimation and backoff follow RFC 6298"""
+
+    def test_estimator(self):
+        rto = RTOEstimator(100)
+        self.assertEqual(rto.rto, 100)
+        rto.sample(40)
+        self.assertEqual((rto.srtt, rto.rttvar, rto.rto), (40, 20, 120))
+        rto.sample(40)
+        self.assertEqual((rto.srtt, rto.rttvar, rto.rto), (40, 15, 100))
+
+    def test_bounds_and_backoff(self):
+        rto = RTOEstimator(100)
+        rto.sample(0.1)
+        self.assertEqual(rto.rto, MIN_RTO)
+        rto.backoff()
+        rto.backoff()
+        self.assertEqual(rto.rto, 4 * MIN_RTO)
+        rto.reset_backoff()
+        self.assertEqual(rto.rto, MIN_RTO)
+        for _ in range(64):
+            rto.backoff()
+        self.assertEqual(rto.rto, MAX_RTO)
+
+    def test_timer(self):
+        fired = threading.Event()
+        timer = RetransmissionTimer(fired.set)
+        timer.start(10)
+        self.assertTrue(timer.running)
+        self.assertTrue(fired.wait(1))
+        self.assertFalse(timer.running)
+
+        fired.clear()
+        timer.start(10)
+        timer.stop()
+        self.assertFalse(fired.wait(0.05))
+        timer.destroy()
+
+
+class TestCongestionControl(unittest.TestCase):
+    """Slow start, multiplicative decrease and the recovery of the congestion window"""
+
+    def test_new_reno(self):
+        cc = NewReno()
+        self.assertEqual(cc.window, INITIAL_CWND)
+        cc.on_ack(INITIAL_CWND, 10)
+        self.assertEqual(cc.window, 2 * INITIAL_CWND)
+        cc.on_loss(20)
+        self.assertEqual((cc.window, cc.ssthresh), (10, 10))
+        cc.on_ack(10, 10)
+        self.assertEqual(cc.window, 11)
+        cc.on_timeout(11)
+        self.assertEqual((cc.window, cc.ssthresh), (1, 5.5))
+
+    def test_cubic(self):
+        cc = Cubic()
+        cc.on_ack(90, 10)
+        cc.on_loss(100)
+        self.assertEqual(cc.window, int(100 * CUBIC_BETA))
+        # Ten round trips in the TCP-friendly region
+        for _ in range(700):
+            cc.on_ack(1, 10)
+        self.assertGreater(cc.window, int(100 * CUBIC_BETA))
+        self.assertLessEqual(cc.window, 100)
+
+
+class TestServerDelivery(unittest.TestCase):
+    """Segments are fed straight into lossy_layer_input, the server's replies go to unused ports"""
+
+    client = ("127.0.0.1", 20000)
+
+    def setUp(self):
+        self.server = BTCPServerSocket(10, 100)
+
+    def tearDown(self):
+        self.server.close()
+
+    def feed(self, seq_num, flags, data=b"\x00" * 8, address=client, data_length=0):
+        segment = self.server.build_segment(seq_num, 0, flags, 10, data_length, data)
+        self.server.lossy_layer_input(segment, address)
+
+    def test_accept_timeout(self):
+        with self.assertRaises(TimeoutError):
+            self.server.accept(timeout=0.01)
+
+    def test_recv(self):
+        self.feed(99, SYN)
+        connection = self.server.accept(timeout=1)
+        self.feed(100, 0, b"hello ")
+        self.feed(102, 0, b"out of order")
+        self.feed(101, 0, b"world")
+        self.assertEqual(connection.recv(3), b"hel")
+        self.assertEqual(connection.recv(), b"lo ")
+
+        # The out-of-order segment was kept in the reorder buffer until the gap before it was filled
+        buffer = bytearray(10)
+        self.assertEqual(connection.recv_into(buffer), 10)
+        self.assertEqual(bytes(buffer), b"worldout o")
+        self.assertEqual(connection.recv(), b"f order")
+        with self.assertRaises(TimeoutError):
+            connection.recv(timeout=0.01)
+
+        self.feed(103, FIN)
+        self.assertEqual(connection.recv(), b"")
+        self.assertEqual(connection.recv_into(buffer), 0)
+
+    def test_delayed_ack(self):
+        self.feed(99, SYN)
+        connection = self.server.accept(timeout=1)
+        acks = []
+        connection._lossy_layer.send_segment = lambda segment: acks.append(connection.unpack_segment(segment).ack_num)
+
+        # Every second in-order segment is acknowledged, a single one once the timer expires
+        self.feed(100, 0)
+        self.assertEqual(acks, [])
+        self.feed(101, 0)
+        self.assertEqual(acks, [102])
+        self.feed(102, 0)
+        time.sleep(0.05)
+        self.assertEqual(acks, [102, 103])
+
+        # A gap and the segment that fills it are acknowledged immediately
+        self.feed(104, 0)
+        self.feed(103, 0)
+        self.assertEqual(acks, [102, 103, 103, 105])
+        connection.close()
+
+    def test_receive_budget(self):
+        self.server.close()
+        self.server = BTCPServerSocket(10, 100, buffer_size=4 * PAYLOAD_SIZE)
+        self.feed(99, SYN)
+        connection = self.server.accept(timeout=1)
+        acks = []
+        connection._lossy_layer.send_segment = lambda segment: acks.append(connection.unpack_segment(segment))
+
+        # The budget holds four segments: the window closes, and a segment beyond it is dropped
+        for seq_num in range(100, 105):
+            self.feed(seq_num, 0, bytes(PAYLOAD_SIZE))
+        self.assertEqual([(ack.ack_num, ack.window) for ack in acks], [(102, 2), (104, 0), (104, 0)])
+        self.assertEqual(connection.info()["out_of_window"], 1)
+
+        # Reading one segment is not worth a window update, reading half the budget reopens the window
+        connection.recv()
+        self.assertEqual(len(acks), 3)
+        connection.recv()
+        self.assertEqual((acks[-1].flags, acks[-1].ack_num, acks[-1].window), (ACK, 104, 2))
+        self.assertEqual(connection.info()["window_updates"], 1)
+        connection.close()
+
+    def test_autotuning(self):
+        self.feed(99, SYN)
+        connection = self.server.accept(timeout=1)
+        now = [0]
+        connection._now = lambda: now[0]
+        connection._drain_start = 0
+        for seq_num in range(100, 110):
+            self.feed(seq_num, 0, bytes(PAYLOAD_SIZE))
+        self.assertEqual(connection.info()["window"], 0)
+
+        # Ten segments read within one AUTOTUNE_INTERVAL: the budget grows to twice that
+        now[0] = AUTOTUNE_INTERVAL
+        connection.recv_into(bytearray(10 * PAYLOAD_SIZE))
+        info = connection.info()
+        self.assertEqual((info["buffer_size"], info["window"]), (20 * PAYLOAD_SIZE, 20))
+        connection.close()
+
+    def test_handshake_rtt(self):
+        self.feed(99, SYN)
+        connection = self.server.accept(timeout=1)
+        time.sleep(0.03)
+        self.feed(100, ACK)
+        self.assertGreaterEqual(connection.info()["receive_rtt"], 30)
+
+        # Without data of its own to time, the connection measures the drain rate over that round trip
+        now = [0]
+        connection._now = lambda: now[0]
+        connection._drain_start = 0
+        connection._recv_rtt = 4 * AUTOTUNE_INTERVAL
+        for seq_num in range(100, 110):
+            self.feed(seq_num, 0, bytes(PAYLOAD_SIZE))
+        now[0] = AUTOTUNE_INTERVAL
+        connection.recv_into(bytearray(5 * PAYLOAD_SIZE))
+        self.assertEqual(connection.info()["buffer_size"], 10 * PAYLOAD_SIZE)
+        now[0] = 4 * AUTOTUNE_INTERVAL
+        connection.recv_into(bytearray(5 * PAYLOAD_SIZE))
+        self.assertEqual(connection.info()["buffer_size"], 20 * PAYLOAD_SIZE)
+        connection.close()
+
+    def test_mss_negotiation(self):
+        synacks = []
+        self.server._lossy_layer.send_segments = lambda segments, address: synacks.extend(map(codec.decode, segments))
+
+        # The client's proposal is accepted, a client that does not negotiate gets the default size
+        self.feed(99, SYN, codec.MSS_OPTION.pack(4000), data_length=codec.MSS_OPTION.size)
+        self.feed(500, SYN, address=("127.0.0.1", 20001))
+        self.assertEqual([codec.mss_option(synack) for synack in synacks], [4000, PAYLOAD_SIZE])
+
+    def test_statistics(self):
+        self.server.close()
+        trace = io.StringIO()
+        self.server = BTCPServerSocket(10, 100, trace=trace, profile=True)
+
+        self.feed(99, SYN)
+        connection = self.server.accept(timeout=1)
+        self.feed(100, 0, b"in order")
+        self.feed(102, 0, b"out of order")
+        self.feed(102, 0, b"out of order")
+        self.feed(100, 0, b"in order")
+        self.feed(200, 0, b"beyond the window")
+        segment = bytearray(self.server.build_segment(101, 0, 0, 10, 0, b"flipped"))
+        segment[-1] ^= 1
+        self.server.lossy_layer_input(bytes(segment), self.client)
+
+        info = connection.info()
+        self.assertEqual((info["segments_received"], info["checksum_failures"], info["out_of_order"],
+                          info["duplicates"], info["out_of_window"]), (7, 1, 1, 2, 1))
+        self.assertEqual((info["bytes_received"], info["buffered"], info["reorder_buffer"]), (20, 1, 1))
+        self.assertEqual(info["acks_sent"], 5)
+
+        # Every event is a JSON line, and every stage of the hot path has been timed
+        events = [json.loads(line) for line in trace.getvalue().splitlines()]
+        self.assertEqual({event["connection"] for event in events}, {"127.0.0.1:20000"})
+        self.assertEqual([event["name"] for event in events].count("checksum_failure"), 1)
+        self.assertEqual(set(connection.profile.stages), {"build", "checksum", "dispatch", "send"})
+        self.assertEqual(connection.profile.stages["dispatch"][0], 7)
+        connection.close()
+
+    def test_forward_error_correction(self):
+        option = codec.encode_options(PAYLOAD_SIZE, {OPTION_FEC: b""})
+        self.feed(99, SYN, option, data_length=len(option))
+        connection = self.server.accept(timeout=1)
+        payloads = [b"first", b"second segment", b"third"]
+        encoder = ParityEncoder()
+        for index, payload in enumerate(payloads):
+            encoder.add(100 + index, payload)
+        parity = encoder.finish()
+
+        # The second segment is lost, the parity rebuilds it
+        self.feed(100, 0, payloads[0])
+        self.feed(102, 0, payloads[2])
+        self.feed(100, PARITY, parity, data_length=len(parity))
+        self.assertEqual(connection.recv_into(bytearray(100)), sum(map(len, payloads)))
+        self.assertEqual(connection.info()["fec_recovered"], 1)
+        connection.close()
+
+    def test_recv_to_file(self):
+        self.feed(99, SYN)
+        payloads = [os.urandom(PAYLOAD_SIZE) for _ in range(5)]
+        for index, payload in enumerate(payloads):
+            self.feed(100 + index, 0, payload)
+        self.feed(105, FIN)
+
+        file = io.BytesIO()
+        self.assertEqual(self.server.accept(timeout=1).recv_to_file(file, timeout=1), 5 * PAYLOAD_SIZE)
+        self.assertEqual(file.getvalue(), b"".join(payloads))
+
+    def test_demultiplexing(self):
+        other = ("127.0.0.1", 20001)
+        self.feed(99, SYN)
+        self.feed(500, SYN, address=other)
+        self.feed(100, 0, b"first")
+        self.feed(501, 0, b"second", address=other)
+        first = self.server.accept(timeout=1)
+        second = self.server.accept(timeout=1)
+
+        self.assertEqual((first.address, second.address), (self.client, other))
+        self.assertEqual(first.recv(), b"first")
+        self.assertEqual(second.recv(), b"second")
+
+        # Data from a client without a connection is ignored
+        self.feed(7, 0, b"stray", address=("127.0.0.1", 20002))
+        with self.assertRaises(TimeoutError):
+            self.server.accept(timeout=0.01)
+
+
+class TestLoopbackTransfer(unittest.TestCase):
+    """Complete transfers between a client and a server at full speed over the loopback interface"""
+
+    def transfer(self, payload, isn, mss=PAYLOAD_SIZE, impairment=None, fec=None, compression=None):
+        server = BTCPServerSocket(100, 100, ("127.0.0.1", 0), impairment=impairment)
+        received = []
+
+        def serve():
+            connection = server.accept(timeout=5)
+            file = io.BytesIO()
+            connection.recv_to_file(file, timeout=5)
+            received.append(file.getvalue())
+            connection.close()
+
+        thread = threading.Thread(target=serve)
+        thread.start()
+        client = BTCPClientSocket(100, 100, server._lossy_layer._udp_sock.getsockname(), ("127.0.0.1", 0), mss=mss,
+                                  impairment=impairment, fec=fec, compression=compression)
+        with mock.patch("btcp.client_socket.random.getrandbits", return_value=isn):
+            self.assertEqual(client.connect(), 1)
+        client.send(payload)
+        client.disconnect()
+        client.close()
+        thread.join(5)
+        server.close()
+
+        self.assertEqual(received, [payload])
+        return client
+
+    # A transfer that starts just below 2^16 crosses the wrap of the 16-bit sequence numbers on the wire
+    def test_transfer_across_wrap(self):
+        client = self.transfer(os.urandom(2000 * PAYLOAD_SIZE + 1), SEQ_SPACE - 1)
+        self.assertGreater(client._seq_num, SEQ_SPACE + 2000)
+
+    # The largest segments that do not fragment on loopback
+    def test_large_segments(self):
+        mss = path_mss(("127.0.0.1", SERVER_PORT))
+        client = self.transfer(os.urandom(100 * mss + 1), 1000, mss)
+        self.assertEqual(client._mss, mss)
+
+    # All impairments of testframework.py at once, emulated in both directions
+    def test_impaired_network(self):
+        impairment = Impairment.parse("corrupt 1% duplicate 10% loss 10% 25% delay 20ms reorder 25% 50% seed 1")
+        client = self.transfer(os.urandom(200 * PAYLOAD_SIZE), 1000, impairment=impairment)
+
+        info = client.info()
+        self.assertEqual(info["bytes_acked"], 200 * PAYLOAD_SIZE)
+        self.assertGreater(info["retransmissions"], 0)
+        self.assertGreater(info["checksum_failures"] + info["duplicate_acks"], 0)
+        self.assertIsNotNone(info["srtt"])
+
+    # Forward error correction on a lossy high-latency path
+    def test_forward_error_correction(self):
+        impairment = Impairment.parse("loss 5% delay 20ms seed 2")
+        client = self.transfer(os.urandom(200 * PAYLOAD_SIZE), 1000, impairment=impairment, fec="auto")
+        self.assertGreater(client.stats.parity_sent, 0)
+        self.assertEqual(client.stats.bytes_acked, 200 * PAYLOAD_SIZE)
+
+    # Compressible data takes a fraction of the segments
+    def test_compression(self):
+        client = self.transfer(TestCompression.text, 1000, compression="zlib:1")
+        self.assertLess(client.stats.bytes_sent, len(TestCompression.text) / 4)
+
+    # A reader slower than the path keeps the window closed, which the client probes without taking it for congestion
+    def test_slow_reader(self):
+        server = BTCPServerSocket(4, 100, ("127.0.0.1", 0), buffer_size=4 * PAYLOAD_SIZE)
+        payload = os.urandom(24 * PAYLOAD_SIZE)
+        received = bytearray()
+
+        def serve():
+            connection = server.accept(timeout=5)
+            buffer = bytearray(2 * PAYLOAD_SIZE)
+            while True:
+                time.sleep(0.05)
+                count = connection.recv_into(buffer, timeout=5)
+                if count == 0:
+                    break
+                received.extend(buffer[:count])
+            connection.close()
+
+        thread = threading.Thread(target=serve)
+        thread.start()
+        client = BTCPClientSocket(100, 10, server._lossy_layer._udp_sock.getsockname(), ("127.0.0.1", 0))
+        self.assertEqual(client.connect(), 1)
+        client.send(payload)
+        client.disconnect()
+        client.close()
+        thread.join(5)
+        server.close()
+
+        self.assertEqual(received, payload)
+        info = client.info()
+        self.assertGreater(info["window_probes"], 0)
+        self.assertEqual((info["timeouts"], info["retransmissions"], info["duplicate_acks"]), (0, 0, 0))
+        self.assertIsNone(info["ssthresh"])
+
+
+class TestForwardErrorCorrection(unittest.TestCase):
+    """XOR parity rebuilds any single segment of a block, and the block size follows the loss rate"""
+
+    def test_recover(self):
+        payloads = [os.urandom(size) for size in (1008, 1008, 17, 1008)]
+        encoder = ParityEncoder()
+        for index, payload in enumerate(payloads):
+            encoder.add(index, memoryview(payload))
+        parity = encoder.finish()
+
+        for lost in range(len(payloads)):
+            self.assertEqual(recover(parity, payloads[:lost] + payloads[lost + 1:]), payloads[lost])
+
+    def test_adaptive_redundancy(self):
+        redundancy = Redundancy(FEC_BLOCK, adaptive=True)
+        for _ in range(100):
+            redundancy.update(100, 10)
+        self.assertLess(redundancy.block, FEC_BLOCK)
+        for _ in range(100):
+            redundancy.update(100, 0)
+        self.assertEqual(redundancy.block, FEC_MAX_BLOCK)
+
+        fixed = Redundancy(4)
+        fixed.update(100, 50)
+        self.assertEqual(fixed.block, 4)
+
+
+class TestCompression(unittest.TestCase):
+    """Frames decode segment by segment, and incompressible chunks are sent as they are"""
+
+    text = b"".join(b"2026-01-01,host%d,GET /items/%d,200\n" % (index % 7, index) for index in range(40000))
+
+    def round_trip(self, method, data):
+        encoder = FrameEncoder(method, None)
+        frames = b"".join(encoder.frames(memoryview(data)))
+        decoder = FrameDecoder(method)
+        decoded = b"".join(bytes(part) for start in range(0, len(frames), PAYLOAD_SIZE)
+                           for part in decoder.decode(frames[start:start + PAYLOAD_SIZE]))
+        self.assertEqual(decoded, data)
+        return encoder
+
+    def test_round_trip(self):
+        for method in available():
+            encoder = self.round_trip(method, self.text + os.urandom(COMPRESSION_CHUNK) + self.text)
+            self.assertLess(encoder.bytes_out, encoder.bytes_in / 2)
+
+    def test_incompressible(self):
+        encoder = self.round_trip("zlib", os.urandom(3 * COMPRESSION_CHUNK))
+        self.assertEqual(encoder.bytes_out, encoder.bytes_in + 3 * FRAME.size)
+
+
+class TestStriping(unittest.TestCase):
+    """A file split into stripes over several connections is written back together in place"""
+
+    def test_stripes(self):
+        for size in (0, 1, mmap.ALLOCATIONGRANULARITY, 10 ** 7 + 3):
+            parts = stripes(size, 3)
+            self.assertEqual(len(parts), 3)
+            self.assertEqual(sum(length for _, length in parts), size)
+            for (offset, length), (next_offset, next_length) in zip(parts, parts[1:]):
+                self.assertEqual(offset + length, next_offset)
+                if next_length > 0:
+                    self.assertEqual(next_offset % mmap.ALLOCATIONGRANULARITY, 0)
+
+    def test_transfer(self):
+        data = os.urandom(3 * mmap.ALLOCATIONGRANULARITY + 100)
+        address = ("127.0.0.1", 31000)
+
+        with tempfile.TemporaryDirectory() as directory:
+            input_path = os.path.join(directory, "input.file")
+            output_path = os.path.join(directory, "output.file")
+            with open(input_path, "wb") as file:
+                file.write(data)
+
+            received = []
+            thread = threading.Thread(
+                target=lambda: received.append(receive_file_striped(output_path, 3, 100, 100, address)))
+            thread.start()
+            self.assertTrue(send_file_striped(input_path, 3, 100, 100, address, local_address=("127.0.0.1", 0)))
+            thread.join(10)
+
+            self.assertEqual(received, [True])
+            with open(output_path, "rb") as file:
+                self.assertEqual(file.read(), data)
+
+
+class TestResume(unittest.TestCase):
+    """An interrupted or changed file is completed by sending only the chunks the server does not hold"""
+
+    def transfer(self, input_path, output_path):
+        server = BTCPServerSocket(100, 100, ("127.0.0.1", 31010), resume=Manifest(output_path).held)
+        client = BTCPClientSocket(100, 100, ("127.0.0.1", 31010), ("127.0.0.1", 0),
+                                  resume=ChunkIndex.from_file(input_path))
+        received = []
+
+        def receive():
+            connection = server.accept(timeout=5)
+            received.append(receive_file(connection, Manifest(output_path)))
+            connection.close()
+
+        thread = threading.Thread(target=receive)
+        thread.start()
+        try:
+            self.assertEqual(client.connect(), 1)
+            send_file(client, input_path, client._resume)
+            client.disconnect()
+            thread.join(10)
+        finally:
+            client.close()
+            server.close()
+
+        self.assertEqual(received, [True])
+        return client
+
+    @mock.patch("btcp.resume.RESUME_CHUNK", 64 * 1024)
+    def test_resume(self):
+        data = bytearray(os.urandom(5 * 64 * 1024 + 100))
+
+        with tempfile.TemporaryDirectory() as directory:
+            input_path = os.path.join(directory, "input.file")
+            output_path = os.path.join(directory, "output.file")
+            with open(input_path, "wb") as file:
+                file.write(data)
+            self.assertEqual(self.transfer(input_path, output_path).resume_held, set())
+
+            # Chunk 1 changes, and the commit of the last chunk was lost when the transfer was interrupted
+            data[64 * 1024 + 10] ^= 1
+            with open(input_path, "wb") as file:
+                file.write(data)
+            with open(output_path + ".manifest") as file:
+                lines = file.readlines()
+            with open(output_path + ".manifest", "w") as file:
+                file.writelines(lines[:-1])
+
+            client = self.transfer(input_path, output_path)
+            self.assertEqual(client.resume_held, {0, 2, 3, 4})
+            self.assertLess(client.stats.bytes_acked, 2 * 64 * 1024)
+            with open(output_path, "rb") as file:
+                self.assertEqual(file.read(), data)
+
+
+class TestSession(unittest.TestCase):
+    """Records of any size are pipelined over one connection and arrive whole and in order"""
+
+    def session(self, send, receive):
+        server = BTCPServerSocket(100, 100, ("127.0.0.1", 31020))
+        client = BTCPClientSocket(100, 100, ("127.0.0.1", 31020), ("127.0.0.1", 0))
+        received = []
+
+        # The result of receive, or the exception it raised. The rest of the data is read in any case, so that the
+        # client can finish.
+        def run():
+            connection = server.accept(timeout=5)
+            try:
+                received.append(receive(connection))
+            except Exception as error:
+                received.append(error)
+            while connection.recv() != b"":
+                pass
+            connection.close()
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        try:
+            self.assertEqual(client.connect(), 1)
+            send(client)
+            client.disconnect()
+            thread.join(10)
+        finally:
+            client.close()
+            server.close()
+
+        return received[0]
+
+    def test_records(self):
+        records = [("empty", b""), ("small", b"x" * 100), ("large", os.urandom(SESSION_JOIN_SIZE + PAYLOAD_SIZE + 1)),
+                   ("ünïcode", os.urandom(3 * PAYLOAD_SIZE))]
+
+        def send(client):
+            for name, data in records:
+                send_record(client, name, data)
+
+        def receive(connection):
+            return list(iter(lambda: recv_record(connection), None))
+
+        self.assertEqual(self.session(send, receive), records)
+
+    def test_files(self):
+        with tempfile.TemporaryDirectory() as directory:
+            files = {"a.txt": b"first", "sub/b.bin": os.urandom(SESSION_READ_SIZE + 10), "sub/deeper/c": b""}
+            for name, data in files.items():
+                path = os.path.join(directory, "input", *name.split("/"))
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, "wb") as file:
+                    file.write(data)
+            output = os.path.join(directory, "output")
+
+            names = self.session(lambda client: send_files(client, [os.path.join(directory, "input")]),
+                                 lambda connection: receive_files(connection, output))
+
+            self.assertEqual(sorted(names), sorted(files))
+            for name, data in files.items():
+                with open(os.path.join(output, *name.split("/")), "rb") as file:
+                    self.assertEqual(file.read(), data)
+
+            # Names that lead out of the output directory are refused
+            error = self.session(lambda client: send_record(client, "../escape", b"data"),
+                                 lambda connection: receive_files(connection, output))
+            self.assertIsInstance(error, ValueError)
+
+
+class TestDuplex(unittest.TestCase):
+    """Both sides send at the same time, and data segments carry the ACKs for the other direction"""
+
+    def duplex(self, serve, run):
+        server = BTCPServerSocket(100, 100, ("127.0.0.1", 0))
+        client = BTCPClientSocket(100, 100, server._lossy_layer._udp_sock.getsockname(), ("127.0.0.1", 0))
+        infos = []
+
+        def accept():
+            connection = server.accept(timeout=5)
+            serve(connection)
+            while connection.recv(timeout=5) != b"":
+                pass
+            infos.append(connection.info())
+            connection.close()
+
+        thread = threading.Thread(target=accept)
+        thread.start()
+        try:
+            self.assertEqual(client.connect(), 1)
+            run(client)
+            client.disconnect()
+            thread.join(10)
+            infos.insert(0, client.info())
+        finally:
+            client.close()
+            server.close()
+
+        return infos
+
+    @staticmethod
+    def recv_exactly(socket, nbytes):
+        data = b""
+        while len(data) < nbytes:
+            data += socket.recv(nbytes - len(data), timeout=5)
+
+        return data
+
+    def test_request_response(self):
+        requests = [os.urandom(100) for _ in range(50)]
+        responses = []
+
+        def serve(connection):
+            for _ in requests:
+                connection.send(self.recv_exactly(connection, 100)[::-1])
+
+        def run(client):
+            for request in requests:
+                client.send(request, wait=False)
+                responses.append(self.recv_exactly(client, 100))
+
+        client_info, server_info = self.duplex(serve, run)
+        self.assertEqual(responses, [request[::-1] for request in requests])
+
+        # Every response acknowledges its request, and the next request the response: hardly any ACK goes alone
+        self.assertGreater(server_info["acks_piggybacked"] + client_info["acks_piggybacked"], 50)
+        self.assertLess(server_info["acks_sent"] + client_info["acks_sent"], 50)
+
+    def test_both_directions(self):
+        upload, download = os.urandom(300 * PAYLOAD_SIZE + 1), os.urandom(200 * PAYLOAD_SIZE + 7)
+        received = {}
+
+        def exchange(socket, data, name):
+            sender = threading.Thread(target=socket.send, args=(data,))
+            sender.start()
+            received[name] = self.recv_exactly(socket, len(upload if name == "server" else download))
+            sender.join(10)
+
+        self.duplex(lambda connection: exchange(connection, download, "server"),
+                    lambda client: exchange(client, upload, "client"))
+        self.assertEqual(received, {"server": upload, "client": download})
+
+
+class TestImpairment(unittest.TestCase):
+    """The in-process network emulator understands netem arguments and is reproducible"""
+
+    def test_parse(self):
+        impairment = Impairment.parse("loss 10% 25% delay 20ms 5ms reorder 25% duplicate 0.1 rate 8kbit seed 7")
+        self.assertEqual((impairment.loss, impairment.loss_correlation, impairment.delay, impairment.jitter),
+                         (0.1, 0.25, 20, 5))
+        self.assertEqual((impairment.reorder, impairment.duplicate, impairment.rate, impairment.seed),
+                         (0.25, 0.1, 1000, 7))
+        self.assertEqual(Impairment.parse("loss gemodel 1% 30%").gemodel, (0.01, 0.3, 1, 0))
+        with self.assertRaises(ValueError):
+            Impairment.parse("jam 10%")
+
+    def test_seeded(self):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(("127.0.0.1", 0))
+        receiver.settimeout(0.5)
+        impairment = Impairment.parse("loss gemodel 5% 20% duplicate 10% corrupt 10% seed 3")
+
+        # The same segments are lost, duplicated and corrupted every time
+        runs = []
+        for _ in range(2):
+            layer = ImpairedLayer(None, "127.0.0.1", 0, *receiver.getsockname(), impairment)
+            layer.send_segments([bytes([number]) * 8 for number in range(200)])
+            layer.destroy()
+
+            received = []
+            try:
+                while True:
+                    received.append(receiver.recv(100))
+            except socket.timeout:
+                runs.append(received)
+
+        receiver.close()
+        self.assertEqual(runs[0], runs[1])
+        self.assertTrue(150 < len(runs[0]) < 200)
+
+
+class TestAsyncio(unittest.TestCase):
+    """Many transfers run concurrently on one event loop against one listening socket"""
+
+    def test_concurrent_transfers(self):
+        payloads = [os.urandom(random.randrange(0, 20 * PAYLOAD_SIZE)) for _ in range(20)]
+        received = {}
+
+        async def serve(connection):
+            chunks = []
+            data = await connection.recv(timeout=5)
+            while data:
+                chunks.append(bytes(data))
+                data = await connection.recv(timeout=5)
+
+            received[connection.address] = b"".join(chunks)
+            connection.close()
+
+        async def send(address, payload):
+            client = AsyncBTCPClientSocket(10, 100, address, ("127.0.0.1", 0))
+            self.assertEqual(await client.connect(), 1)
+            await client.send(payload)
+            await client.disconnect()
+            client.close()
+
+            return client._transport.get_extra_info("sockname")
+
+        async def main():
+            server = AsyncBTCPServerSocket(10, 100, ("127.0.0.1", 0))
+            address = await server.listen()
+            clients = asyncio.gather(*(send(address, payload) for payload in payloads))
+            connections = [await server.accept(timeout=5) for _ in payloads]
+            await asyncio.gather(*(serve(connection) for connection in connections))
+            addresses = await clients
+            server.close()
+
+            return addresses
+
+        addresses = asyncio.run(main())
+        for address, payload in zip(addresses, payloads):
+            self.assertEqual(received[address], payload)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -11,6 +11,10 @@ import sys
 timeout=100
 winsize=100
 intf="lo"
+# With emulate set, the impairments are emulated in-process by client_app.py and server_app.py (see btcp.impairment)
+# instead of by tc netem, which needs root. seed makes the emulated impairments reproducible.
+emulate=False
+seed=1
 netem_add="sudo tc qdisc add dev {} root netem".format(intf)
 netem_change="sudo tc qdisc change dev {} root netem {}".format(intf,"{}")
 netem_del="sudo tc qdisc del dev {} root netem".format(intf)
@@ -53,19 +57,37 @@ class TestbTCPFramework(unittest.TestCase):
     def setUp(self):
         """Prepare for testing"""
         # default netem rule (does nothing)
-        run_command(netem_add)
-
-        # launch localhost server
-        self._server_thread = threading.Thread(target=run_command_with_output,
-                                        args=(f"python3 server_app.py -w {winsize} -t {timeout} -o output.file", ))
-        self._server_thread.start()
+        self._impairment = None
+        if not emulate:
+            run_command(netem_add)
 
     def tearDown(self):
         """Clean up after testing"""
         # clean the environment
-        run_command(netem_del)
-        
-        # close server
+        if not emulate:
+            run_command(netem_del)
+
+    def impair(self, spec):
+        """set up the network impairments, given as tc netem arguments"""
+        if emulate:
+            self._impairment = spec
+        else:
+            run_command(netem_change.format(spec))
+
+    def transfer(self):
+        """send input.file from a localhost client to a localhost server, which stores it in output.file"""
+        impair = f' -n "{self._impairment} seed {seed}"' if self._impairment is not None else ""
+
+        # launch localhost server
+        server = f"python3 server_app.py -w {winsize} -t {timeout} -o output.file{impair}"
+        server_thread = threading.Thread(target=run_command_with_output, args=(server, ))
+        server_thread.start()
+
+        # launch localhost client connecting to server
+        run_command_with_output(f"python3 client_app.py -w {winsize} -t {timeout} -i input.file{impair}")
+
+        # close server: it exits once the client has closed the connection
+        server_thread.join()
 
     def test_ideal_network(self):
         """reliability over an ideal framework"""
@@ -76,7 +98,7 @@ class TestbTCPFramework(unittest.TestCase):
         # launch localhost client connecting to server
         # client sends content to server
         # server receives content from client
-        run_command_with_output(f"python3 client_app.py -w {winsize} -t {timeout} -i input.file")
+        self.transfer()
 
         # content received by server matches the content sent by client
         assert filecmp.cmp('input.file', 'output.file')
@@ -87,12 +109,12 @@ class TestbTCPFramework(unittest.TestCase):
         print("Flipping network...")
         
         # setup environment
-        run_command(netem_change.format("corrupt 1%"))
+        self.impair("corrupt 1%")
         
         # launch localhost client connecting to server
         # client sends content to server
         # server receives content from client
-        run_command_with_output(f"python3 client_app.py -w {winsize} -t {timeout} -i input.file")
+        self.transfer()
         
         # content received by server matches the content sent by client
         assert filecmp.cmp('input.file', 'output.file')
@@ -102,12 +124,12 @@ class TestbTCPFramework(unittest.TestCase):
         print("Duplicate network...")
         
         # setup environment
-        run_command(netem_change.format("duplicate 10%"))
+        self.impair("duplicate 10%")
         
         # launch localhost client connecting to server
         # client sends content to server
         # server receives content from client
-        run_command_with_output(f"python3 client_app.py -w {winsize} -t {timeout} -i input.file")
+        self.transfer()
 
         # content received by server matches the content sent by client
         assert filecmp.cmp('input.file', 'output.file')
@@ -117,12 +139,27 @@ class TestbTCPFramework(unittest.TestCase):
         print("Packet loss...")
         
         # setup environment
-        run_command(netem_change.format("loss 10% 25%"))
+        self.impair("loss 10% 25%")
         
         # launch localhost client connecting to server
         # client sends content to server
         # server receives content from client
-        run_command_with_output(f"python3 client_app.py -w {winsize} -t {timeout} -i input.file")
+        self.transfer()
+
+        # content received by server matches the content sent by client
+        assert filecmp.cmp('input.file', 'output.file')
+
+    def test_burst_loss_network(self):
+        """reliability over network with bursts of packet loss (Gilbert-Elliott model)"""
+        print("Burst loss...")
+
+        # setup environment
+        self.impair("loss gemodel 1% 30%")
+
+        # launch localhost client connecting to server
+        # client sends content to server
+        # server receives content from client
+        self.transfer()
 
         # content received by server matches the content sent by client
         assert filecmp.cmp('input.file', 'output.file')
@@ -132,12 +169,12 @@ class TestbTCPFramework(unittest.TestCase):
         print("Reordering...")
         
         # setup environment
-        run_command(netem_change.format("delay 20ms reorder 25% 50%"))
+        self.impair("delay 20ms reorder 25% 50%")
         
         # launch localhost client connecting to server
         # client sends content to server
         # server receives content from client
-        run_command_with_output(f"python3 client_app.py -w {winsize} -t {timeout} -i input.file")
+        self.transfer()
 
         # content received by server matches the content sent by client
         assert filecmp.cmp('input.file', 'output.file')
@@ -147,12 +184,12 @@ class TestbTCPFramework(unittest.TestCase):
         print("Delayed...")
         
         # setup environment
-        run_command(netem_change.format("delay "+str(timeout)+"ms 20ms"))
+        self.impair("delay "+str(timeout)+"ms 20ms")
         
         # launch localhost client connecting to server
         # client sends content to server
         # server receives content from client
-        run_command_with_output(f"python3 client_app.py -w {winsize} -t {timeout} -i input.file")
+        self.transfer()
         
         # content received by server matches the content sent by client
         assert filecmp.cmp('input.file', 'output.file')
@@ -162,12 +199,12 @@ class TestbTCPFramework(unittest.TestCase):
         print("All bad...")
 
         # setup environment
-        run_command(netem_change.format("corrupt 1% duplicate 10% loss 10% 25% delay 20ms reorder 25% 50%"))
+        self.impair("corrupt 1% duplicate 10% loss 10% 25% delay 20ms reorder 25% 50%")
         
         # launch localhost client connecting to server
         # client sends content to server
         # server receives content from client
-        run_command_with_output(f"python3 client_app.py -w {winsize} -t {timeout} -i input.file")
+        self.transfer()
         
         # content received by server matches the content sent by client
         assert filecmp.cmp('input.file', 'output.file')
@@ -185,9 +222,14 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="bTCP tests")
     parser.add_argument("-w", "--window", help="Define bTCP window size used", type=int, default=100)
     parser.add_argument("-t", "--timeout", help="Define the timeout value used (ms)", type=int, default=timeout)
+    parser.add_argument("-e", "--emulate", help="Emulate the network impairments in-process instead of with tc netem",
+                        action="store_true")
+    parser.add_argument("-s", "--seed", help="Define the seed of the emulated impairments", type=int, default=seed)
     args, extra = parser.parse_known_args()
     timeout = args.timeout
     winsize = args.window
+    emulate = args.emulate
+    seed = args.seed
     
     # Pass the extra arguments to unittest
     sys.argv[1:] = extra